@@ -1,167 +1,258 @@
 # coding: utf-8
 
-import time
+'''Benchmark suite: throughput, latency percentiles, startup and merge
+
+For each value size a new cask (on a temporary directory) is filled with
+`--keys` keys (fewer for big values, see `--max-bytes`) and these workloads
+are measured:
+
+- write: the cask is filled, one `__setitem__` per key;
+- read_sequential, read_random, read_zipfian: `--ops` reads of keys in the
+  order they were written, uniformly distributed or zipfian distributed
+  (a few keys are much more read than the others);
+- mixed_90_10, mixed_50_50: reads and writes (of zipfian distributed keys)
+  with these ratios;
+- open_hints, open_no_hints: the closed cask is opened (on a separate process)
+  with its hint files and without them (they're created from data files),
+  reporting the duration and the RSS increase per key;
+- merge: half the keys are overwritten and the cask is merged.
+
+Only the local filesystem is used. Results are saved as JSON, including
+the git commit (if any), so runs of different commits can be compared with
+`--baseline`.
+'''
+
+import bisect
 import glob
 import json
+import multiprocessing
 import os
+import platform
+import random
 import shutil
-import timeit
-
-
-CODE = '''
-import dbm
-import hashlib
+import subprocess
 import tempfile
+import time
+
+import psutil
 
 import bitcask
-import redis
 
 
-def _generate_key_value(counter):
-    key = bytes('{:010d}'.format(counter), 'ascii')
-    value = (key * 410)[:-4]
-    return key, value
+VALUE_SIZES = (16, 256, 4096, 65536, 1048576)
+MIXED_RATIOS = {'mixed_90_10': 0.9, 'mixed_50_50': 0.5}
 
-TOTAL = ##TOTAL##
-testkey, testvalue = _generate_key_value(TOTAL)
-keysize = TOTAL * len(testkey)
-valuesize = TOTAL * len(testvalue)
-totalsize = keysize + valuesize
-dbindexes = list(range(15))
-print('Total data written: {:7.3f} MB'.format(totalsize / (1024 ** 2)))
 
+def _key(counter):
+    return bytes('{:010d}'.format(counter), 'ascii')
 
-def test_bitcask_readwrite():
-    path = tempfile.mktemp()
-    print('  Bitcask on {}'.format(path))
-    bcask = bitcask.Bitcask(path)
-    for counter in range(TOTAL):
-        key, value = _generate_key_value(counter)
-        bcask[key] = value
-        assert bcask[key] == value
-
-def test_bitcask_write():
-    path = tempfile.mktemp()
-    print('  Bitcask on {}'.format(path))
-    bcask = bitcask.Bitcask(path)
-    for counter in range(TOTAL):
-        key, value = _generate_key_value(counter)
-        bcask[key] = value
 
-def test_dbm_readwrite():
-    path = tempfile.mktemp()
-    print('  DBM on {}'.format(path))
-    db = dbm.open(path, 'c')
-    for counter in range(TOTAL):
-        key, value = _generate_key_value(counter)
-        db[key] = value
-        assert db[key] == value
-    db.close()
-
-def test_dbm_write():
-    path = tempfile.mktemp()
-    print('  DBM on {}'.format(path))
-    db = dbm.open(path, 'c')
-    for counter in range(TOTAL):
-        key, value = _generate_key_value(counter)
-        db[key] = value
-    db.close()
-
-def test_redis():
-    port = dbindexes.pop()
-    print('  Redis on {}'.format(port))
-    redis_dict = redis.StrictRedis('localhost', port=9999)
-    for counter in range(TOTAL):
-        redis_dict[key] = value
-        assert redis_dict[key] == value
-'''
+def _value(counter, size):
+    return (_key(counter) * (size // 10 + 1))[:size]
+
+
+def percentile(sorted_values, fraction):
+    'Return the nearest-rank percentile of an already sorted list'
+
+    index = max(0, min(len(sorted_values) - 1,
+                       int(fraction * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies, duration):
+    'Return ops/s and latency percentiles (in microseconds) of an operation'
+
+    latencies = sorted(latencies)
+    return {'ops': len(latencies),
+            'ops_per_sec': len(latencies) / duration,
+            'p50_us': percentile(latencies, 0.5) / 1000,
+            'p99_us': percentile(latencies, 0.99) / 1000,
+            'p999_us': percentile(latencies, 0.999) / 1000,
+            'max_us': latencies[-1] / 1000}
+
+
+def zipfian_indexes(total, count, rnd, exponent=0.99):
+    'Return `count` zipfian distributed indexes in `range(total)`'
+
+    cumulative, accumulator = [], 0.0
+    for rank in range(1, total + 1):
+        accumulator += 1.0 / rank ** exponent
+        cumulative.append(accumulator)
+    # the most popular ranks are spread over the keys (not only the first)
+    ranks = list(range(total))
+    rnd.shuffle(ranks)
+    return [ranks[min(bisect.bisect(cumulative, rnd.random() * accumulator),
+                      total - 1)]
+            for _ in range(count)]
 
-def run(total, timer, iterations=3):
-    tests_pythondict = {
-            #'Python dict': 'test_pythondict()',
-            #'Redis': 'test_redis()',
-    }
-    tests_dbm = {
-            'DBM write': 'test_dbm_write()',
-            'DBM readwrite': 'test_dbm_readwrite()',
-    }
-    tests_bitcask = {
-            'Bitcask write': 'test_bitcask_write()',
-            'Bitcask readwrite': 'test_bitcask_readwrite()',
-    }
-
-    result = {}
-    test_code = CODE.replace('##TOTAL##', str(total))
-
-    for test_name, function_call in tests_dbm.items():
-        duration = timeit.timeit(function_call, test_code, number=iterations,
-                timer=timer)
-        print('{} => {}'.format(test_name, duration))
-        result[test_name] = duration
-        for filename in glob.glob('/tmp/*.db'):
+
+def _timed(function, arguments):
+    'Call `function` for each item of `arguments` and return the latencies'
+
+    latencies = []
+    append = latencies.append
+    clock = time.perf_counter_ns
+    start = time.perf_counter()
+    for argument in arguments:
+        before = clock()
+        function(argument)
+        append(clock() - before)
+    return latencies, time.perf_counter() - start
+
+
+def _open_cask(path, queue):
+    process = psutil.Process()
+    before = process.memory_info().rss
+    start = time.perf_counter()
+    cask = bitcask.Bitcask(path)
+    duration = time.perf_counter() - start
+    rss = process.memory_info().rss - before
+    total = len(cask)
+    cask.close()
+    queue.put({'duration': duration,
+               'rss_per_key': rss / total if total else 0.0})
+
+
+def measure_open(path, hintfiles):
+    'Open the cask on `path` in a new process, returning duration and RSS'
+
+    if not hintfiles:
+        for filename in glob.glob(os.path.join(path, '*.bitcask.hint')):
             os.remove(filename)
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_open_cask, args=(path, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def run(value_size, keys, ops, seed=42):
+    rnd = random.Random(seed)
+    path = tempfile.mktemp()
+    result = {'keys': keys}
+    try:
+        cask = bitcask.Bitcask(path)
+
+        def write(counter):
+            cask[_key(counter)] = _value(counter, value_size)
 
-    result['DBM read'] = result['DBM readwrite'] - result['DBM write']
+        def read(counter):
+            cask[_key(counter)]
 
-    for test_name, function_call in tests_bitcask.items():
-        duration = timeit.timeit(function_call, test_code, number=iterations,
-                timer=timer)
-        print('{} => {}'.format(test_name, duration))
-        result[test_name] = duration
-        for filename in glob.glob('/tmp/tmp*'):
-            shutil.rmtree(filename)
-    result['Bitcask read'] = result['Bitcask readwrite'] - result['Bitcask write']
+        result['write'] = summarize(*_timed(write, range(keys)))
+        reads = {'read_sequential': [index % keys for index in range(ops)],
+                 'read_random': [rnd.randrange(keys) for _ in range(ops)],
+                 'read_zipfian': zipfian_indexes(keys, ops, rnd)}
+        for name, indexes in reads.items():
+            result[name] = summarize(*_timed(read, indexes))
 
+        for name, ratio in MIXED_RATIOS.items():
+            indexes = zipfian_indexes(keys, ops, rnd)
+            is_read = [rnd.random() < ratio for _ in range(ops)]
+            operations = [(read if reading else write, index)
+                          for reading, index in zip(is_read, indexes)]
+            result[name] = summarize(*_timed(
+                lambda operation: operation[0](operation[1]), operations))
+        cask.close()
+
+        # hint files are removed before opening without them, so use a copy
+        for hintfiles in (True, False):
+            copy_path = tempfile.mktemp()
+            shutil.copytree(path, copy_path)
+            try:
+                name = 'open_hints' if hintfiles else 'open_no_hints'
+                result[name] = measure_open(copy_path, hintfiles)
+            finally:
+                shutil.rmtree(copy_path)
+
+        cask = bitcask.Bitcask(path)
+        for counter in range(0, keys, 2):
+            cask[_key(counter)] = _value(counter + 1, value_size)
+        total_bytes = sum(stats.total_bytes for stats in cask.file_stats())
+        start = time.perf_counter()
+        cask.merge()
+        duration = time.perf_counter() - start
+        result['merge'] = {'duration': duration,
+                           'input_mb_per_sec':
+                               total_bytes / duration / 1024 ** 2}
+        cask.close()
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
     return result
 
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'],
+                cwd=os.path.dirname(os.path.abspath(bitcask.__file__)),
+                stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline, results):
+    'Print the change of ops/s (and open/merge durations) from `baseline`'
+
+    for size, workloads in sorted(results.items(), key=lambda item:
+                                  int(item[0])):
+        for name, data in workloads.items():
+            old = baseline.get(size, {}).get(name)
+            if not isinstance(data, dict) or not old:
+                continue
+            elif 'ops_per_sec' in data:
+                change = data['ops_per_sec'] / old['ops_per_sec'] - 1
+            else:  # the lower the duration, the better
+                change = old['duration'] / data['duration'] - 1
+            print('{:>8} {:<16} {:+7.1%}'.format(size, name, change))
+
+
 def main():
     import argparse
 
     parser = argparse.ArgumentParser()
     parser.add_argument('output_filename')
-    parser.add_argument('--timer', default='wallclock')
+    parser.add_argument('--keys', type=int, default=10000)
+    parser.add_argument('--ops', type=int, default=10000)
+    parser.add_argument('--value-sizes', default=','.join(map(str,
+                                                              VALUE_SIZES)))
+    parser.add_argument('--max-bytes', type=int, default=256 * 1024 ** 2,
+                        help='maximum bytes of values written per value size')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--baseline',
+                        help='JSON of a previous run to compare with')
     args = parser.parse_args()
-    if args.timer == 'wallclock':
-        timer = time.time
-    elif args.timer == 'cpu':
-        timer = time.process_time
-    else:
-        raise ValueError('Wrong timer (should be wallclock or cpu)')
-
-    bench = {}
-    kv_count = (10, 100, 1000, 10000, 100000, 1000000) #, 2000000, 4000000)
-    for runs in kv_count:
-        bench[runs] = run(runs, timer)
-        print(bench)
-        print('')
-
-    plot = {}
-    for x, data in bench.items():
-        for curva, y in data.items():
-            if curva not in plot:
-                plot[curva] = []
-            plot[curva].append((x, y))
-    for a, b in plot.items():
-        plot[a] = sorted(b)
-    print(plot)
-    N = len(list(plot.items())[0])
-    bitcask_read = [y for x, y in plot['Bitcask read']]
-    bitcask_write = [y for x, y in plot['Bitcask write']]
-    dbm_read = [y for x, y in plot['DBM read']]
-    dbm_write = [y for x, y in plot['DBM write']]
-    labels = [str(x) for x, y in plot['Bitcask read']]
-    names = ('bitcask_read', 'bitcask_write', 'dbm_read', 'dbm_write')
-
-    data = {}
-    data['xlabels'] = kv_count
-    data['curve_data'] = [
-            ('dbm read', dbm_read),
-            ('bitcask read', bitcask_read),
-            ('dbm write', dbm_write),
-            ('bitcask write', bitcask_write),
-            ]
+
+    results = {}
+    for value_size in map(int, args.value_sizes.split(',')):
+        keys = max(1, min(args.keys, args.max_bytes // value_size))
+        results[str(value_size)] = result = run(value_size, keys, args.ops,
+                                                args.seed)
+        for name, data in result.items():
+            if isinstance(data, dict) and 'ops_per_sec' in data:
+                print('{:>8} {:<16} {:10.0f} ops/s  p50 {:8.1f}us  '
+                      'p99 {:8.1f}us  p999 {:8.1f}us'
+                      .format(value_size, name, data['ops_per_sec'],
+                              data['p50_us'], data['p99_us'],
+                              data['p999_us']))
+            elif isinstance(data, dict):
+                print('{:>8} {:<16} {:10.3f}s{}'.format(
+                        value_size, name, data['duration'],
+                        '  {:.1f} RSS bytes/key'.format(data['rss_per_key'])
+                        if 'rss_per_key' in data else ''))
+
+    output = {'commit': _git_commit(),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'arguments': vars(args),
+              'results': results}
     with open(args.output_filename, 'w') as fobj:
-        json.dump(data, fobj, indent=2)
+        json.dump(output, fobj, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as fobj:
+            compare(json.load(fobj)['results'], results)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,92 @@
+# coding: utf-8
+
+'''Compare hints/second of `bitcask._read_hintfile` and the old hint parser
+
+The old parser (`read_hintfile_old`) is the entry-by-entry loop used before
+entries were decoded in place, kept here as a reference.
+'''
+
+import binascii
+import io
+import json
+import os
+import tempfile
+import time
+
+import bitcask
+from bitcask import (HINTFILE_END, STRUCT_HINT, STRUCT_INT16, STRUCT_POS)
+
+
+def read_hintfile_old(filename):
+    with open(filename, 'rb') as fobj:
+        filedata = fobj.read()
+    hintdata, crcdata = filedata[:-18], filedata[-18:]
+    _, _, crc, _ = STRUCT_HINT.unpack(crcdata)
+    if crc != binascii.crc32(hintdata):
+        return None
+
+    entries = []
+    hintbytes = io.BytesIO(hintdata)
+    data = hintbytes.read(18)
+    while data:
+        timestamp, ksize, entry_size, vinfo = STRUCT_HINT.unpack(data)
+        tombstone = (vinfo >> 63) == 1
+        new_data = STRUCT_INT16.unpack(data[10:12])[0] & 0b0111111111111111
+        pos_packed = STRUCT_INT16.pack(new_data) + data[12:18]
+        entry_position = STRUCT_POS.unpack(pos_packed)[0]
+        key = hintbytes.read(ksize)
+        entries.append((key, entry_position, entry_size, timestamp, tombstone))
+        data = hintbytes.read(18)
+    return entries
+
+
+def create_hintfile(filename, total):
+    hintio = io.BytesIO()
+    for counter in range(total):
+        key = bytes('{:010d}'.format(counter), 'ascii')
+        hintio.write(STRUCT_HINT.pack(1466611260, len(key), 124, counter * 124))
+        hintio.write(key)
+    hintdata = hintio.getvalue()
+    with open(filename, 'wb') as fobj:
+        fobj.write(hintdata)
+        fobj.write(STRUCT_HINT.pack(0, 0, binascii.crc32(hintdata),
+                                    HINTFILE_END))
+
+
+def run(total, iterations=3):
+    filename = tempfile.mktemp()
+    create_hintfile(filename, total)
+    result = {}
+    try:
+        parsers = (('old', read_hintfile_old),
+                   ('new', lambda name: bitcask._read_hintfile(name)[0]))
+        for name, parser in parsers:
+            durations = []
+            for _ in range(iterations):
+                start = time.time()
+                entries = parser(filename)
+                durations.append(time.time() - start)
+            assert len(entries) == total
+            result[name] = total / min(durations)
+            print('{} => {:.0f} hints/s'.format(name, result[name]))
+        assert read_hintfile_old(filename) == \
+            bitcask._read_hintfile(filename)[0]
+    finally:
+        os.remove(filename)
+    return result
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('output_filename')
+    parser.add_argument('--hints', type=int, default=1000000)
+    args = parser.parse_args()
+
+    with open(args.output_filename, 'w') as fobj:
+        json.dump(run(args.hints), fobj, indent=2)
+
+
+if __name__ == '__main__':
+    main()
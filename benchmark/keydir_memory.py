@@ -0,0 +1,70 @@
+# coding: utf-8
+
+'''Compare memory used per key by a `dict` keydir and a `CompactKeydir`
+
+Each keydir is filled in a separate process, so RSS measurements don't
+interfere with each other. Both the RSS after filling the keydir and the peak
+RSS while filling it (`ru_maxrss`, which includes resizes) are reported.
+'''
+
+import json
+import multiprocessing
+import resource
+
+import psutil
+
+import bitcask
+
+
+KEYDIRS = {
+        'dict': dict,
+        'CompactKeydir': bitcask.CompactKeydir,
+}
+
+
+def _fill_keydir(name, total, queue):
+    process = psutil.Process()
+    fobj = object()  # keydirs only store a reference to the file object
+    before = process.memory_info().rss
+    keydir = KEYDIRS[name]()
+    for counter in range(total):
+        key = bytes('{:010d}'.format(counter), 'ascii')
+        keydir[key] = bitcask.Hint(fobj=fobj,
+                                   position=counter * 4138,
+                                   size=4138,
+                                   timestamp=1466611260 + counter // 1000)
+    after = process.memory_info().rss
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    queue.put((after - before, peak - before))
+
+
+def run(total):
+    result = {}
+    for name in KEYDIRS:
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_fill_keydir,
+                                          args=(name, total, queue))
+        process.start()
+        used, peak = queue.get()
+        process.join()
+        result[name] = {'total_bytes': used, 'bytes_per_key': used / total,
+                        'peak_bytes': peak, 'peak_bytes_per_key': peak / total}
+        print('{} ({} keys): {:.1f} bytes/key ({:.1f} at peak)'
+              .format(name, total, used / total, peak / total))
+    return result
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('output_filename')
+    parser.add_argument('--keys', type=int, default=10000000)
+    args = parser.parse_args()
+
+    with open(args.output_filename, 'w') as fobj:
+        json.dump(run(args.keys), fobj, indent=2)
+
+
+if __name__ == '__main__':
+    main()
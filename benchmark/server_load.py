@@ -0,0 +1,115 @@
+# coding: utf-8
+
+'''Load generator for `server.py` reporting requests/second and latencies
+
+Runs `--clients` concurrent connections sending `--requests` commands in
+total (half SET, half GET). Use `--pipeline` to send many commands at once
+on a persistent connection (asyncio server) or `--reconnect` to open a new
+connection for each command (needed by the `--legacy` server).
+'''
+
+import asyncio
+import json
+import random
+import time
+
+
+def _encode_command(*arguments):
+    result = [b'*' + bytes(str(len(arguments)), 'ascii') + b'\r\n']
+    for argument in arguments:
+        result.append(b'$' + bytes(str(len(argument)), 'ascii') + b'\r\n' +
+                      argument + b'\r\n')
+    return b''.join(result)
+
+
+async def _read_reply(reader):
+    line = await reader.readline()
+    if line[:1] == b'$':
+        length = int(line[1:])
+        if length >= 0:
+            await reader.readexactly(length + 2)
+    elif line[:1] == b'*':
+        for _ in range(int(line[1:])):
+            await _read_reply(reader)
+    elif line[:1] == b'-':
+        raise RuntimeError(line.decode('utf-8'))
+
+
+async def _client(host, port, requests, pipeline, reconnect, keys, value,
+                  latencies):
+    reader = writer = None
+    sent = 0
+    while sent < requests:
+        count = 1 if reconnect else min(pipeline, requests - sent)
+        commands = []
+        for _ in range(count):
+            key = random.choice(keys)
+            if random.random() < 0.5:
+                commands.append(_encode_command(b'SET', key, value))
+            else:
+                commands.append(_encode_command(b'GET', key))
+
+        start = time.perf_counter()
+        if writer is None:
+            reader, writer = await asyncio.open_connection(host, port)
+        writer.write(b''.join(commands))
+        await writer.drain()
+        for _ in range(count):
+            await _read_reply(reader)
+        if reconnect:
+            writer.close()
+            await writer.wait_closed()
+            writer = None
+        duration = time.perf_counter() - start
+        # every command in a pipeline waits for the whole pipeline
+        latencies.extend([duration] * count)
+        sent += count
+    if writer is not None:
+        writer.close()
+        await writer.wait_closed()
+
+
+async def run(host, port, clients, requests, pipeline, reconnect, keys=1000,
+              value_size=100):
+    keys = [bytes('key-{:06d}'.format(counter), 'ascii')
+            for counter in range(keys)]
+    value = b'x' * value_size
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*[_client(host, port, requests // clients, pipeline,
+                                   reconnect, keys, value, latencies)
+                           for _ in range(clients)])
+    duration = time.perf_counter() - start
+    latencies.sort()
+    return {
+            'requests': len(latencies),
+            'requests_per_second': len(latencies) / duration,
+            'p50_ms': latencies[len(latencies) // 2] * 1000,
+            'p99_ms': latencies[int(len(latencies) * 0.99)] * 1000,
+    }
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=9999)
+    parser.add_argument('--clients', type=int, default=10)
+    parser.add_argument('--requests', type=int, default=100000)
+    parser.add_argument('--pipeline', type=int, default=1)
+    parser.add_argument('--reconnect', action='store_true')
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args.host, args.port, args.clients,
+                             args.requests, args.pipeline, args.reconnect))
+    print('{requests} requests: {requests_per_second:.0f} req/s, '
+          'p50 {p50_ms:.3f} ms, p99 {p99_ms:.3f} ms'.format(**result))
+    if args.output:
+        with open(args.output, 'w') as fobj:
+            json.dump(result, fobj, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+# coding: utf-8
+
+'''Measure put throughput of a `ShardedBitcask` with 1 to 8 shards
+
+Keys are written with `put_many` in batches of `--batch` items, so each
+shard gets its part of every batch. By default each shard runs on its own
+process (use `--threads` to keep them on the benchmark's process).
+'''
+
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import bitcask
+
+
+SHARDS = (1, 2, 4, 8)
+
+
+def run(shards, keys, value_size, batch, processes):
+    path = tempfile.mktemp()
+    items = [(bytes('{:010d}'.format(counter), 'ascii'),
+              os.urandom(value_size)) for counter in range(keys)]
+    try:
+        db = bitcask.ShardedBitcask(path, shards=shards, processes=processes)
+        start = time.perf_counter()
+        for index in range(0, keys, batch):
+            db.put_many(items[index:index + batch])
+        db.sync()
+        duration = time.perf_counter() - start
+        db.close()
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+    return {'duration': duration, 'puts_per_sec': keys / duration,
+            'mb_per_sec': keys * value_size / duration / 1024 ** 2}
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('output_filename')
+    parser.add_argument('--keys', type=int, default=200000)
+    parser.add_argument('--value-size', type=int, default=256)
+    parser.add_argument('--batch', type=int, default=10000)
+    parser.add_argument('--shards', default=','.join(map(str, SHARDS)))
+    parser.add_argument('--threads', action='store_true',
+                        help='run shards on this process')
+    args = parser.parse_args()
+
+    results = {}
+    for shards in map(int, args.shards.split(',')):
+        results[shards] = result = run(shards, args.keys, args.value_size,
+                                       args.batch, not args.threads)
+        print('{:>2} shards {:10.0f} puts/s {:8.1f} MB/s'
+              .format(shards, result['puts_per_sec'], result['mb_per_sec']))
+    with open(args.output_filename, 'w') as fobj:
+        json.dump({'arguments': vars(args), 'results': results}, fobj,
+                  indent=2)
+
+
+if __name__ == '__main__':
+    main()
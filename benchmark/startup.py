@@ -0,0 +1,93 @@
+# coding: utf-8
+
+'''Measure the time to open a cask using 1, 4 and 16 load workers
+
+A cask with `--keys` keys split in many data files is created and then
+opened with hint files and without them (so they're rebuilt from data files)
+and also from a keydir snapshot.
+'''
+
+import glob
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import bitcask
+
+
+def _generate_key_value(counter):
+    key = bytes('{:010d}'.format(counter), 'ascii')
+    value = (key * 10)[:-4]
+    return key, value
+
+
+def create_cask(path, total, files):
+    value_size = len(_generate_key_value(0)[1])
+    max_file_size = total * (14 + 10 + value_size) // files + 1
+    cask = bitcask.Bitcask(path, max_file_size=max_file_size)
+    for counter in range(total):
+        key, value = _generate_key_value(counter)
+        cask[key] = value
+    cask.close()
+
+
+def open_cask(path, workers, hintfiles):
+    if not hintfiles:
+        for filename in glob.glob(os.path.join(path, '*.bitcask.hint')):
+            os.remove(filename)
+    start = time.time()
+    cask = bitcask.Bitcask(path, load_workers=workers)
+    duration = time.time() - start
+    cask.close()
+    return duration
+
+
+def run(total, files, workers_list=(1, 4, 16)):
+    result = {}
+    path = tempfile.mktemp()
+    create_cask(path, total, files)
+    try:
+        for hintfiles in (True, False):
+            for workers in workers_list:
+                # hint files are removed before opening without them (and
+                # rebuilt), so each open uses a copy
+                copy_path = tempfile.mktemp()
+                shutil.copytree(path, copy_path)
+                duration = open_cask(copy_path, workers, hintfiles)
+                shutil.rmtree(copy_path)
+                name = '{} workers, {}'.format(
+                        workers, 'hint files' if hintfiles else 'no hint files')
+                print('{} => {:.3f}s'.format(name, duration))
+                result[name] = duration
+
+        # the snapshot is written when a cask opened with `snapshot_interval`
+        # is closed
+        copy_path = tempfile.mktemp()
+        shutil.copytree(path, copy_path)
+        bitcask.Bitcask(copy_path, snapshot_interval=3600).close()
+        duration = open_cask(copy_path, 1, True)
+        shutil.rmtree(copy_path)
+        print('snapshot => {:.3f}s'.format(duration))
+        result['snapshot'] = duration
+    finally:
+        shutil.rmtree(path)
+    return result
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('output_filename')
+    parser.add_argument('--keys', type=int, default=1000000)
+    parser.add_argument('--files', type=int, default=100)
+    args = parser.parse_args()
+
+    with open(args.output_filename, 'w') as fobj:
+        json.dump(run(args.keys, args.files), fobj, indent=2)
+
+
+if __name__ == '__main__':
+    main()
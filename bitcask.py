@@ -23,14 +23,32 @@ It provides the class `Bitcask`, which has the `collections.abc.MutableMapping`
 interface.
 '''
 
+import array
 import binascii
+import bz2
+import contextlib
+import gc
 import glob
+import heapq
 import io
+import itertools
+import logging
+import lzma
+import math
+import mmap
+import multiprocessing
 import os
+import socket
+import socketserver
 import struct
+import sys
+import threading
 import time
+import weakref
+import zlib
 
-from collections import namedtuple
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from collections.abc import MutableMapping
 
 import psutil
@@ -41,17 +59,67 @@ import psutil
 BITCASK_WRITE_LOCK = 'bitcask.write.lock'
 BITCASK_DATA = '{}.bitcask.data'
 BITCASK_HINT = '{}.bitcask.hint'
+BITCASK_MERGE = '{}.merge'  # suffix of files being written by `merge`
+BITCASK_SHARDS = 'bitcask.shards'  # number of shards of a `ShardedBitcask`
+BITCASK_SNAPSHOT = 'bitcask.keydir'  # see `Bitcask.snapshot`
+BITCASK_FOLLOW = 'bitcask.follow'  # position of a `Follower`
 STRUCT_HINT = struct.Struct('>IHIQ')
 STRUCT_DATA = struct.Struct('>IIHI')
 STRUCT_INT16 = struct.Struct('>H')
 STRUCT_INT32 = struct.Struct('>I')
 STRUCT_POS = struct.Struct('>Q')
 HINTFILE_END = STRUCT_POS.unpack(b'\x7f\xff\xff\xff\xff\xff\xff\xff')[0]
+HINT_POSITION_MASK = 2 ** 63 - 1  # hint position without the tombstone bit
+HINT_CHECKPOINT_SIZE = 2 ** 20  # active hint bytes between checkpoints
+READ_CHUNK_SIZE = 2 ** 20  # bytes read at once when scanning data files
+COALESCE_GAP = 2 ** 12  # max bytes between entries read at once by get_many
 DATA_NULL = b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
 TOMBSTONE_PREFIX = b'bitcask_tombstone'
-MAX_KEYSIZE = 2 ** 16
-MAX_VALUESIZE = 2 ** 63
+TOMBSTONE2_PREFIX = b'bitcask_tombstone2'  # + file id of the deleted entry
+CODEC_PREFIX = b'bitcask_codec'  # + codec id + encoded value
+CODEC_RAW = 0  # codec id of raw values which start with `CODEC_PREFIX`
+COMPRESS_THRESHOLD = 256  # values smaller than this are stored raw
+# timestamps of entries with a TTL are their expiry time plus this flag (so
+# they're told apart from the write time of other entries, until 2038)
+TIMESTAMP_EXPIRES = 2 ** 31
+SYNC_NONE = 'none'
+SYNC_ALWAYS = 'always'
+SYNC_INTERVAL = 'interval'
+MAX_KEYSIZE = 2 ** 16 - 1  # `key_size` is 16-bit
+MAX_VALUESIZE = 2 ** 32 - 1  # `value_size` is 32-bit
+MAX_ENTRYSIZE = 2 ** 32 - 1  # hint files' `entry_size` is 32-bit
+STREAM_CHUNK_SIZE = 2 ** 16  # bytes copied at once by `put_stream`
+SNAPSHOT_MAGIC = b'PYBCKD02'
+# magic, active file id, active file offset, number of files
+STRUCT_SNAPSHOT = struct.Struct('>8sIQI')
+# file id, live keys, live bytes, dead keys, dead bytes, file size
+STRUCT_SNAPSHOT_FILE = struct.Struct('>Iqqqqq')
+SNAPSHOT_BLOCK = 2 ** 16  # keydir entries per snapshot block
+# change feed frames: kind, file id, offset, size (of the entry which follows)
+STRUCT_FEED = struct.Struct('>BIQI')
+STRUCT_POSITION = struct.Struct('>IQ')  # file id, offset
+FEED_ENTRY = 0  # a data file entry (as it's on the file)
+FEED_SYNCED = 1  # all entries were sent (up to the file id and offset)
+FEED_RESET = 2  # all entries will be sent again, from the first file
+FEED_BUFFER_SIZE = 2 ** 16  # bytes of frames sent at once
 Hint = namedtuple('Hint', ['fobj', 'position', 'size', 'timestamp'])
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+Change = namedtuple('Change', ['fileid', 'offset', 'size', 'timestamp', 'key',
+                               'value', 'tombstone'])
+Codec = namedtuple('Codec', ['id', 'compress', 'decompress'])
+CODECS = {'zlib': Codec(1, zlib.compress, zlib.decompress),
+          'bz2': Codec(2, bz2.compress, bz2.decompress),
+          'lzma': Codec(3, lzma.compress, lzma.decompress)}
+FileStats = namedtuple('FileStats', ['fileid', 'live_keys', 'live_bytes',
+                                     'dead_keys', 'dead_bytes',
+                                     'total_bytes'])
+NO_FILE = 2 ** 32 - 1  # `CompactKeydir` file index of deleted entries
+SLOT_EMPTY = -1
+SLOT_DELETED = -2
+COUNTERS = ('gets', 'get_misses', 'puts', 'deletes', 'bytes_written',
+            'flushes', 'fsyncs', 'hint_rebuilds', 'rotations', 'merges')
+
+logger = logging.getLogger(__name__)
 
 
 def _pid_exists(pid):
@@ -60,6 +128,859 @@ def _pid_exists(pid):
     return pid in psutil.pids()
 
 
+def _fileid(filename):
+    'Return the file id of a data/hint filename (`N.bitcask.data` -> `N`)'
+
+    return int(os.path.basename(filename).split('.')[0])
+
+
+def _find_next_entry(data, start):
+    'Return the offset of the first valid entry of `data` after `start`'
+
+    unpack_from = STRUCT_DATA.unpack_from
+    crc32 = binascii.crc32
+    for offset in range(start + 1, len(data) - 13):
+        crc, _, key_size, value_size = unpack_from(data, offset)
+        end = offset + 14 + key_size + value_size
+        if end <= len(data) and crc == crc32(data[offset + 4:end]):
+            return offset
+    return None
+
+
+def _read_entries(fobj, offset=0, tolerant=False, skipped=None):
+    '''Yield `(position, crc, timestamp, key, value)` for each data file entry
+
+    Entries are read starting on `offset`, in chunks of `READ_CHUNK_SIZE`
+    bytes (entries are parsed from the chunks in place). Raises
+    `RuntimeError` if any entry is incomplete or has a wrong CRC, unless:
+
+    - `tolerant` is `True`: then it stops on the first of them (as the end of
+      a file still being written);
+    - `skipped` is a list: then the bad bytes are skipped until the next
+      valid entry (or the end of the file) and `(start, end)` of each skipped
+      range is appended to `skipped`.
+    '''
+
+    unpack_from = STRUCT_DATA.unpack_from
+    crc32 = binascii.crc32
+    fobj.seek(offset)
+    buffer = fobj.read(READ_CHUNK_SIZE)
+    eof = len(buffer) < READ_CHUNK_SIZE
+    base, index = offset, 0  # `base` is the file position of `buffer[0]`
+    while True:
+        # parse all the complete entries of the buffer
+        data = memoryview(buffer)
+        size = len(buffer)
+        error = None
+        while index + 14 <= size:
+            # crc, timestamp, keysize, valuesize: 4 + 4 + 2 + 4
+            crc, timestamp, key_size, value_size = unpack_from(buffer, index)
+            key_start = index + 14
+            value_start = key_start + key_size
+            end = value_start + value_size
+            if end > size:
+                break
+            # the CRC covers the header (but the CRC itself), key and value,
+            # which are contiguous on the buffer
+            elif crc != crc32(data[index + 4:end]):
+                error = 'CRC error'
+                break
+            yield (base + index, crc, timestamp,
+                   buffer[key_start:value_start], buffer[value_start:end])
+            index = end
+        data.release()
+
+        if error is None and not eof:
+            # read the rest of the last entry (and the next chunk)
+            needed = READ_CHUNK_SIZE
+            if index + 14 <= size:
+                needed = max(needed, end - index)
+            chunk = fobj.read(needed)
+            buffer = buffer[index:] + chunk
+            eof = len(chunk) < needed
+            base, index = base + index, 0
+            continue
+        elif index == size:
+            return
+        elif error is None:
+            error = 'Incomplete entry'
+
+        if tolerant:
+            return
+        elif skipped is None:
+            raise RuntimeError(error)
+        # the whole rest of the file is needed to find the next entry
+        buffer = buffer[index:] + fobj.read()
+        base, index, eof = base + index, 0, True
+        index = _find_next_entry(buffer, 0)
+        if index is None:
+            skipped.append((base, base + len(buffer)))
+            return
+        skipped.append((base, base + index))
+
+
+def _read_hintfile(filename):
+    '''Return `(entries, complete)` with the valid entries of a hint file
+
+    Entries are `(key, position, size, timestamp, tombstone)` tuples. Hint
+    files have checkpoints (records with key size 0 and position
+    `HINTFILE_END`) holding the CRC of all the bytes before them: the active
+    hint file gets a new one periodically and the last one is written when
+    the file is sealed. Only the entries before the last valid checkpoint are
+    returned; `complete` is `True` if it's at the end of the file (otherwise
+    the data file must be read after the last entry returned).
+    '''
+
+    with open(filename, 'rb') as fobj:
+        filedata = fobj.read()
+
+    # Entries are decoded in place (no intermediary buffers): timestamp,
+    # keysize, valuesize, valuepos: 4 bytes unsigned int + 2 bytes unsinged
+    # int + 4 bytes unsigned int + 8 bytes unsigned long long (the first bit
+    # is the tombstone flag)
+    data = memoryview(filedata)
+    entries = []
+    append = entries.append
+    unpack_from = STRUCT_HINT.unpack_from
+    crc = valid = checked = offset = 0
+    end = len(filedata) - 18
+    while offset <= end:
+        timestamp, key_size, entry_size, vinfo = unpack_from(filedata, offset)
+        if vinfo == HINTFILE_END and key_size == 0:
+            crc = binascii.crc32(data[checked:offset], crc)
+            if crc != entry_size:
+                # This hintfile is corrupted (or was not completely written)
+                break
+            offset += 18
+            crc = binascii.crc32(data[offset - 18:offset], crc)
+            checked, valid = offset, len(entries)
+            continue
+        offset += 18
+        append((filedata[offset:offset + key_size],
+                vinfo & HINT_POSITION_MASK,
+                entry_size,
+                timestamp,
+                vinfo > HINT_POSITION_MASK))
+        offset += key_size
+    del entries[valid:]
+    return entries, 0 < checked == len(filedata)
+
+
+def _entries_end(entries):
+    'Return the data file position after the last of `entries`'
+
+    return max((position + size for _, position, size, _, _ in entries),
+               default=0)
+
+
+def _expired(timestamp, now=None):
+    'Return `True` if an entry with `timestamp` has a TTL which is over'
+
+    return timestamp >= TIMESTAMP_EXPIRES and \
+            timestamp - TIMESTAMP_EXPIRES <= (time.time() if now is None
+                                              else now)
+
+
+def _entry_timestamp(ttl=None):
+    'Return the timestamp of an entry written now (see `Bitcask.set`)'
+
+    now = time.time()
+    if ttl is None:
+        return int(now)
+    elif ttl <= 0:
+        raise ValueError('TTL must be greater than 0')
+    timestamp = math.ceil(now + ttl)
+    if timestamp >= TIMESTAMP_EXPIRES:
+        raise ValueError('Expiry time is greater than {}'
+                         .format(TIMESTAMP_EXPIRES - 1))
+    return timestamp | TIMESTAMP_EXPIRES
+
+
+def _read_exactly(fobj, size):
+    'Read `size` bytes of `fobj` (less only if it ends before)'
+
+    data = fobj.read(size)
+    while len(data) < size:
+        chunk = fobj.read(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def _create_hintfile_from_datafile(datafobj, hintfilename=None,
+                                   entries=None, skipped=None):
+    '''Create a new hint file based on a data file and return its entries
+
+    If `hintfilename` is `None`, the entries are only returned. If `entries`
+    is given (the valid part of an incomplete hint file), only the data file
+    entries after them are read. `skipped` is passed to `_read_entries`.
+    Expired entries (see `Bitcask.set`) are written as tombstones.
+
+    Some reasons to completely read a datafile:
+    - Create a hintfile
+    - Check all CRCs
+    - Load key-value pairs "manually" (instead of using the keydir concept)
+    '''
+
+    # TODO: what about whence?
+    # TODO: what about DATA_NULL?
+    # It is important to check CRC here (`_read_entries` does it) since
+    # we're creating the hintfile based on this datafile, so to the
+    # hintfile to be correct we need to check all datafile's CRCs.
+    entries = list(entries or [])
+    hintio = io.BytesIO()
+    for key, position, entry_size, timestamp, tombstone in entries:
+        hintio.write(STRUCT_HINT.pack(timestamp,
+                                      len(key),
+                                      entry_size,
+                                      position | (tombstone << 63)))
+        hintio.write(key)
+    for position, _, timestamp, key, value in _read_entries(
+            datafobj, _entries_end(entries), skipped=skipped):
+        entry_size = 14 + len(key) + len(value)
+        tombstone = value.startswith(TOMBSTONE_PREFIX) or _expired(timestamp)
+        entries.append((key, position, entry_size, timestamp, tombstone))
+        hintio.write(STRUCT_HINT.pack(timestamp,
+                                      len(key),
+                                      entry_size,
+                                      position | (tombstone << 63)))
+        hintio.write(key)
+
+    if hintfilename is None:
+        return entries
+    hintio.seek(0)
+    hintdata = hintio.read()
+    hintcrc = STRUCT_HINT.pack(0,  # timestamp
+                               0,  # key size
+                               binascii.crc32(hintdata),  # value size
+                               HINTFILE_END)  # (value) position
+    with open(hintfilename, 'wb') as hintfobj:
+        hintfobj.write(hintdata)
+        hintfobj.write(hintcrc)
+    return entries
+
+
+def _load_entries(datafilename):
+    '''Return `(entries, rebuilt)` of a data file, read from its hint file
+
+    If the hint file does not exist or is incomplete (the cask was not
+    closed) a new one is created, reading the data file only after the valid
+    part of the old one. Corrupted entries are skipped and an incomplete or
+    corrupted end of the data file (a write interrupted by a crash) is
+    truncated (`rebuilt` is `True` if the data file was read). This function
+    runs on worker processes when the cask is loaded in parallel.
+    '''
+
+    hintfilename = os.path.join(os.path.dirname(datafilename),
+                                BITCASK_HINT.format(_fileid(datafilename)))
+    entries, complete = [], False
+    if os.path.exists(hintfilename):
+        entries, complete = _read_hintfile(hintfilename)
+        if not complete:
+            logger.warning('%s: incomplete hint file, creating another',
+                           hintfilename)
+    if not complete:
+        skipped = []
+        with open(datafilename, 'rb') as fobj:
+            entries = _create_hintfile_from_datafile(fobj, hintfilename,
+                                                     entries, skipped)
+            size = os.fstat(fobj.fileno()).st_size
+        if skipped:
+            logger.warning('%s: skipped %d corrupted bytes (%d ranges)',
+                           datafilename,
+                           sum(end - start for start, end in skipped),
+                           len(skipped))
+            if skipped[-1][1] == size:
+                os.truncate(datafilename, skipped[-1][0])
+    return entries, not complete
+
+
+def _big_endian(values):
+    'Convert an `array.array` from/to big endian (in place)'
+
+    if sys.byteorder == 'little':
+        values.byteswap()
+    return values
+
+
+def _write_snapshot(filename, items, fileids, file_stats, file_sizes,
+                    active_fileid, active_offset):
+    '''Write a keydir snapshot (see `Bitcask.snapshot`) to `filename`
+
+    `items` is an iterable of the keydir's `(key, hint)`. The snapshot has a
+    header (`STRUCT_SNAPSHOT`), the stats and size of each file
+    (`STRUCT_SNAPSHOT_FILE`) and blocks of up to `SNAPSHOT_BLOCK` entries,
+    the last one empty. A block has its number of entries (32-bit) and
+    arrays (big endian) of their file ids, positions, sizes, timestamps and
+    key sizes, followed by the keys. It ends with the CRC of all the
+    preceding bytes. It's written to a temporary file which is renamed.
+    '''
+
+    tmp_filename = filename + '.tmp'
+    crc = 0
+    with open(tmp_filename, 'wb') as fobj:
+        def write(data):
+            nonlocal crc
+            crc = binascii.crc32(data, crc)
+            fobj.write(data)
+
+        write(STRUCT_SNAPSHOT.pack(SNAPSHOT_MAGIC, active_fileid,
+                                   active_offset, len(file_stats)))
+        for fileid, stats in sorted(file_stats.items()):
+            write(STRUCT_SNAPSHOT_FILE.pack(fileid, *stats,
+                                            file_sizes[fileid]))
+        items = iter(items)
+        while True:
+            block = [item for _, item in zip(range(SNAPSHOT_BLOCK), items)]
+            write(STRUCT_INT32.pack(len(block)))
+            if not block:
+                break
+            write(_big_endian(array.array(
+                'I', [fileids[hint.fobj] for _, hint in block])).tobytes())
+            write(_big_endian(array.array(
+                'Q', [hint.position for _, hint in block])).tobytes())
+            write(_big_endian(array.array(
+                'I', [hint.size for _, hint in block])).tobytes())
+            write(_big_endian(array.array(
+                'I', [hint.timestamp for _, hint in block])).tobytes())
+            write(_big_endian(array.array(
+                'H', [len(key) for key, _ in block])).tobytes())
+            write(b''.join(key for key, _ in block))
+        fobj.write(STRUCT_INT32.pack(crc))
+        fobj.flush()
+        os.fsync(fobj.fileno())
+    os.rename(tmp_filename, filename)
+
+
+def _read_snapshot_blocks(data, offset):
+    'Yield `(file ids, positions, sizes, timestamps, key sizes, keys)` blocks'
+
+    while True:
+        count = STRUCT_INT32.unpack_from(data, offset)[0]
+        offset += 4
+        if count == 0:
+            break
+        block = []
+        for typecode in 'IQIIH':
+            values = array.array(typecode)
+            size = values.itemsize * count
+            values.frombytes(data[offset:offset + size])
+            block.append(_big_endian(values))
+            offset += size
+        keys_size = sum(block[-1])
+        block.append(bytes(data[offset:offset + keys_size]))
+        offset += keys_size
+        yield block
+
+
+def _pread_entries(entries, fds, max_gap):
+    '''Yield `(key, value)` for each `(fileid, position, size, key)` entry
+
+    `entries` must be sorted and `fds` maps their file ids to file
+    descriptors. Entries of the same file at most `max_gap` bytes apart are
+    read with a single `os.pread` (of up to `READ_CHUNK_SIZE` bytes, unless
+    an entry is bigger than that).
+    '''
+
+    index, total = 0, len(entries)
+    while index < total:
+        fileid, start, size, _ = entries[index]
+        end, stop = index + 1, start + size
+        while end < total and entries[end][0] == fileid:
+            _, position, size, _ = entries[end]
+            if position - stop > max_gap or \
+                    position + size - start > READ_CHUNK_SIZE:
+                break
+            end, stop = end + 1, position + size
+        chunk = os.pread(fds[fileid], stop - start, start)
+        for _, position, size, key in entries[index:end]:
+            offset = position - start
+            yield key, chunk[offset + 14 + len(key):offset + size]
+        index = end
+
+
+def _parse_sync(sync):
+    '''Return the sync strategy and interval (in seconds) of a `sync` option
+
+    `sync` can be `'none'` (the OS decides when to write to disk),
+    `'always'` (fsync after every write) or `'interval=<ms>'` (fsync every
+    `<ms>` milliseconds, in a background thread). `True` and `False` mean
+    `'always'` and `'none'`.
+    '''
+
+    if sync is True:
+        sync = SYNC_ALWAYS
+    elif sync is False:
+        sync = SYNC_NONE
+
+    if sync in (SYNC_NONE, SYNC_ALWAYS):
+        return sync, None
+    elif isinstance(sync, str) and sync.startswith(SYNC_INTERVAL + '='):
+        try:
+            interval = int(sync.split('=', 1)[1])
+        except ValueError:
+            interval = 0
+        if interval > 0:
+            return SYNC_INTERVAL, interval / 1000
+    raise ValueError('Invalid sync strategy: {!r}'.format(sync))
+
+
+def _run_periodically(reference, stop, interval, method):
+    '''Call `method` of the referenced `Bitcask` every `interval` seconds
+
+    Only a weak reference is kept between runs, so the thread does not keep
+    the `Bitcask` object alive.
+    '''
+
+    while not stop.wait(interval):
+        bitcask = reference()
+        if bitcask is None:
+            break
+        getattr(bitcask, method)()
+        del bitcask
+
+
+class CompactKeydir(MutableMapping):
+    '''Keydir which stores its entries in packed arrays instead of a `dict`
+
+    Keys are appended to a single `bytearray` and the entry fields (file,
+    position, size and timestamp) are stored in parallel `array.array`s. An
+    open-addressing hash table (also an `array.array`) maps keys to entry
+    indexes. `Hint` objects are only created when an entry is read, so it
+    uses a fraction of the memory of a `dict` of `Hint`s (at the cost of
+    slower lookups).
+    '''
+
+    def __init__(self, capacity=8):
+        self._fobjs = []
+        self._fobj_indexes = {}
+        self._keys = bytearray()
+        self._key_offsets = array.array('Q')
+        self._key_sizes = array.array('H')
+        self._files = array.array('I')
+        self._positions = array.array('Q')
+        self._sizes = array.array('I')
+        self._timestamps = array.array('I')
+        self._slots = array.array('i', [SLOT_EMPTY]) * capacity
+        self._length = 0
+        self._used_slots = 0  # filled or deleted
+        self._frozen = None  # see `freeze`
+        self._frozen_end = self._frozen_next = 0
+
+    def _key(self, entry):
+        offset = self._key_offsets[entry]
+        return bytes(self._keys[offset:offset + self._key_sizes[entry]])
+
+    def _find(self, key):
+        'Return `(slot, entry)` for `key` (`entry` is `None` if not found)'
+
+        slots, key_sizes, key_offsets = \
+                self._slots, self._key_sizes, self._key_offsets
+        mask = len(slots) - 1
+        slot = hash(key) & mask
+        key_size = len(key)
+        free_slot = None
+        while True:
+            entry = slots[slot]
+            if entry == SLOT_EMPTY:
+                return slot if free_slot is None else free_slot, None
+            elif entry == SLOT_DELETED:
+                if free_slot is None:
+                    free_slot = slot
+            elif key_sizes[entry] == key_size:
+                offset = key_offsets[entry]
+                if self._keys[offset:offset + key_size] == key:
+                    return slot, entry
+            slot = (slot + 1) & mask
+
+    def _hint(self, entry):
+        return Hint(fobj=self._fobjs[self._files[entry]],
+                    position=self._positions[entry],
+                    size=self._sizes[entry],
+                    timestamp=self._timestamps[entry])
+
+    def _compact(self):
+        'Move the live entries (and their keys) over the deleted ones'
+
+        keys, key_offsets, key_sizes = \
+                self._keys, self._key_offsets, self._key_sizes
+        files, positions, sizes, timestamps = \
+                self._files, self._positions, self._sizes, self._timestamps
+        index = keys_end = 0
+        for entry in range(len(files)):
+            if files[entry] == NO_FILE:
+                continue
+            offset, key_size = key_offsets[entry], key_sizes[entry]
+            if index != entry:
+                keys[keys_end:keys_end + key_size] = \
+                        keys[offset:offset + key_size]
+                key_offsets[index] = keys_end
+                key_sizes[index] = key_size
+                files[index] = files[entry]
+                positions[index] = positions[entry]
+                sizes[index] = sizes[entry]
+                timestamps[index] = timestamps[entry]
+            index += 1
+            keys_end += key_size
+        for values in (key_offsets, key_sizes, files, positions, sizes,
+                       timestamps):
+            del values[index:]
+        del keys[keys_end:]
+
+    def _rebuild(self):
+        '''Drop deleted entries and resize the hash table to fit the entries
+
+        The arrays are compacted in place (unless the keydir is frozen) and
+        only the hash table is created again (from the stored keys), so no
+        other copy of the entries is made.
+        '''
+
+        if self._length < len(self._files) and self._frozen is None:
+            self._compact()
+        capacity = 8
+        while capacity < self._length * 3:
+            capacity *= 2
+        slots = array.array('i', [SLOT_EMPTY]) * capacity
+        mask = capacity - 1
+        files = self._files
+        for entry in range(len(files)):
+            if files[entry] == NO_FILE:
+                continue
+            slot = hash(self._key(entry)) & mask
+            while slots[slot] != SLOT_EMPTY:
+                slot = (slot + 1) & mask
+            slots[slot] = entry
+        self._slots = slots
+        self._used_slots = self._length
+
+    def __getitem__(self, key):
+        _, entry = self._find(key)
+        if entry is None:
+            raise KeyError(key)
+        return self._hint(entry)
+
+    def __setitem__(self, key, hint):
+        fobj_index = self._fobj_indexes.get(hint.fobj)
+        if fobj_index is None:
+            fobj_index = self._fobj_indexes[hint.fobj] = len(self._fobjs)
+            self._fobjs.append(hint.fobj)
+
+        slot, entry = self._find(key)
+        if entry is not None:
+            self._keep_frozen(entry)
+            self._files[entry] = fobj_index
+            self._positions[entry] = hint.position
+            self._sizes[entry] = hint.size
+            self._timestamps[entry] = hint.timestamp
+            return
+
+        if self._slots[slot] == SLOT_EMPTY:
+            self._used_slots += 1
+        self._slots[slot] = len(self._files)
+        self._key_offsets.append(len(self._keys))
+        self._key_sizes.append(len(key))
+        self._keys += key
+        self._files.append(fobj_index)
+        self._positions.append(hint.position)
+        self._sizes.append(hint.size)
+        self._timestamps.append(hint.timestamp)
+        self._length += 1
+        if self._used_slots * 3 >= len(self._slots) * 2:
+            self._rebuild()
+
+    def __delitem__(self, key):
+        slot, entry = self._find(key)
+        if entry is None:
+            raise KeyError(key)
+        self._keep_frozen(entry)
+        self._slots[slot] = SLOT_DELETED
+        self._files[entry] = NO_FILE
+        self._length -= 1
+        if self._frozen is None and len(self._files) > 8 and \
+                self._length * 2 < len(self._files):
+            self._rebuild()
+
+    def __contains__(self, key):
+        return self._find(key)[1] is not None
+
+    def __len__(self):
+        return self._length
+
+    def freeze(self):
+        '''Keep the entries as they are now, to be read by `frozen_block`
+
+        Until `unfreeze` is called, entries aren't moved (deleted ones are
+        kept on the arrays) and the old hint of each entry changed before
+        it's read is kept, so the keydir can be read in blocks (while it's
+        changed) without being copied at once.
+        '''
+
+        self._frozen = {}
+        self._frozen_end = len(self._files)
+        self._frozen_next = 0
+
+    def _keep_frozen(self, entry):
+        if self._frozen is not None and \
+                self._frozen_next <= entry < self._frozen_end and \
+                entry not in self._frozen:
+            self._frozen[entry] = None if self._files[entry] == NO_FILE \
+                                  else self._hint(entry)
+
+    def frozen_block(self, start, stop):
+        '''Return entries `start` to `stop` as they were on `freeze`
+
+        Only array slices are copied (to be decoded by `block_items`), so
+        it's fast. Blocks must be read in order.
+        '''
+
+        stop = min(stop, self._frozen_end)
+        self._frozen_next = stop
+        frozen = {entry: hint for entry, hint in self._frozen.items()
+                  if entry < stop}
+        for entry in frozen:
+            del self._frozen[entry]
+        if start >= stop:
+            return start, b'', array.array('Q'), array.array('H'), \
+                   array.array('I'), array.array('Q'), array.array('I'), \
+                   array.array('I'), frozen
+        keys_start = self._key_offsets[start]
+        keys_end = self._key_offsets[stop - 1] + self._key_sizes[stop - 1]
+        return (start, self._keys[keys_start:keys_end],
+                self._key_offsets[start:stop], self._key_sizes[start:stop],
+                self._files[start:stop], self._positions[start:stop],
+                self._sizes[start:stop], self._timestamps[start:stop], frozen)
+
+    def block_items(self, block):
+        'Return the `(key, hint)` items of a `frozen_block`'
+
+        start, keys, key_offsets, key_sizes, files, positions, sizes, \
+                timestamps, frozen = block
+        fobjs = self._fobjs  # only appended to
+        keys_start = key_offsets[0] if key_offsets else 0
+        items = []
+        for index in range(len(files)):
+            hint = frozen.get(start + index, False)
+            if hint is False:
+                if files[index] == NO_FILE:
+                    continue
+                hint = Hint(fobj=fobjs[files[index]],
+                            position=positions[index], size=sizes[index],
+                            timestamp=timestamps[index])
+            elif hint is None:
+                continue  # already deleted on `freeze`
+            offset = key_offsets[index] - keys_start
+            items.append((bytes(keys[offset:offset + key_sizes[index]]), hint))
+        return items
+
+    def unfreeze(self):
+        'Stop keeping the old entries (see `freeze`)'
+
+        self._frozen = None
+        if len(self._files) > 8 and self._length * 2 < len(self._files):
+            self._rebuild()
+
+    def copy(self):
+        'Return a copy of the keydir (copying its arrays)'
+
+        other = CompactKeydir.__new__(CompactKeydir)
+        for name, value in vars(self).items():
+            if isinstance(value, dict):
+                value = value.copy()
+            elif isinstance(value, (array.array, bytearray, list)):
+                value = value[:]
+            setattr(other, name, value)
+        return other
+
+    def __iter__(self):
+        files = self._files
+        return (self._key(entry) for entry in range(len(files))
+                if files[entry] != NO_FILE)
+
+
+class LRUCache:
+    '''Least recently used values cache, limited to `max_bytes` bytes
+
+    The size of an item is the size of its key plus the size of its value.
+    Values bigger than `max_bytes` are not cached. It's thread-safe.
+    '''
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self._lock = threading.Lock()
+        self._values = OrderedDict()
+
+    def get(self, key):
+        'Return the cached value for `key` (or `None`)'
+
+        with self._lock:
+            value = self._values.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._values.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        size = len(key) + len(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._discard(key)
+            self._values[key] = value
+            self.size += size
+            while self.size > self.max_bytes:
+                old_key, old_value = self._values.popitem(last=False)
+                self.size -= len(old_key) + len(old_value)
+
+    def discard(self, key):
+        with self._lock:
+            self._discard(key)
+
+    def _discard(self, key):
+        value = self._values.pop(key, None)
+        if value is not None:
+            self.size -= len(key) + len(value)
+
+    def __len__(self):
+        return len(self._values)
+
+
+class LatencyHistogram:
+    '''Histogram of latencies (in nanoseconds) with power of 2 buckets
+
+    Recording is O(1) and uses a fixed amount of memory; percentiles are
+    estimated as the upper bound of their bucket (at most 2x the real value).
+    '''
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.buckets = [0] * 64  # bucket N: latencies < 2 ** N
+
+    def record(self, nanoseconds):
+        self.count += 1
+        self.total += nanoseconds
+        self.buckets[min(nanoseconds.bit_length(), 63)] += 1
+
+    def percentile(self, fraction):
+        'Return the (estimated) latency percentile in nanoseconds'
+
+        rank = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return 2 ** bucket
+        return 0
+
+    def summary(self):
+        '''Return count, sum and percentiles 50, 99 and 99.9 (microseconds)'''
+
+        return {'count': self.count,
+                'sum_us': self.total / 1000,
+                'p50_us': self.percentile(0.5) / 1000,
+                'p99_us': self.percentile(0.99) / 1000,
+                'p999_us': self.percentile(0.999) / 1000}
+
+
+def format_prometheus(stats, prefix='bitcask'):
+    '''Return `Bitcask.stats()` in Prometheus' text exposition format
+
+    Latencies are exported as summaries (in microseconds).
+    '''
+
+    lines = []
+    for name, value in sorted(stats.items()):
+        if name != 'latency':
+            lines.append('{}_{} {}'.format(prefix, name, value))
+    for operation, summary in sorted(stats.get('latency', {}).items()):
+        metric = '{}_{}_latency_microseconds'.format(prefix, operation)
+        lines.append('# TYPE {} summary'.format(metric))
+        for quantile, name in (('0.5', 'p50_us'), ('0.99', 'p99_us'),
+                               ('0.999', 'p999_us')):
+            lines.append('{}{{quantile="{}"}} {}'.format(metric, quantile,
+                                                         summary[name]))
+        lines.append('{}_sum {}'.format(metric, summary['sum_us']))
+        lines.append('{}_count {}'.format(metric, summary['count']))
+    return '\n'.join(lines) + '\n'
+
+
+class ValueStream(io.RawIOBase):
+    '''Read-only, seekable stream over a value on a data file
+
+    Returned by `Bitcask.open_value`. Reads are `os.pread`s of a duplicated
+    file descriptor (closed with the stream), so the stream stays valid even
+    if the file is merged or the cask is closed.
+    '''
+
+    def __init__(self, fd, offset, size):
+        super().__init__()
+        self._fd = fd
+        self._offset = offset  # of the value on the data file
+        self._position = 0
+        self.size = size
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.size - self._position)
+        if size <= 0:
+            return 0
+        data = os.pread(self._fd, size, self._offset + self._position)
+        buffer[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError('Invalid whence: {}'.format(whence))
+        if position < 0:
+            raise ValueError('Negative seek position: {}'.format(position))
+        self._position = position
+        return position
+
+    def tell(self):
+        return self._position
+
+    def sendfile(self, sock):
+        '''Send the rest of the value to `sock` using `os.sendfile`
+
+        The data is copied by the kernel (it's never read by Python). Returns
+        the number of bytes sent.
+        '''
+
+        sent = 0
+        while self._position < self.size:
+            count = os.sendfile(sock.fileno(), self._fd,
+                                self._offset + self._position,
+                                self.size - self._position)
+            if count == 0:
+                break
+            self._position += count
+            sent += count
+        return sent
+
+    def close(self):
+        if not self.closed:
+            os.close(self._fd)
+        super().close()
+
+
 class Bitcask(MutableMapping):
     """Implements Bitcask based on Basho's source code (in Erlang)
 
@@ -71,17 +992,153 @@ class Bitcask(MutableMapping):
     - value_size: unsigned int, 32 bits (4 bytes), struct format: I
 
     Erlang uses big endian by default, so our struct format starts with '>'
+
+    `sync` defines when writes are forced to disk (see `_parse_sync`): data
+    is always flushed to the OS after each write but only fsync'ed after each
+    write (`'always'`), periodically (`'interval=<ms>'`) or when `sync` is
+    called (`'none'`, the default).
+
+    If `max_file_size` is set, the active file is sealed (and a new one is
+    opened) when the next entry would make it greater than `max_file_size`
+    bytes (an entry bigger than that gets its own file).
+
+    If `compact_keydir` is `True`, a `CompactKeydir` is used instead of a
+    `dict` (less memory per key, slower lookups).
+
+    If `mmap_reads` is `True`, sealed (immutable) data files are memory
+    mapped and values read from them are returned as `memoryview` slices of
+    the map (no system calls and no copies); values on the active file are
+    read with `os.pread` and returned as `bytes`.
+
+    If `cache_size` is greater than 0, the most recently read values are
+    kept in memory (up to `cache_size` bytes of keys and values, see
+    `LRUCache`).
+
+    If `codec` is set (a name of `CODECS` or a `Codec`), values with at
+    least `compress_threshold` bytes are compressed before being written,
+    unless that doesn't make them smaller. A compressed value is stored as
+    `CODEC_PREFIX`, the codec id (one byte) and the compressed bytes, so
+    each entry is decoded on its own (a cask can have entries written
+    with different codecs or none) and casks without compressed values are
+    still readable by Erlang's bitcask. Raw values which start with
+    `CODEC_PREFIX` are stored with the `CODEC_RAW` id. Codecs other than
+    the ones on `CODECS` must be added to it (or passed) to be read.
+
+    Entries written with a TTL (see `set`) are dropped from the keydir when
+    they expire: lazily, when read, and by a background thread which checks
+    every `expiry_interval` seconds (if not `None`) the expiry times of the
+    keys (kept on a heap). Expired entries are never loaded again (they
+    hide older entries of their keys, like tombstones) and are removed by
+    `merge`.
+
+    If `snapshot_interval` is set, a snapshot of the keydir is written
+    every `snapshot_interval` seconds and when the cask is closed (see
+    `snapshot`). A valid snapshot is always used when the cask is opened:
+    its entries are loaded at once and only entries written after it are
+    read from hint (or data) files.
+
+    If `load_workers` is greater than 1, hint files are read (or created,
+    if missing) by that many worker processes when the cask is opened.
+
+    If `merge_threshold` is set, a background thread checks every
+    `merge_interval` seconds the ratio of dead bytes (see `file_stats`) to
+    total data file bytes and calls `merge` when it reaches the threshold.
+
+    Counters (operations, bytes written, flushes etc.) are always kept and
+    returned by `stats`. If `metrics` is `True`, the latencies of gets, puts
+    (`put_many` calls) and deletes are also recorded (see
+    `LatencyHistogram`); otherwise, they cost nothing.
+
+    A `Bitcask` can be shared by many threads: reads don't block each other
+    (nor writes), since the keydir lookup is atomic (a `CompactKeydir` is
+    looked up holding the lock) and values are read with `os.pread` (there's
+    no shared file cursor). Writes (`put_many`, `__delitem__`, rotations and
+    `merge`'s keydir swap) are serialized by a lock and the keydir is updated
+    only after the data is written, so readers get either the old value or
+    the new one (if `merge` closes a file between the lookup and the read,
+    the lookup is retried). A value read is cached only if its key's entry
+    wasn't changed meanwhile (checked holding the lock). `put_stream` holds
+    that lock only to rotate and to update the keydir (other writes wait for
+    its copy on another lock), so slow sources don't block reads. Iterating
+    over the keys lists them at once, so writes can happen while iterating.
+    Counters and latencies may miss some concurrent reads.
+
+    If `read_only` is `True`, the cask is opened even if another process is
+    writing to it: the write lock is not checked, no file is created or
+    changed and `refresh` loads the entries written after the cask was
+    opened. Only one process can open a cask for writing, but many processes
+    can read it.
+
+    Every entry written can be read again, in order, with `changes` (from a
+    data file position on); a `ChangeFeedServer` sends them to `Follower`s,
+    which replicate the cask into other directories.
     """
 
-    def __init__(self, path, sync=True):
-        self.sync = True
+    def __init__(self, path, sync=SYNC_NONE, max_file_size=None,
+                 merge_threshold=None, merge_interval=60,
+                 compact_keydir=False, mmap_reads=False, load_workers=1,
+                 cache_size=0, read_only=False, metrics=False, codec=None,
+                 compress_threshold=COMPRESS_THRESHOLD, expiry_interval=1,
+                 snapshot_interval=None):
+        self.sync_strategy, self.sync_interval = _parse_sync(sync)
+        if isinstance(codec, str):
+            if codec not in CODECS:
+                raise ValueError('Unknown codec: {}'.format(codec))
+            codec = CODECS[codec]
+        elif codec is not None and codec.id == CODEC_RAW:
+            raise ValueError('Codec id {} is reserved'.format(CODEC_RAW))
+        self.codec = codec
+        self.compress_threshold = compress_threshold
+        self.expiry_interval = expiry_interval
+        self.snapshot_interval = snapshot_interval
+        self.max_file_size = max_file_size
+        self.merge_threshold = merge_threshold
+        self.merge_interval = merge_interval
+        self.mmap_reads = mmap_reads
+        self.load_workers = load_workers
+        self.read_only = read_only
         self._active_data = None
+        self._active_fileid = None
         self._active_hint = None
         self._bitcask_path = path
+        self._cache = LRUCache(cache_size) if cache_size > 0 else None
+        self._closed = False
+        self._counters = dict.fromkeys(COUNTERS, 0)
+        self._datafiles = {}
+        self._decoders = {codec.id: codec.decompress
+                          for codec in CODECS.values()}
+        if codec is not None:
+            self._decoders[codec.id] = codec.decompress
+        self._deleted = {}  # read-only: file id of the last tombstone of keys
+        self._expiry = []  # heap of (expiry time, key) of entries with TTL
+        self._expiring = 0  # keys on keydir with TTL
+        self._expiry_thread = False
+        self._file_stats = {}  # fobj: [live keys/bytes, dead keys/bytes]
         self._files = set()
-        self._keydir = {}
+        self._histograms = None
+        if metrics:
+            self._histograms = {operation: LatencyHistogram()
+                                for operation in ('get', 'put', 'delete')}
+        self._keydir = CompactKeydir() if compact_keydir else {}
+        self._lock = threading.RLock()
+        # serializes writes to the active files (taken before `_lock`), so
+        # `put_stream` copies values without blocking readers
+        self._write_lock = threading.RLock()
+        # a `dict` lookup is atomic, but a `CompactKeydir` one is not
+        self._keydir_lock = self._lock if compact_keydir else None
+        self._lockfile = None
+        self._merge_lock = threading.Lock()
+        self._mmaps = {}
+        self._stop = threading.Event()
+        self._tail = None  # read-only: [fileid, fobj, offset] of active file
+        self._unsynced = set()  # sealed data files maybe not fsync'ed yet
+        # file id of merged active files: (their size, next active file id)
+        self._merged_active = {}
 
-        if not os.path.exists(path):
+        if read_only:
+            if not os.path.exists(path):
+                raise FileNotFoundError('Bitcask not found: {}'.format(path))
+        elif not os.path.exists(path):
             os.mkdir(path)
         else:
             lockfile = os.path.join(path, BITCASK_WRITE_LOCK)
@@ -92,208 +1149,1069 @@ class Bitcask(MutableMapping):
                 if not _pid_exists(int(pid)):  # invalid lock file
                     os.remove(lockfile)
                 else:
-                    # TODO: change this behaviour to allow read-only mode
                     raise RuntimeError('Bitcask is locked by process {}'
                             .format(pid))
 
+        start = time.perf_counter()
         self._open_files()
+        self._open_seconds = time.perf_counter() - start
+
+        if merge_threshold is not None:
+            self._start_thread(merge_interval, '_maybe_merge')
+        if self.sync_interval is not None:
+            self._start_thread(self.sync_interval, 'sync')
+        if snapshot_interval is not None and not read_only:
+            self._start_thread(snapshot_interval, 'snapshot')
+
+    def _start_thread(self, interval, method):
+        thread = threading.Thread(target=_run_periodically,
+                                  args=(weakref.ref(self), self._stop,
+                                        interval, method),
+                                  daemon=True)
+        thread.start()
 
     def _path(self, filename):
         return os.path.join(self._bitcask_path, filename)
 
-    def _load_immutable_file(self, filename):
-        fobj = open(filename, 'rb')
-        hintfilename = filename.replace('.data', '.hint')
-        if os.path.exists(hintfilename):
-            self._read_hintfile(hintfilename, fobj)
-        else:
-            self._create_hintfile_from_datafile(fobj, hintfilename)
+    def _load_immutable_file(self, filename, loaded=None, start=0):
+        'Load entries of a data file (the ones at `start` or after it)'
+
+        fileid = _fileid(filename)
+        fobj = self._datafiles.get(fileid) or open(filename, 'rb')
+        self._datafiles[fileid] = fobj
+        entries, rebuilt = loaded or _load_entries(filename)
+        self._counters['hint_rebuilds'] += rebuilt
+        for key, position, size, timestamp, tombstone in entries:
+            if position < start:
+                continue  # loaded from the snapshot
+            self._update_keydir(key, Hint(fobj=fobj,
+                                          position=position,
+                                          size=size,
+                                          timestamp=timestamp), tombstone)
         return fobj
 
     def _write_hintfile_crc(self):
-        # TODO: test
-        self._active_hint.seek(0)
-        data = self._active_hint.read()
-        self._active_hint.write(STRUCT_HINT.pack(0, 0, binascii.crc32(data), HINTFILE_END))
+        '''Append a checkpoint with the CRC of the active hint file
 
-    def _read_hintfile(self, filename, datafobj):
-        fobj = open(filename, 'rb')
-        self._files.add(fobj)
+        The CRC is updated as hint entries are written, so the file is never
+        read back.
+        '''
 
-        # check CRC (last entry of the file)
-        filedata = fobj.read()
-        hintdata, crcdata = filedata[:-18], filedata[-18:]
-        _, _, crc, _ = STRUCT_HINT.unpack(crcdata)
-        checked_crc = binascii.crc32(hintdata)
-        if crc != checked_crc:
-            # This hintfile is corrupted (or was not completely written,
-            # because of CRC mismatch), so we're going to write a new one.
-
-            # TODO: logger.warning('corrupted hint file, creating another')
-            self._files.remove(fobj)
-            self._create_hintfile_from_datafile(datafobj, filename)
-            return
+        checkpoint = STRUCT_HINT.pack(0, 0, self._hint_crc, HINTFILE_END)
+        self._active_hint.write(checkpoint)
+        self._hint_crc = binascii.crc32(checkpoint, self._hint_crc)
+        self._hint_unchecked = 0
 
-        # TODO: should remove CRC/truncate file? (only for active hint files)
-        hintbytes = io.BytesIO(hintdata)
-        data = hintbytes.read(18)
-        while data:
-            # timestamp, keysize, valuesize, valuepos: 4 bytes unsigned int + 2
-            # bytes unsinged int + 4 bytes unsigned int + 8 bytes unsigned long
-            # long
-            timestamp, ksize, entry_size, vinfo = STRUCT_HINT.unpack(data)
-            tombstone = (vinfo >> 63) == 1
-            # remove first bit (tombstone) and pack again
-            new_data = STRUCT_INT16.unpack(data[10:12])[0] & 0b0111111111111111
-            pos_packed = STRUCT_INT16.pack(new_data) + data[12:18]
-            entry_position = STRUCT_POS.unpack(pos_packed)[0]
-
-            key = hintbytes.read(ksize)
-            if not tombstone:
-                self._keydir[key] = Hint(fobj=datafobj,
-                                         position=entry_position,
-                                         size=entry_size,
-                                         timestamp=timestamp)
-            data = hintbytes.read(18)
-
-    def _create_hintfile_from_datafile(self, datafobj, hintfilename):
-        '''Create a new hint file based on a data file
-
-        Some reasons to completely read a datafile:
-        - Create a hintfile
-        - Check all CRCs
-        - Load key-value pairs "manually" (instead of using the keydir concept)
-        '''
-
-        # TODO: what about whence?
-        # TODO: what about DATA_NULL?
-        hintio = io.BytesIO()
-        datafobj.seek(0)
-        data = datafobj.read(14)
-        while data:
-            # crc, timestamp, keysize, valuesize: 4 + 4 + 2 + 4
-            crc, timestamp, key_size, value_size = STRUCT_DATA.unpack(data)
-            position = datafobj.tell() - 14
-            key = datafobj.read(key_size)
-            value = datafobj.read(value_size)
-            entry_size = datafobj.tell() - position
-            checked_crc = binascii.crc32(data[4:] + key + value)
-            if crc != checked_crc:
-                # It is important to check CRC here since we're creating the
-                # hintfile based on this datafile, so to the hintfile to be
-                # correct we need to check all datafile's CRCs.
-
-                # TODO: do something else (maybe just go to the next entry)
-                raise RuntimeError('CRC error')
-
-            # if it's a tombstone, just ignore it
-            if not value.startswith(TOMBSTONE_PREFIX):
-                self._keydir[key] = Hint(fobj=datafobj,
-                                         position=position,
-                                         size=entry_size,
-                                         timestamp=timestamp)
-                hintio.write(STRUCT_HINT.pack(timestamp,
-                                              key_size,
-                                              entry_size,
-                                              position))
-                hintio.write(key)
-
-            data = datafobj.read(14)
-
-        hintio.seek(0)
-        hintdata = hintio.read()
-        hintcrc = STRUCT_HINT.pack(0,  # timestamp
-                                   0,  # key size
-                                   binascii.crc32(hintdata),  # value size
-                                   HINTFILE_END)  # (value) position
-        with open(hintfilename, 'wb') as hintfobj:
-            hintfobj.write(hintdata)
-            hintfobj.write(hintcrc)
+    def _seal_hintfile(self):
+        'Write the last checkpoint of the active hint file (if needed)'
+
+        if self._hint_unchecked or not self._active_hint.tell():
+            self._write_hintfile_crc()
+
+    def _update_keydir(self, key, hint, tombstone=False):
+        '''Point `key` to `hint` (or remove it, if `hint` is a tombstone)
+
+        The old entry (if any) and tombstones are accounted as dead on their
+        files' stats and the new entry as live. Expired entries are handled
+        as tombstones and the ones with a TTL are added to the expiry heap.
+        '''
+
+        old_hint = self._keydir.get(key)
+        if old_hint is not None and old_hint.timestamp >= TIMESTAMP_EXPIRES:
+            self._expiring -= 1
+        if not tombstone and hint.timestamp >= TIMESTAMP_EXPIRES:
+            if _expired(hint.timestamp):
+                tombstone = True
+            else:
+                self._expiring += 1
+                self._schedule_expiry(key, hint.timestamp)
+        if old_hint is not None:
+            stats = self._file_stats.setdefault(old_hint.fobj, [0, 0, 0, 0])
+            stats[0] -= 1
+            stats[1] -= old_hint.size
+            stats[2] += 1
+            stats[3] += old_hint.size
+        stats = self._file_stats.setdefault(hint.fobj, [0, 0, 0, 0])
+        if tombstone:
+            if old_hint is not None:
+                del self._keydir[key]
+            stats[2] += 1
+            stats[3] += hint.size
+        else:
+            self._keydir[key] = hint
+            stats[0] += 1
+            stats[1] += hint.size
+
+    def _schedule_expiry(self, key, timestamp):
+        '''Add an entry with TTL to the expiry heap (see `expire`)
+
+        Entries of keys changed since they were added stay on the heap until
+        it has more than twice as many entries as keys with TTL, when they're
+        removed (so its size depends on the keys, not on the writes).
+        '''
+
+        heapq.heappush(self._expiry, (timestamp - TIMESTAMP_EXPIRES, key))
+        if len(self._expiry) > 2 * self._expiring + 16:
+            self._compact_expiry()
+        if not self._expiry_thread and self.expiry_interval is not None:
+            self._expiry_thread = True
+            self._start_thread(self.expiry_interval, 'expire')
+
+    def _compact_expiry(self):
+        'Keep on the expiry heap only the current entry of each key with TTL'
+
+        keydir = self._keydir
+        expiry = {}
+        for expiry_time, key in self._expiry:
+            hint = keydir.get(key)
+            if hint is not None and \
+                    hint.timestamp == expiry_time | TIMESTAMP_EXPIRES:
+                expiry[key] = expiry_time
+        self._expiry = [(expiry_time, key)
+                        for key, expiry_time in expiry.items()]
+        heapq.heapify(self._expiry)
 
     def _open_files(self):
         'Open immutable and active files'
 
-        # open immutable files for reading
-        filenames = glob.glob(self._path(BITCASK_DATA.format('*')))
-        for filename in filenames:  # TODO: assert order
-            self._files.add(self._load_immutable_file(filename))
+        if self.read_only:
+            self.refresh()
+            return
+
+        # remove leftovers of an interrupted merge (or snapshot)
+        for filename in glob.glob(self._path(BITCASK_MERGE.format('*'))):
+            os.remove(filename)
+        if os.path.exists(self._path(BITCASK_SNAPSHOT + '.tmp')):
+            os.remove(self._path(BITCASK_SNAPSHOT + '.tmp'))
+
+        # open immutable files for reading (in order, so newer entries win)
+        all_filenames = filenames = sorted(
+                glob.glob(self._path(BITCASK_DATA.format('*'))), key=_fileid)
+        snapshot = self._load_snapshot(filenames)
+        if snapshot is not None:
+            # entries after the snapshot (its active file offset or newer)
+            fileid, offset = snapshot
+            filename = self._path(BITCASK_DATA.format(fileid))
+            if os.path.getsize(filename) > offset:
+                self._load_immutable_file(filename, start=offset)
+            filenames = [filename for filename in filenames
+                         if _fileid(filename) > fileid]
+        if self.load_workers > 1 and len(filenames) > 1:
+            # hint files are read (or created) by worker processes and their
+            # entries are applied here in file order, as they're available
+            with ProcessPoolExecutor(self.load_workers) as executor:
+                loaded = executor.map(_load_entries, filenames)
+                for filename, entries in zip(filenames, loaded):
+                    self._files.add(self._load_immutable_file(filename,
+                                                              entries))
+        else:
+            for filename in filenames:
+                self._files.add(self._load_immutable_file(filename))
+        # overwritten entries with TTL were added while loading
+        self._compact_expiry()
 
-        # create next active file
+        # create next active file: once closed, a file is immutable and will
+        # never be opened for writing again
         next_fileid = 1
-        if filenames:
-            next_fileid = max(int(os.path.basename(filename).split('.')[0])
-                              for filename in filenames)
-        active_data_filename = self._path(BITCASK_DATA.format(next_fileid))
-        active_hint_filename = self._path(BITCASK_HINT.format(next_fileid))
+        if all_filenames:
+            next_fileid = _fileid(all_filenames[-1]) + 1
+        if all_filenames and os.path.getsize(all_filenames[-1]) == 0:
+            # ...but the last active file has no entries (the cask was closed
+            # without writes), so it's used again (with a new hint file) and
+            # empty files don't pile up
+            next_fileid -= 1
+            fobj = self._datafiles.pop(next_fileid)
+            self._files.discard(fobj)
+            self._file_stats.pop(fobj, None)
+            fobj.close()
+            hintfilename = self._path(BITCASK_HINT.format(next_fileid))
+            if os.path.exists(hintfilename):
+                os.remove(hintfilename)
+        # files of other processes may not have been fsync'ed
+        self._unsynced = set(self._datafiles.values())
+        self._open_active_file(next_fileid)
+
+    def _load_snapshot(self, filenames):
+        '''Load the keydir snapshot, if it's valid for the data `filenames`
+
+        It's valid if its CRC is right, all the files it refers to exist (and
+        have all of its entries) and the other ones are newer than its active
+        file. Returns `None` if it was not loaded or its active file id and
+        offset (entries from there on must be loaded from the files).
+        '''
+
+        filename = self._path(BITCASK_SNAPSHOT)
+        try:
+            fobj = open(filename, 'rb')
+        except FileNotFoundError:
+            return None
+        with fobj:
+            if os.fstat(fobj.fileno()).st_size < STRUCT_SNAPSHOT.size + 4:
+                logger.warning('%s: invalid snapshot, ignoring it', filename)
+                return None
+            data = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+        with data:
+            return self._load_snapshot_data(filename, data, filenames)
+
+    def _load_snapshot_data(self, filename, data, filenames):
+        end = len(data) - 4
+        with memoryview(data) as view:
+            crc = binascii.crc32(view[:end])
+        if data[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC or \
+                crc != STRUCT_INT32.unpack_from(data, end)[0]:
+            logger.warning('%s: invalid snapshot, ignoring it', filename)
+            return None
+
+        _, active_fileid, active_offset, files = \
+                STRUCT_SNAPSHOT.unpack_from(data)
+        offset = STRUCT_SNAPSHOT.size
+        file_stats, file_sizes = {}, {}
+        for _ in range(files):
+            fileid, *stats, size = STRUCT_SNAPSHOT_FILE.unpack_from(data,
+                                                                    offset)
+            file_stats[fileid], file_sizes[fileid] = stats, size
+            offset += STRUCT_SNAPSHOT_FILE.size
+        fileids = {_fileid(filename) for filename in filenames}
+        if active_fileid not in file_stats or \
+                not fileids.issuperset(file_stats) or \
+                any(fileid < active_fileid and fileid not in file_stats
+                    for fileid in fileids):
+            return None  # merged (or changed) after the snapshot
+        # data not fsync'ed may be lost after a crash, so every file must be
+        # at least as big as it was (so all of its entries are there)
+        if any(os.path.getsize(self._path(BITCASK_DATA.format(fileid))) < size
+               for fileid, size in file_sizes.items()):
+            logger.warning('%s: data files are smaller than the snapshot '
+                           'refers to, ignoring it', filename)
+            return None
 
+        fobjs = {}
+        for fileid, stats in file_stats.items():
+            datafilename = self._path(BITCASK_DATA.format(fileid))
+            fobj = fobjs[fileid] = open(datafilename, 'rb')
+            self._datafiles[fileid] = fobj
+            self._files.add(fobj)
+            self._file_stats[fobj] = stats
+        # entries are created by `map`s and `zip`s (no Python loops) and,
+        # since they have no reference cycles, the garbage collector (which
+        # would traverse all of them many times) is disabled meanwhile
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for fileids, positions, sizes, timestamps, key_sizes, keys in \
+                    _read_snapshot_blocks(data, offset):
+                ends = list(itertools.accumulate(key_sizes))
+                keys = list(map(keys.__getitem__,
+                                map(slice, [0] + ends[:-1], ends)))
+                # `tuple.__new__` is faster than `Hint`'s (a Python function)
+                hints = map(tuple.__new__, itertools.repeat(Hint),
+                            zip(map(fobjs.__getitem__, fileids), positions,
+                                sizes, timestamps))
+                self._keydir.update(zip(keys, hints))
+                if max(timestamps) >= TIMESTAMP_EXPIRES:
+                    for key, timestamp in zip(keys, timestamps):
+                        if timestamp >= TIMESTAMP_EXPIRES:
+                            self._expiring += 1
+                            self._schedule_expiry(key, timestamp)
+        finally:
+            if gc_enabled:
+                gc.enable()
+        self.expire()
+        return active_fileid, active_offset
+
+    def _open_active_file(self, fileid):
         # TODO: may use mmap on these files
-        self._active_data = open(self._path(BITCASK_DATA.format(next_fileid)),
+        self._active_fileid = fileid
+        self._active_data = open(self._path(BITCASK_DATA.format(fileid)),
                                  'a+b')
-        self._active_hint = open(self._path(BITCASK_HINT.format(next_fileid)),
+        self._active_hint = open(self._path(BITCASK_HINT.format(fileid)),
                                  'a+b')
+        self._active_size = 0
+        self._hint_crc = 0
+        self._hint_unchecked = 0  # hint bytes written after last checkpoint
+        self._datafiles[fileid] = self._active_data
         self._files.add(self._active_data)
         self._files.add(self._active_hint)
+        self._write_lockfile()
 
-    def __delitem__(self, item):
-        # TODO: check max keysize?
-        raise NotImplementedError()
+    def _write_lockfile(self):
+        'Write (atomically) the lock file with our PID and the active file'
 
-    def __setitem__(self, key, value):
-        key_size = len(key)
-        value_size = len(value)
+        lockfile = self._path(BITCASK_WRITE_LOCK)
+        tmp_lockfile = BITCASK_MERGE.format(lockfile)
+        fd = os.open(tmp_lockfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                     0o600)
+        with open(fd, 'wt') as fobj:
+            fobj.write('{} {}'.format(os.getpid(),
+                                      BITCASK_DATA.format(self._active_fileid)))
+        os.replace(tmp_lockfile, lockfile)
+        self._lockfile = lockfile
+
+    def _check_writable(self):
+        if self.read_only:
+            raise RuntimeError('Bitcask is opened in read-only mode')
+
+    def _refresh_entry(self, fileid, key, hint, tombstone):
+        'Update keydir with an entry of file `fileid` (unless it is outdated)'
+
+        old_hint = self._keydir.get(key)
+        if (old_hint is not None and _fileid(old_hint.fobj.name) > fileid) \
+                or self._deleted.get(key, 0) > fileid:
+            # files written by merge may appear after newer ones
+            return
+        elif tombstone:
+            self._deleted[key] = fileid
+        else:
+            self._deleted.pop(key, None)
+        self._update_keydir(key, hint, tombstone)
+        if self._cache is not None:
+            self._cache.discard(key)
+
+    def _read_tail(self, fileid, fobj, offset):
+        '''Load entries of a data file still being written, from `offset`
+
+        Returns the position after the last complete entry.
+        '''
+
+        for position, _, timestamp, key, value in _read_entries(
+                fobj, offset, tolerant=True):
+            offset = position + 14 + len(key) + len(value)
+            self._refresh_entry(fileid, key,
+                                Hint(fobj=fobj,
+                                     position=position,
+                                     size=offset - position,
+                                     timestamp=timestamp),
+                                value.startswith(TOMBSTONE_PREFIX))
+        return offset
+
+    def refresh(self):
+        '''Load the entries written by the writer since the last refresh
+
+        Only for read-only casks. New data files are loaded from their hint
+        files (and data files, after the valid part of the hint file) and the
+        newest data file (the writer's active file) is read from the position
+        where the last refresh stopped.
+
+        Data files removed by the writer's `merge` are dropped (and closed):
+        its output files (which are written before the inputs are removed)
+        have all the live entries of the merged files, so keys still pointing
+        to removed files after the new ones are loaded were deleted (their
+        tombstones may have been merged before this cask could read them).
+        '''
+
+        if not self.read_only:
+            raise RuntimeError('Only read-only casks can be refreshed')
+
+        with self._lock:
+            filenames = sorted(glob.glob(self._path(BITCASK_DATA.format('*'))),
+                               key=_fileid)
+            newest_fileid = _fileid(filenames[-1]) if filenames else 0
+            if self._tail is not None:
+                fileid, fobj, offset = self._tail
+                offset = self._read_tail(fileid, fobj, offset)
+                # if there's a newer file, this one was sealed (and read
+                # completely, since data is written before rotation)
+                self._tail = [fileid, fobj, offset] \
+                             if newest_fileid == fileid else None
+
+            for filename in filenames:
+                fileid = _fileid(filename)
+                if fileid in self._datafiles:
+                    continue
+                try:
+                    fobj = open(filename, 'rb')
+                except FileNotFoundError:
+                    continue  # merged (and removed) by the writer meanwhile
+                self._datafiles[fileid] = fobj
+                self._files.add(fobj)
+
+                hintfilename = self._path(BITCASK_HINT.format(fileid))
+                try:
+                    entries, complete = _read_hintfile(hintfilename)
+                except FileNotFoundError:
+                    entries, complete = [], False
+                if not complete and fileid != newest_fileid:
+                    entries = _create_hintfile_from_datafile(
+                            fobj, entries=entries, skipped=[])
+                    self._counters['hint_rebuilds'] += 1
+                for key, position, size, timestamp, tombstone in entries:
+                    self._refresh_entry(fileid, key,
+                                        Hint(fobj=fobj,
+                                             position=position,
+                                             size=size,
+                                             timestamp=timestamp),
+                                        tombstone)
+                if fileid == newest_fileid:
+                    # the writer's active file: its hint file only covers
+                    # entries up to the last checkpoint
+                    offset = _entries_end(entries)
+                    self._tail = [fileid, fobj,
+                                  self._read_tail(fileid, fobj, offset)]
+
+            fileids = set(map(_fileid, filenames))
+            removed = {fobj: fileid
+                       for fileid, fobj in self._datafiles.items()
+                       if fileid not in fileids}
+            if removed:
+                self._drop_removed_files(removed)
+
+    def _drop_removed_files(self, removed):
+        '''Drop keydir entries of data files removed by the writer (`merge`)
+
+        The files are closed, so their disk space is freed. Merge outputs
+        always have greater file ids than the removed files, so tombstones
+        read from them don't need to be remembered anymore.
+        '''
+
+        for key, hint in [(key, hint) for key, hint in self._keydir.items()
+                          if hint.fobj in removed]:
+            del self._keydir[key]
+            if hint.timestamp >= TIMESTAMP_EXPIRES:
+                self._expiring -= 1
+            if self._cache is not None:
+                self._cache.discard(key)
+        fileids = set(removed.values())
+        for key in [key for key, fileid in self._deleted.items()
+                    if fileid in fileids]:
+            del self._deleted[key]
+        for fobj, fileid in removed.items():
+            del self._datafiles[fileid]
+            self._file_stats.pop(fobj, None)
+            self._mmaps.pop(fobj, None)
+            self._files.discard(fobj)
+            fobj.close()
+
+    def _rotate(self, reserve=0):
+        '''Seal the active file and open a new one
+
+        The old active data file object is kept open for reading. `reserve`
+        file ids are skipped, so `merge` can use them for its output.
+        '''
+
+        self._seal_hintfile()
+        self._sync_active_files()
+        if self.sync_strategy == SYNC_NONE:
+            self._unsynced.add(self._active_data)
+        self._active_hint.close()
+        self._files.remove(self._active_hint)
+        self._open_active_file(self._active_fileid + reserve + 1)
+        self._counters['rotations'] += 1
+
+    def _must_rotate(self, position, entry_size):
+        'Check if an entry written at `position` would exceed `max_file_size`'
+
+        return self.max_file_size is not None and position > 0 and \
+                position + entry_size > self.max_file_size
+
+    def _dead_ratio(self):
+        'Return the ratio of dead bytes to total bytes of all data files'
+
+        with self._lock:
+            total = sum(os.fstat(fobj.fileno()).st_size
+                        for fobj in self._datafiles.values())
+            dead = sum(stats[3] for stats in self._file_stats.values())
+        return dead / total if total else 0.0
+
+    def _maybe_merge(self):
+        if not self._closed and self._dead_ratio() >= self.merge_threshold:
+            self.merge()
+
+    def merge(self):
+        '''Rewrite data files keeping only the live entries
+
+        The active file is sealed and a new one is opened, so writes can
+        continue while all the (now immutable) files are merged into new data
+        files (plus their hint files), which get file ids greater than any
+        merged file and lower than the new active one. Then keydir entries
+        not changed in the meantime are pointed to the new files and the old
+        files are deleted. Reads and writes are blocked only during the
+        rotation and the keydir swap.
+        '''
+
+        self._check_writable()
+        with self._merge_lock:
+            with self._write_lock, self._lock:
+                if self._closed:
+                    return
+                self.expire()  # so expired entries aren't copied
+                first_fileid = self._active_fileid + 1
+                reserve = 1
+                if self.max_file_size is not None:
+                    total = sum(os.fstat(fobj.fileno()).st_size
+                                for fobj in self._datafiles.values())
+                    reserve += total // self.max_file_size
+                sealed = (self._active_fileid, self._active_size)
+                self._rotate(reserve=reserve)
+                # so change feeds at its end continue on the new active file
+                self._merged_active[sealed[0]] = (sealed[1],
+                                                  self._active_fileid)
+                inputs = sorted((fileid, fobj)
+                                for fileid, fobj in self._datafiles.items()
+                                if fileid < first_fileid)
+            last_fileid = first_fileid + reserve - 1
+
+            # copy live entries to the new files, reading the old ones using
+            # other file objects (the ones on keydir are used by readers).
+            # Tombstones are never live: all the files older than them are
+            # merged, so there's no deleted entry left to hide.
+            outputs = []  # [fileid, data fobj, hint data, moved entries]
+            for _, fobj in inputs:
+                with open(fobj.name, 'rb') as input_fobj:
+                    for entry in _read_entries(input_fobj, skipped=[]):
+                        position, crc, timestamp, key, value = entry
+                        old_hint = self._lookup(key)
+                        if old_hint is None or \
+                                old_hint.fobj is not fobj or \
+                                old_hint.position != position:
+                            continue  # dead entry
+
+                        if not outputs or \
+                                (outputs[-1][0] < last_fileid and
+                                 self._must_rotate(outputs[-1][1].tell(),
+                                                   old_hint.size)):
+                            fileid = outputs[-1][0] + 1 if outputs \
+                                     else first_fileid
+                            filename = self._path(BITCASK_DATA.format(fileid))
+                            outputs.append([fileid,
+                                            open(BITCASK_MERGE.format(filename),
+                                                 'wb'),
+                                            io.BytesIO(),
+                                            []])
+                        _, output, hintio, moved = outputs[-1]
+
+                        new_position = output.tell()
+                        output.write(STRUCT_DATA.pack(crc, timestamp,
+                                                      len(key), len(value)))
+                        output.write(key)
+                        output.write(value)
+                        hintio.write(STRUCT_HINT.pack(timestamp,
+                                                      len(key),
+                                                      old_hint.size,
+                                                      new_position))
+                        hintio.write(key)
+                        moved.append((key, old_hint, new_position))
+
+            merged = []
+            for fileid, output, hintio, moved in outputs:
+                output.flush()
+                os.fsync(output.fileno())
+                output.close()
+                datafilename = self._path(BITCASK_DATA.format(fileid))
+                hintfilename = self._path(BITCASK_HINT.format(fileid))
+                hintdata = hintio.getvalue()
+                with open(BITCASK_MERGE.format(hintfilename), 'wb') as hintfobj:
+                    hintfobj.write(hintdata)
+                    hintfobj.write(STRUCT_HINT.pack(0, 0,
+                                                    binascii.crc32(hintdata),
+                                                    HINTFILE_END))
+                    hintfobj.flush()
+                    os.fsync(hintfobj.fileno())
+                os.rename(BITCASK_MERGE.format(datafilename), datafilename)
+                os.rename(BITCASK_MERGE.format(hintfilename), hintfilename)
+                merged.append((fileid, open(datafilename, 'rb'), moved))
+
+            with self._lock:
+                for fileid, fobj, moved in merged:
+                    stats = [0, 0, 0, 0]
+                    for key, old_hint, new_position in moved:
+                        if self._keydir.get(key) == old_hint:
+                            self._keydir[key] = old_hint._replace(
+                                    fobj=fobj, position=new_position)
+                            stats[0] += 1
+                            stats[1] += old_hint.size
+                        else:  # changed (or deleted) while merging
+                            stats[2] += 1
+                            stats[3] += old_hint.size
+                    self._datafiles[fileid] = fobj
+                    self._files.add(fobj)
+                    self._file_stats[fobj] = stats
+                for fileid, fobj in inputs:
+                    del self._datafiles[fileid]
+                    self._file_stats.pop(fobj, None)
+                    self._unsynced.discard(fobj)
+                    # the map is dropped but not closed, so returned views
+                    # stay valid
+                    self._mmaps.pop(fobj, None)
+                    self._files.discard(fobj)
+                    fobj.close()
+
+            # remove in ascending order, so an interruption here never leaves
+            # an older entry without the newer one which supersedes it
+            for fileid, _ in inputs:
+                os.remove(self._path(BITCASK_DATA.format(fileid)))
+                hintfilename = self._path(BITCASK_HINT.format(fileid))
+                if os.path.exists(hintfilename):
+                    os.remove(hintfilename)
+            self._counters['merges'] += 1
+
+    def __delitem__(self, key):
+        '''Delete `key`, writing a tombstone to the active file
+
+        The tombstone value is Erlang's `bitcask_tombstone2` followed by the
+        file id of the deleted entry (4 bytes).
+        '''
+
+        self._check_writable()
+        start = time.perf_counter_ns() if self._histograms else None
+        timestamp = int(time.time())
+        with self._write_lock, self._lock:
+            old_hint = self._keydir.get(key)
+            if old_hint is None:
+                raise KeyError(key)
+            value = TOMBSTONE2_PREFIX + \
+                    STRUCT_INT32.pack(_fileid(old_hint.fobj.name))
+            entry = self._encode_entry(key, value, timestamp, tombstone=True)
+            self._write_entries([(key, entry, True)], timestamp)
+            self._counters['deletes'] += 1
+        if start is not None:
+            self._histograms['delete'].record(time.perf_counter_ns() - start)
+
+    def _check_sizes(self, key_size, value_size):
         if key_size > MAX_KEYSIZE:
             # TODO: Test
             raise ValueError('Key is greater than {}'.format(MAX_KEYSIZE))
         elif value_size > MAX_VALUESIZE:
-            # TODO: Test
             raise ValueError('Value is greater than {}'.format(MAX_VALUESIZE))
-        elif value.startswith(TOMBSTONE_PREFIX):
+        elif 14 + key_size + value_size > MAX_ENTRYSIZE:
+            raise ValueError('Entry is greater than {}'.format(MAX_ENTRYSIZE))
+
+    def _encode_entry(self, key, value, timestamp, tombstone=False):
+        'Return the data file entry for `key`/`value` (checking their sizes)'
+
+        key_size = len(key)
+        value_size = len(value)
+        self._check_sizes(key_size, value_size)
+        if value.startswith(TOMBSTONE_PREFIX) and not tombstone:
             # TODO: Test
             raise ValueError('Value cannot start with "{}"'.format(TOMBSTONE_PREFIX))
-        else:
-            # TODO: if key already exists on hintfile or datafile, write
-            # tombstone (if key in self._keydir: ...)
-
-            timestamp = int(time.time())
-            entry_size = 14 + key_size + value_size  # 14 bytes = data header
-            data_entry = STRUCT_DATA.pack(0, timestamp, key_size, value_size)
-            crc = binascii.crc32(data_entry[4:])
-            crc = binascii.crc32(key, crc)
-            crc = STRUCT_INT32.pack(binascii.crc32(value, crc))
-            entry_position = self._active_data.seek(0, 2)
-            self._active_data.write(crc)
-            self._active_data.write(data_entry[4:])
-            self._active_data.write(key)
-            self._active_data.write(value)
-            if self.sync:
-                self._active_data.flush()
-
-            hint_entry = STRUCT_HINT.pack(timestamp,
-                                          key_size,
-                                          entry_size,
-                                          entry_position)
-            self._active_hint.seek(0, 2)
-            # TODO: if we maintain the hint file cursor only at the end, we may
-            # not need this seek
-            self._active_hint.write(hint_entry)
-            # we don't need to flush hint file on every write, since it will be
-            # flushed sometime in the future by the OS and if it's corrupted
-            # somehow, we can just create another one based on data file.
-
-            self._keydir[key] = Hint(fobj=self._active_data,
-                                     position=entry_position,
-                                     size=entry_size,
-                                     timestamp=timestamp)
+        elif not tombstone:
+            value = self._encode_value(value)
+            value_size = len(value)
+            self._check_sizes(key_size, value_size)
+
+        data_entry = STRUCT_DATA.pack(0, timestamp, key_size, value_size)
+        crc = binascii.crc32(data_entry[4:])
+        crc = binascii.crc32(key, crc)
+        crc = STRUCT_INT32.pack(binascii.crc32(value, crc))
+        return b''.join((crc, data_entry[4:], key, value))
+
+    def _encode_value(self, value):
+        'Return `value` as stored: compressed or raw (see `codec`)'
+
+        codec = self.codec
+        if codec is not None and len(value) >= self.compress_threshold:
+            compressed = codec.compress(value)
+            if len(CODEC_PREFIX) + 1 + len(compressed) < len(value):
+                return b''.join((CODEC_PREFIX, bytes((codec.id, )),
+                                 compressed))
+        if value[:len(CODEC_PREFIX)] == CODEC_PREFIX:
+            return b''.join((CODEC_PREFIX, bytes((CODEC_RAW, )), value))
+        return value
+
+    def _decode_value(self, value):
+        'Return the original value of a stored (maybe compressed) one'
+
+        if value[:len(CODEC_PREFIX)] != CODEC_PREFIX:
+            return value
+        codec_id, data = value[len(CODEC_PREFIX)], \
+                value[len(CODEC_PREFIX) + 1:]
+        if codec_id == CODEC_RAW:
+            return data
+        elif codec_id not in self._decoders:
+            raise RuntimeError('Unknown codec id: {}'.format(codec_id))
+        return self._decoders[codec_id](data)
+
+    def _append(self, data, hints, new_hints):
+        '''Write data and hint entries to the active files and update keydir
+
+        The keydir is updated only after the data is written (and flushed).
+        '''
+
+        data = b''.join(data)
+        self._active_data.write(data)
+        self._flush_active(len(data))
+        self._append_hints(hints, new_hints)
+
+    def _flush_active(self, size):
+        'Flush `size` bytes written to the active file (fsync, if needed)'
+
+        self._active_data.flush()
+        self._active_size += size
+        counters = self._counters
+        counters['bytes_written'] += size
+        counters['flushes'] += 1
+        if self.sync_strategy == SYNC_ALWAYS:
+            os.fsync(self._active_data.fileno())
+            counters['fsyncs'] += 1
+
+    def _append_hints(self, hints, new_hints):
+        'Write hint entries of data already written and update keydir'
+
+        hintdata = b''.join(hints)
+        self._active_hint.write(hintdata)
+        self._hint_crc = binascii.crc32(hintdata, self._hint_crc)
+        self._hint_unchecked += len(hintdata)
+        if self._hint_unchecked >= HINT_CHECKPOINT_SIZE:
+            self._write_hintfile_crc()
+        # we don't need to flush hint file on every write, since it will be
+        # flushed sometime in the future by the OS and if it's corrupted
+        # somehow, the data file is read after its last valid checkpoint.
+
+        for key, hint, tombstone in new_hints:
+            self._update_keydir(key, hint, tombstone)
+            if self._cache is not None:
+                self._cache.discard(key)
+
+    def put_many(self, items, ttl=None):
+        '''Write many `(key, value)` pairs at once
+
+        All entries are encoded into one buffer and appended to the active
+        file with a single write (and flush); hint entries are also written at
+        once (one write per data file, if the active file is rotated in the
+        middle). No entry is written if any of them is invalid. If `ttl` is
+        set, all entries expire after `ttl` seconds (see `set`).
+        '''
+
+        # overwritten entries don't need tombstones: the newest entry of a
+        # key always wins when the files are loaded (in order)
+        self._check_writable()
+        start = time.perf_counter_ns() if self._histograms else None
+        timestamp = _entry_timestamp(ttl)
+        entries = [(key, self._encode_entry(key, value, timestamp), False)
+                   for key, value in items]
+        self._write_entries(entries, timestamp)
+        self._counters['puts'] += len(entries)
+        if start is not None:
+            self._histograms['put'].record(time.perf_counter_ns() - start)
+
+    def _write_entries(self, entries, timestamp):
+        'Append `(key, encoded entry, tombstone)` entries to the active file'
+
+        with self._write_lock, self._lock:
+            data, hints, new_hints = [], [], []
+            position = self._active_size
+            for key, entry, tombstone in entries:
+                entry_size = len(entry)
+                if self._must_rotate(position, entry_size):
+                    if data:
+                        self._append(data, hints, new_hints)
+                        data, hints, new_hints = [], [], []
+                    self._rotate()
+                    position = 0
+
+                data.append(entry)
+                hints.append(STRUCT_HINT.pack(timestamp, len(key), entry_size,
+                                              position | (tombstone << 63)))
+                hints.append(key)
+                new_hints.append((key, Hint(fobj=self._active_data,
+                                            position=position,
+                                            size=entry_size,
+                                            timestamp=timestamp), tombstone))
+                position += entry_size
+            if data:
+                self._append(data, hints, new_hints)
+
+    @contextlib.contextmanager
+    def write_batch(self):
+        '''Context manager to collect writes and do them at once on exit
+
+        It returns a `dict` to be filled with the new key-value pairs, which
+        are written using `put_many` (only if no exception is raised).
+        '''
+
+        batch = {}
+        yield batch
+        self.put_many(batch.items())
+
+    def __setitem__(self, key, value):
+        self.put_many([(key, value)])
+
+    def set(self, key, value, ttl=None):
+        '''Write `key`/`value`, which expires after `ttl` seconds (if set)
+
+        The expiry time (rounded up to the next second) is written as the
+        entry's timestamp, flagged by `TIMESTAMP_EXPIRES`.
+        '''
+
+        self.put_many([(key, value)], ttl=ttl)
+
+    def put_stream(self, key, fileobj, size=None, ttl=None):
+        '''Write `key` with a value read from the file object `fileobj`
+
+        The value (`size` bytes or, if `fileobj` is seekable and `size` is
+        `None`, the rest of it) is copied to the active file in chunks of
+        `STREAM_CHUNK_SIZE` bytes while its CRC is computed, so it's never
+        completely in memory; the CRC is written at last and the keydir is
+        updated only after that. Streamed values aren't compressed. Other
+        writes wait until the copy ends, but reads don't: the lock they take
+        is held only to rotate the active file and to update the keydir.
+        '''
+
+        self._check_writable()
+        if size is None:
+            if not fileobj.seekable():
+                raise ValueError('size is required for non-seekable files')
+            position = fileobj.tell()
+            size = fileobj.seek(0, io.SEEK_END) - position
+            fileobj.seek(position)
+        timestamp = _entry_timestamp(ttl)
+        # the first bytes tell if the value needs `CODEC_PREFIX`
+        head = _read_exactly(fileobj, min(size, len(TOMBSTONE_PREFIX)))
+        if head.startswith(TOMBSTONE_PREFIX):
+            raise ValueError('Value cannot start with "{}"'.format(TOMBSTONE_PREFIX))
+        prefix = b''
+        if head.startswith(CODEC_PREFIX):
+            prefix = CODEC_PREFIX + bytes((CODEC_RAW, ))
+        value_size = len(prefix) + size
+        self._check_sizes(len(key), value_size)
+        entry_size = 14 + len(key) + value_size
+
+        with self._write_lock:
+            with self._lock:
+                if self._must_rotate(self._active_size, entry_size):
+                    self._rotate()
+            position = self._active_size
+            data = self._active_data
+            header = STRUCT_DATA.pack(0, timestamp, len(key), value_size)
+            crc = 0
+            try:
+                remaining = size - len(head)
+                data.write(header[:4])  # CRC, written at last
+                chunk = b''.join((header[4:], key, prefix, head))
+                while True:
+                    crc = binascii.crc32(chunk, crc)
+                    data.write(chunk)
+                    if remaining <= 0:
+                        break
+                    chunk = fileobj.read(min(STREAM_CHUNK_SIZE, remaining))
+                    if not chunk:
+                        raise ValueError('File ended {} bytes before the '
+                                         'value size'.format(remaining))
+                    remaining -= len(chunk)
+                data.flush()
+                # the active file is opened for appending, so the CRC (the
+                # first field) is written using another file descriptor
+                fd = os.open(data.name, os.O_WRONLY)
+                try:
+                    os.pwrite(fd, STRUCT_INT32.pack(crc), position)
+                finally:
+                    os.close(fd)
+            except BaseException:
+                data.truncate(position)
+                data.seek(0, io.SEEK_END)
+                raise
+            hint = Hint(fobj=data, position=position, size=entry_size,
+                        timestamp=timestamp)
+            with self._lock:
+                self._flush_active(entry_size)
+                self._append_hints([STRUCT_HINT.pack(timestamp, len(key),
+                                                     entry_size, position),
+                                    key],
+                                   [(key, hint, False)])
+                self._counters['puts'] += 1
+
+    def snapshot(self):
+        '''Write a snapshot of the keydir (to the `bitcask.keydir` file)
+
+        The keydir is written as it was when the snapshot started, with the
+        stats of each file and the active file's id and size, so the cask can
+        be opened loading it at once and only the entries written after it
+        (see `snapshot_interval`). The active file and the sealed ones not
+        fsync'ed yet (with `sync='none'`, files are sealed without it) are
+        fsync'ed before, so the snapshot never refers to data not on disk.
+
+        A `CompactKeydir` is frozen (see `CompactKeydir.freeze`) and read in
+        blocks of `SNAPSHOT_BLOCK` entries, holding the lock only to copy
+        each one. A `dict` is copied at once, holding the lock (and the GIL)
+        for around 50ns per key, so big casks with `snapshot_interval` set
+        should use `compact_keydir=True` not to block writes for seconds.
+        '''
+
+        self._check_writable()
+        with self._merge_lock:
+            with self._write_lock, self._lock:
+                if self._closed:
+                    return
+                keydir = self._keydir
+                state = self._snapshot_state()
+                if isinstance(keydir, CompactKeydir):
+                    keydir.freeze()
+                    items = self._frozen_items()
+                else:
+                    items = keydir.copy().items()
+                # sealed files are closed only by `merge` and `close`, which
+                # wait for the snapshot
+                unsynced = list(self._unsynced)
+                fd = os.dup(self._active_data.fileno())
+            try:
+                for fobj in unsynced:
+                    os.fsync(fobj.fileno())
+                os.fsync(fd)
+                with self._lock:
+                    self._unsynced.difference_update(unsynced)
+                _write_snapshot(self._path(BITCASK_SNAPSHOT), items, *state)
+            finally:
+                os.close(fd)
+                if isinstance(keydir, CompactKeydir):
+                    with self._lock:
+                        keydir.unfreeze()
+
+    def _snapshot_state(self):
+        '''Return file ids, stats, sizes and the active position
+
+        Called with the writer lock held, so the sizes (which are not smaller
+        than the end of any entry on keydir) don't change meanwhile.
+        '''
+
+        fileids = {fobj: fileid for fileid, fobj in self._datafiles.items()}
+        file_stats = {fileid: list(self._file_stats.get(fobj, [0, 0, 0, 0]))
+                      for fobj, fileid in fileids.items()}
+        file_sizes = {fileid: os.fstat(fobj.fileno()).st_size
+                      for fobj, fileid in fileids.items()}
+        file_sizes[self._active_fileid] = self._active_size
+        return (fileids, file_stats, file_sizes, self._active_fileid,
+                self._active_size)
+
+    def _frozen_items(self):
+        'Yield `(key, hint)` of the frozen `CompactKeydir`, a block at a time'
+
+        keydir = self._keydir
+        for start in range(0, keydir._frozen_end, SNAPSHOT_BLOCK):
+            with self._lock:
+                block = keydir.frozen_block(start, start + SNAPSHOT_BLOCK)
+            yield from keydir.block_items(block)
+
+    def changes(self, fileid=0, offset=0, follow=False, interval=0.1):
+        '''Yield a `Change` for each entry written from a position on
+
+        The position is a data file id and offset (`0, 0` for the first
+        entry of the oldest file); to continue from a `Change`, use its
+        `fileid` and `offset + size`. Values are decoded and tombstones have
+        `tombstone=True`. If `follow` is `False`, it ends when the newest
+        entry is yielded; otherwise, new entries are checked every `interval`
+        seconds. Raises `PositionLost` if the position was merged (see
+        `ChangeFeed`).
+        '''
+
+        feed = ChangeFeed(self, fileid, offset)
+        while True:
+            for fileid, position, _, timestamp, key, value in feed.read():
+                tombstone = value.startswith(TOMBSTONE_PREFIX)
+                yield Change(fileid, position, 14 + len(key) + len(value),
+                             timestamp, key,
+                             value if tombstone else self._decode_value(value),
+                             tombstone)
+            if not follow or self._stop.wait(interval):
+                break
+
+    def _apply_entries(self, entries):
+        '''Append `(key, data file entry, tombstone, timestamp)` entries
+
+        The entries (read from another cask, see `Follower`) are written as
+        they are, in order.
+        '''
+
+        self._check_writable()
+        for timestamp, group in itertools.groupby(entries,
+                                                  key=lambda entry: entry[3]):
+            self._write_entries([entry[:3] for entry in group], timestamp)
+
+    def _drop_expired(self, key, hint):
+        'Remove `key` from keydir if it still points to (expired) `hint`'
+
+        with self._lock:
+            if self._keydir.get(key) != hint:
+                return False
+            del self._keydir[key]
+            self._expiring -= 1
+            stats = self._file_stats.setdefault(hint.fobj, [0, 0, 0, 0])
+            stats[0] -= 1
+            stats[1] -= hint.size
+            stats[2] += 1
+            stats[3] += hint.size
+            if self._cache is not None:
+                self._cache.discard(key)
+            return True
+
+    def expire(self):
+        '''Remove the expired entries from the keydir and return how many
+
+        Called periodically by a background thread (see `expiry_interval`).
+        '''
+
+        now = time.time()
+        expired = 0
+        with self._lock:
+            heap = self._expiry
+            while heap and heap[0][0] <= now:
+                expiry, key = heapq.heappop(heap)
+                hint = self._keydir.get(key)
+                # the key may have been changed (or deleted) since then
+                if hint is not None and \
+                        hint.timestamp == expiry | TIMESTAMP_EXPIRES:
+                    expired += self._drop_expired(key, hint)
+        return expired
+
+    def _lookup(self, key):
+        'Return the keydir `Hint` of `key` or `None` (see `Bitcask`)'
+
+        if self._keydir_lock is None:
+            return self._keydir.get(key)  # atomic for a `dict`
+        with self._keydir_lock:
+            return self._keydir.get(key)
+
+    def _cache_value(self, key, hint, value):
+        'Cache `value` of `key` if `hint` was not changed since it was read'
+
+        # otherwise, a value read before a write could be cached after it
+        with self._lock:
+            if self._keydir.get(key) == hint:
+                self._cache.put(key, value)
 
     def __contains__(self, key):
-        return key in self._keydir
+        hint = self._lookup(key)
+        if hint is not None and hint.timestamp >= TIMESTAMP_EXPIRES and \
+                _expired(hint.timestamp):
+            self._drop_expired(key, hint)
+            return False
+        return hint is not None
 
-    def __getitem__(self, key):
-        hint = self._keydir[key]
-        hint.fobj.seek(hint.position)
-        data = hint.fobj.read(hint.size)
-        _, _, key_size, _ = STRUCT_DATA.unpack(data[:14])
-        return data[14 + key_size:]
+    def _mmap(self, fobj):
+        'Return a `memoryview` of a read-only memory map of data file `fobj`'
+
+        view = self._mmaps.get(fobj)
+        if view is None:
+            mapped = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+            view = self._mmaps[fobj] = memoryview(mapped)
+        return view
+
+    def _read_value(self, key, hint):
+        '''Read the value of `key` (no file cursor is used, see `Bitcask`)
+
+        Returns `None` if the file of `hint` was closed (by `merge`) before
+        the read finished.
+        '''
+
+        value_position = hint.position + 14 + len(key)
+        value_size = hint.size - 14 - len(key)
+        fobj = hint.fobj
+        try:
+            if self.mmap_reads:
+                tail = self._tail
+                if fobj is not self._active_data and \
+                        (tail is None or fobj is not tail[1]):
+                    # file is not growing anymore
+                    return self._mmap(fobj)[value_position:
+                                            value_position + value_size]
+            value = os.pread(fobj.fileno(), value_size, value_position)
+        except (OSError, ValueError):
+            if not fobj.closed:
+                raise
+            return None
+        # a file object is marked as closed before its descriptor is closed
+        # (and maybe reused by another file), so the read is valid if it's
+        # still open now
+        return None if fobj.closed else value
 
         # TODO: should check CRC on every read or create another operation to
         # fully scan the datafiles for corruption? or both?
@@ -305,21 +2223,757 @@ class Bitcask(MutableMapping):
         #else:
         #    return data[14 + key_size:]
 
+    def __getitem__(self, key):
+        start = time.perf_counter_ns() if self._histograms else None
+        self._counters['gets'] += 1
+        value = None
+        if self._cache is not None:
+            value = self._cache.get(key)
+        while value is None:
+            hint = self._lookup(key)
+            if hint is not None and hint.timestamp >= TIMESTAMP_EXPIRES and \
+                    _expired(hint.timestamp):
+                self._drop_expired(key, hint)
+                hint = None
+            if hint is None:
+                self._counters['get_misses'] += 1
+                raise KeyError(key)
+            value = self._read_value(key, hint)
+            if value is None and self._closed:
+                raise ValueError('Bitcask is closed')
+            elif value is None:
+                continue  # merged meanwhile: keydir points to the new file
+            value = self._decode_value(value)
+            # values with TTL aren't cached, so cache hits never expire
+            if self._cache is not None and \
+                    hint.timestamp < TIMESTAMP_EXPIRES:
+                self._cache_value(key, hint, value)
+        if start is not None:
+            self._histograms['get'].record(time.perf_counter_ns() - start)
+        return value
+
+    def open_value(self, key):
+        '''Return a `ValueStream` to read the value of `key` (not in memory)
+
+        Compressed values (see `codec`) are decompressed in memory and
+        returned as `io.BytesIO`.
+        '''
+
+        with self._lock:
+            hint = self._keydir.get(key)
+            if hint is not None and _expired(hint.timestamp):
+                self._drop_expired(key, hint)
+                hint = None
+            if hint is None:
+                raise KeyError(key)
+            # duplicated, so the file can be merged (and closed) meanwhile
+            fd = os.dup(hint.fobj.fileno())
+        offset = hint.position + 14 + len(key)
+        size = hint.size - 14 - len(key)
+        head = os.pread(fd, len(CODEC_PREFIX) + 1, offset)
+        if head[:len(CODEC_PREFIX)] == CODEC_PREFIX:
+            if head[len(CODEC_PREFIX)] != CODEC_RAW:
+                try:
+                    value = os.pread(fd, size, offset)
+                finally:
+                    os.close(fd)
+                return io.BytesIO(self._decode_value(value))
+            offset += len(head)
+            size -= len(head)
+        return ValueStream(fd, offset, size)
+
+    def get_many(self, keys):
+        '''Return a `dict` with the values of `keys` (missing keys omitted)
+
+        Values not cached are sorted by file and position and the ones close
+        to each other (up to `COALESCE_GAP` bytes apart) are read with a
+        single `os.pread`.
+        '''
+
+        now = time.time()
+        with self._lock:
+            result, entries, hints = {}, [], {}
+            cache, keydir = self._cache, self._keydir
+            fileids = {fobj: fileid
+                       for fileid, fobj in self._datafiles.items()}
+            keys = dict.fromkeys(keys)  # without duplicates, in order
+            for key in keys:
+                value = cache.get(key) if cache is not None else None
+                if value is not None:
+                    result[key] = value
+                    continue
+                hint = keydir.get(key)
+                if hint is not None and hint.timestamp >= TIMESTAMP_EXPIRES:
+                    if _expired(hint.timestamp, now):
+                        self._drop_expired(key, hint)
+                        continue
+                elif hint is not None:
+                    hints[key] = hint  # values with TTL aren't cached
+                if hint is not None:
+                    entries.append((fileids[hint.fobj], hint.position,
+                                    hint.size, key))
+            # duplicated, so files can be merged (and closed) meanwhile
+            fds = {fileid: os.dup(self._datafiles[fileid].fileno())
+                   for fileid in {entry[0] for entry in entries}}
+        entries.sort()
+        try:
+            for key, value in _pread_entries(entries, fds, COALESCE_GAP):
+                result[key] = self._decode_value(value)
+        finally:
+            for fd in fds.values():
+                os.close(fd)
+        if cache is not None:
+            with self._lock:  # see `_cache_value`
+                for key, hint in hints.items():
+                    if key in result and keydir.get(key) == hint:
+                        cache.put(key, result[key])
+        self._counters['gets'] += len(keys)
+        self._counters['get_misses'] += len(keys) - len(result)
+        return result
+
+    def cache_info(self):
+        '''Return `CacheInfo(hits, misses, maxsize, currsize)` of value cache
+
+        Sizes are in bytes. Returns `None` if the cache is disabled.
+        '''
+
+        cache = self._cache
+        if cache is None:
+            return None
+        return CacheInfo(cache.hits, cache.misses, cache.max_bytes, cache.size)
+
+    def stats(self):
+        '''Return a `dict` snapshot of the counters and state of the cask
+
+        Counters (`COUNTERS`) are always kept; `latency` (summaries of the
+        `LatencyHistogram` of each operation) is only included if the cask
+        was opened with `metrics=True`. See `format_prometheus`.
+        '''
+
+        with self._lock:
+            stats = dict(self._counters)
+            stats['keys'] = len(self._keydir)
+            stats['data_files'] = len(self._datafiles)
+            file_stats = list(self._file_stats.values())
+            stats['live_bytes'] = sum(counts[1] for counts in file_stats)
+            stats['dead_bytes'] = sum(counts[3] for counts in file_stats)
+            stats['open_seconds'] = self._open_seconds
+            if self._cache is not None:
+                stats['cache_hits'] = self._cache.hits
+                stats['cache_misses'] = self._cache.misses
+                stats['cache_bytes'] = self._cache.size
+            if self._histograms is not None:
+                stats['latency'] = {operation: histogram.summary()
+                                    for operation, histogram
+                                    in self._histograms.items()}
+        return stats
+
+    def file_stats(self):
+        '''Return a `FileStats` for each data file, ordered by file id
+
+        Live keys/bytes are the entries the keydir points to; dead ones are
+        overwritten and deleted entries plus tombstones (what `merge` would
+        remove). `total_bytes` is the current file size.
+        '''
+
+        with self._lock:
+            return [FileStats(fileid,
+                              *self._file_stats.get(fobj, [0, 0, 0, 0]),
+                              total_bytes=os.fstat(fobj.fileno()).st_size)
+                    for fileid, fobj in sorted(self._datafiles.items())]
+
     def __len__(self):
         return len(self._keydir)
 
     def __iter__(self):
-        # TODO: test
-        return (key for key in self._keydir)
+        # keys are listed at once, so writes can happen while iterating
+        if self._keydir_lock is None:
+            return iter(list(self._keydir))  # atomic for a `dict`
+        with self._keydir_lock:
+            return iter(list(self._keydir))
+
+    def iter_items(self):
+        '''Yield `(key, value)` of all live entries, in disk order
+
+        Live entries are sorted by file and position and each file is read
+        sequentially, in reads of up to `READ_CHUNK_SIZE` bytes (plus one
+        entry) instead of one seek per value. Entries are the ones live when
+        the iteration starts, even if they're changed (or merged) meanwhile.
+        '''
+
+        now = time.time()
+        with self._lock:
+            # entries are listed and sorted from a copy (which is fast), so
+            # writes aren't blocked meanwhile
+            keydir = self._keydir.copy()
+            fileids = {fobj: fileid
+                       for fileid, fobj in self._datafiles.items()}
+            # duplicated, so files can be rotated, merged or closed meanwhile
+            fds = {fileid: os.dup(fobj.fileno())
+                   for fobj, fileid in fileids.items()}
+        entries = sorted((fileids[hint.fobj], hint.position, hint.size, key)
+                         for key, hint in keydir.items()
+                         if not _expired(hint.timestamp, now))
+        del keydir
+        try:
+            for key, value in _pread_entries(entries, fds, READ_CHUNK_SIZE):
+                yield key, self._decode_value(value)
+        finally:
+            for fd in fds.values():
+                os.close(fd)
+
+    def fold(self, function, accumulator):
+        '''Call `function(key, value, accumulator)` for all live entries
+
+        Each call returns the accumulator of the next one and the last one is
+        returned (like Erlang's `bitcask:fold/3`). Entries are read in disk
+        order (see `iter_items`).
+        '''
+
+        for key, value in self.iter_items():
+            accumulator = function(key, value, accumulator)
+        return accumulator
+
+    def _sync_active_files(self):
+        'Flush the active files and fsync them (unless sync strategy is none)'
+
+        for fobj in (self._active_data, self._active_hint):
+            fobj.flush()
+            if self.sync_strategy != SYNC_NONE:
+                os.fsync(fobj.fileno())
+                self._counters['fsyncs'] += 1
+        self._counters['flushes'] += 1
+
+    def sync(self):
+        '''Force the active data and hint files to be written to disk
+
+        Writes are blocked only while the files are flushed to the OS, not
+        during the fsync.
+        '''
+
+        with self._write_lock, self._lock:
+            if self._closed or self.read_only:
+                return
+            if self._hint_unchecked:
+                self._write_hintfile_crc()
+            fds = []
+            for fobj in (self._active_data, self._active_hint):
+                fobj.flush()
+                # duplicated, so they're still valid if the file is rotated
+                fds.append(os.dup(fobj.fileno()))
+            self._counters['flushes'] += 1
+            self._counters['fsyncs'] += len(fds)
+        for fd in fds:
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
 
     def close(self):
-        # TODO: remove lock file
-        # TODO: should be the same as __del__
-        for fobj in self._files:
-            fobj.close()
+        'Stop threads, write the active hint file CRC and close all files'
+
+        if self._closed:
+            return
+        self._stop.set()
+        with self._merge_lock, self._write_lock, self._lock:
+            self._closed = True
+            if self._active_hint is not None:
+                self._seal_hintfile()
+                self._sync_active_files()
+                if self.snapshot_interval is not None:
+                    # see `snapshot`
+                    for fobj in self._unsynced | {self._active_data}:
+                        os.fsync(fobj.fileno())
+                    self._unsynced.clear()
+                    _write_snapshot(self._path(BITCASK_SNAPSHOT),
+                                    self._keydir.items(),
+                                    *self._snapshot_state())
+            for fobj in self._files:
+                fobj.close()
+            self._mmaps.clear()
+            if self._lockfile is not None and os.path.exists(self._lockfile):
+                os.remove(self._lockfile)
 
     def __del__(self):
         # TODO: test
-        # TODO: calculate active hintfile CRC incrementally
-        self._write_hintfile_crc()
-        self.close()
+        if hasattr(self, '_closed'):
+            self.close()
+
+
+def _shard_index(key, shards):
+    'Return the shard of `key` (stable across processes, unlike `hash`)'
+
+    return zlib.crc32(key) % shards
+
+
+def _serve_shard(connection, path, options):
+    'Run a `Bitcask` on a worker process, calling the methods sent to it'
+
+    db = Bitcask(path, **options)
+    try:
+        while True:
+            method, args = connection.recv()
+            try:
+                if method == 'keys':
+                    result = list(db)
+                else:
+                    result = getattr(db, method)(*args)
+                # `memoryview`s (of `mmap_reads`) can't be pickled
+                if isinstance(result, memoryview):
+                    result = bytes(result)
+                elif method == 'get_many':
+                    result = {key: bytes(value)
+                              for key, value in result.items()}
+            except Exception as exception:
+                connection.send((False, exception))
+            else:
+                connection.send((True, result))
+            if method == 'close':
+                break
+    finally:
+        db.close()
+        connection.close()
+
+
+class ShardProcess:
+    '''Proxy to a `Bitcask` running on its own process (see `ShardedBitcask`)
+
+    Calls are sent through a pipe and exceptions raised by the worker are
+    raised again. `send` and `receive` can be called separately, so many
+    shards work at the same time.
+    '''
+
+    def __init__(self, path, options):
+        self._connection, child = multiprocessing.Pipe()
+        self._lock = threading.Lock()
+        self._process = multiprocessing.Process(
+                target=_serve_shard, args=(child, path, options), daemon=True)
+        self._process.start()
+        child.close()
+        self.call('__len__')  # wait for the cask to be opened (or fail)
+
+    def send(self, method, *args):
+        self._lock.acquire()
+        try:
+            self._connection.send((method, args))
+        except BaseException:
+            self._lock.release()
+            raise
+
+    def receive(self):
+        try:
+            ok, result = self._connection.recv()
+        finally:
+            self._lock.release()
+        if not ok:
+            raise result
+        return result
+
+    def call(self, method, *args):
+        self.send(method, *args)
+        return self.receive()
+
+    def close(self):
+        if self._process.is_alive():
+            self.call('close')
+        self._process.join()
+        self._connection.close()
+
+
+class ShardedBitcask(MutableMapping):
+    '''Many `Bitcask`s (shards) exposed as a single mapping
+
+    Keys are partitioned by their CRC32 across `shards` sub-directories of
+    `path` (`shard-0`, `shard-1` etc.), each one an independent cask with
+    its own active file, lock and merges; the number of shards is saved
+    (in `bitcask.shards`) and can't be changed later. `options` are passed
+    to each `Bitcask`.
+
+    If `processes` is `True`, each shard runs on its own worker process
+    (see `ShardProcess`), so writes to different shards use different
+    cores; `put_many` and `get_many` send each shard its part of the
+    items before waiting for any of them.
+    '''
+
+    def __init__(self, path, shards=4, processes=False, **options):
+        if shards < 1:
+            raise ValueError('shards must be greater than 0')
+        if not os.path.exists(path):
+            if options.get('read_only'):
+                raise FileNotFoundError('Bitcask not found: {}'.format(path))
+            os.mkdir(path)
+        shards_filename = os.path.join(path, BITCASK_SHARDS)
+        if os.path.exists(shards_filename):
+            with open(shards_filename) as fobj:
+                saved = int(fobj.read())
+            if saved != shards:
+                raise ValueError('Bitcask has {} shards (not {})'
+                                 .format(saved, shards))
+        elif not options.get('read_only'):
+            with open(shards_filename, 'w') as fobj:
+                fobj.write(str(shards))
+
+        self.processes = processes
+        self._shards = []
+        try:
+            for index in range(shards):
+                shard_path = os.path.join(path, 'shard-{}'.format(index))
+                if processes:
+                    self._shards.append(ShardProcess(shard_path, options))
+                else:
+                    self._shards.append(Bitcask(shard_path, **options))
+        except BaseException:
+            self.close()
+            raise
+
+    def _call(self, shard, method, *args):
+        if self.processes:
+            return shard.call(method, *args)
+        return getattr(shard, method)(*args)
+
+    def _call_all(self, method, args=None):
+        'Call `method` on all shards (with `args[index]`, if set), at once'
+
+        if args is None:
+            args = [()] * len(self._shards)
+        if not self.processes:
+            return [getattr(shard, method)(*shard_args)
+                    for shard, shard_args in zip(self._shards, args)]
+        called = []
+        try:
+            for shard, shard_args in zip(self._shards, args):
+                shard.send(method, *shard_args)
+                called.append(shard)
+        finally:  # always wait for the answers, so the pipes stay in sync
+            results, error = [], None
+            for shard in called:
+                try:
+                    results.append(shard.receive())
+                except Exception as exception:
+                    error = error or exception
+        if error is not None:
+            raise error
+        return results
+
+    def _shard(self, key):
+        return self._shards[_shard_index(key, len(self._shards))]
+
+    def _partition(self, items, key=lambda item: item):
+        parts = [[] for _ in self._shards]
+        for item in items:
+            parts[_shard_index(key(item), len(parts))].append(item)
+        return parts
+
+    def __getitem__(self, key):
+        return self._call(self._shard(key), '__getitem__', key)
+
+    def __setitem__(self, key, value):
+        self._call(self._shard(key), 'put_many', [(key, value)])
+
+    def __delitem__(self, key):
+        self._call(self._shard(key), '__delitem__', key)
+
+    def __contains__(self, key):
+        return self._call(self._shard(key), '__contains__', key)
+
+    def __len__(self):
+        return sum(self._call_all('__len__'))
+
+    def __iter__(self):
+        for shard in self._shards:
+            if self.processes:
+                yield from shard.call('keys')
+            else:
+                yield from shard
+
+    def put_many(self, items, ttl=None):
+        '''Write many `(key, value)` pairs, one `put_many` per shard
+
+        Each shard's entries are written atomically (see
+        `Bitcask.put_many`), but not all shards' ones.
+        '''
+
+        parts = self._partition(items, key=lambda item: item[0])
+        self._call_all('put_many', [(part, ttl) for part in parts])
+
+    def set(self, key, value, ttl=None):
+        self._call(self._shard(key), 'put_many', [(key, value)], ttl)
+
+    def get_many(self, keys):
+        'Return a `dict` with the values of `keys` (missing keys omitted)'
+
+        parts = self._partition(keys)
+        result = {}
+        for values in self._call_all('get_many', [(part, ) for part in parts]):
+            result.update(values)
+        return result
+
+    def merge(self):
+        self._call_all('merge')
+
+    def sync(self):
+        self._call_all('sync')
+
+    def stats(self):
+        'Return the `Bitcask.stats` of each shard (a `list`)'
+
+        return self._call_all('stats')
+
+    def close(self):
+        'Close all shards (and stop their processes)'
+
+        for shard in self._shards:
+            shard.close()
+        self._shards = []
+
+
+class PositionLost(RuntimeError):
+    'The position of a change feed is not on the data files anymore'
+
+
+class ChangeFeed:
+    '''Read the entries of a cask's data files, from a position on
+
+    `position` is `(file id, offset)` of the next entry to be read (or
+    `(0, 0)`, for the first file). Sealed files are read up to their end
+    and the newest (active) one up to its last complete entry; `read` ends
+    there and can be called again later to continue.
+
+    If `merge` removes the file of the position, `read` continues on the
+    active file created by the merge if the position was at the end of the
+    merged active file (known only by the process which merged it) or
+    raises `PositionLost` otherwise: tombstones of the entries not read were
+    dropped, so the feed must be read again from `(0, 0)`.
+    '''
+
+    def __init__(self, db, fileid=0, offset=0):
+        self.db = db
+        self.position = (fileid, offset)
+
+    def read(self):
+        'Yield `(fileid, offset, crc, timestamp, key, value)` of the entries'
+
+        db = self.db
+        while True:
+            fileid, offset = self.position
+            with db._lock:
+                fileids = sorted(db._datafiles)
+                merged = db._merged_active.get(fileid)
+            if fileid not in fileids and merged is not None and \
+                    merged[0] == offset:
+                fileid, offset = merged[1], 0
+            elif fileid == 0 and offset == 0:
+                if not fileids:
+                    return
+                fileid = fileids[0]
+            if fileid not in fileids:
+                raise PositionLost('File {} was merged'.format(fileid))
+            self.position = (fileid, offset)
+
+            sealed = fileid != fileids[-1]
+            try:
+                fobj = open(db._path(BITCASK_DATA.format(fileid)), 'rb')
+            except FileNotFoundError:
+                raise PositionLost('File {} was merged'.format(fileid))
+            with fobj:
+                if offset > os.fstat(fobj.fileno()).st_size:
+                    raise PositionLost('File {} is smaller than {}'
+                                       .format(fileid, offset))
+                # the newest file may have an entry being written
+                entries = _read_entries(fobj, offset, tolerant=not sealed,
+                                        skipped=[] if sealed else None)
+                for position, crc, timestamp, key, value in entries:
+                    self.position = (fileid,
+                                     position + 14 + len(key) + len(value))
+                    yield fileid, position, crc, timestamp, key, value
+            if not sealed:
+                return
+            # sealed before the next file was created: it was read entirely
+            self.position = (fileids[fileids.index(fileid) + 1], 0)
+
+
+def _recv_exactly(fobj, size):
+    data = _read_exactly(fobj, size)
+    if len(data) < size:
+        raise EOFError('Connection closed')
+    return data
+
+
+class _ChangeFeedHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        try:
+            self._send_feed()
+        except (OSError, EOFError):
+            pass  # the follower disconnected
+
+    def _send_feed(self):
+        server = self.server
+        with self.request.makefile('rb') as rfile:
+            _, fileid, offset, _ = STRUCT_FEED.unpack(
+                    _recv_exactly(rfile, STRUCT_FEED.size))
+        feed = ChangeFeed(server.db, fileid, offset)
+        frames = []
+        if (fileid, offset) == (0, 0):
+            frames.append(STRUCT_FEED.pack(FEED_RESET, 0, 0, 0))
+        synced = None
+        while not server.stopped.is_set():
+            try:
+                buffered = 0
+                for fileid, position, crc, timestamp, key, value in \
+                        feed.read():
+                    size = 14 + len(key) + len(value)
+                    frames.append(STRUCT_FEED.pack(FEED_ENTRY, fileid,
+                                                   position, size))
+                    frames.append(STRUCT_DATA.pack(crc, timestamp, len(key),
+                                                   len(value)))
+                    frames.append(key)
+                    frames.append(value)
+                    buffered += STRUCT_FEED.size + size
+                    if buffered >= FEED_BUFFER_SIZE:
+                        self.request.sendall(b''.join(frames))
+                        frames, buffered = [], 0
+            except PositionLost:
+                logger.warning('change feed position lost, sending all '
+                               'entries again')
+                frames.append(STRUCT_FEED.pack(FEED_RESET, 0, 0, 0))
+                feed.position = (0, 0)
+                continue
+            if feed.position != synced:
+                synced = feed.position
+                frames.append(STRUCT_FEED.pack(FEED_SYNCED, *synced, 0))
+            if frames:
+                self.request.sendall(b''.join(frames))
+                frames = []
+            server.stopped.wait(server.interval)
+
+
+class ChangeFeedServer(socketserver.ThreadingMixIn,
+                       socketserver.UnixStreamServer):
+    '''Serve the change feed of `db` to `Follower`s on a Unix socket
+
+    Each connection starts with a `STRUCT_FEED` frame with the position of
+    the follower. Then the server sends the entries written from there on
+    (each one a `FEED_ENTRY` frame followed by the entry as it is on the
+    data file) and, whenever all of them were sent, a `FEED_SYNCED` frame
+    with the position; new entries are checked every `interval` seconds. A
+    `FEED_RESET` frame is sent when all the entries will be sent again (the
+    follower had no position or it was lost, see `ChangeFeed`). Use
+    `serve_forever` (on a thread, if needed), `shutdown` and `server_close`.
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, address, db, interval=0.1):
+        self.db = db
+        self.interval = interval
+        self.stopped = threading.Event()
+        super().__init__(address, _ChangeFeedHandler)
+
+    def server_close(self):
+        self.stopped.set()
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+class Follower:
+    '''Replicate the cask served by a `ChangeFeedServer` into another cask
+
+    A `Bitcask` is opened on `path` (`options` are passed to it) and a
+    thread applies the entries received from the Unix socket `address`
+    as they are (same values, timestamps and tombstones), reconnecting if
+    the connection is lost. The cask (`db`) can be read meanwhile but must
+    not be written to. The position of the last `FEED_SYNCED` frame is
+    saved (in `bitcask.follow`), so only newer entries are requested when
+    it's opened again. After a `FEED_RESET`, keys not sent again are
+    deleted when the follower is synced.
+    '''
+
+    def __init__(self, path, address, reconnect_interval=1, **options):
+        self.db = Bitcask(path, **options)
+        self.address = address
+        self.reconnect_interval = reconnect_interval
+        self.synced = threading.Event()
+        self._position_filename = os.path.join(path, BITCASK_FOLLOW)
+        self.position = (0, 0)
+        if os.path.exists(self._position_filename):
+            with open(self._position_filename, 'rb') as fobj:
+                self.position = STRUCT_POSITION.unpack(fobj.read())
+        self._live = None  # keys sent since the last `FEED_RESET`
+        self._socket = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self._socket = socket.socket(socket.AF_UNIX,
+                                             socket.SOCK_STREAM)
+                self._socket.connect(self.address)
+                self._socket.sendall(STRUCT_FEED.pack(FEED_SYNCED,
+                                                      *self.position, 0))
+                with self._socket.makefile('rb') as rfile:
+                    self._follow(rfile)
+            except (OSError, EOFError, RuntimeError) as exception:
+                if not self._stop.is_set():
+                    logger.warning('follower: %s, reconnecting', exception)
+            finally:
+                self._socket.close()
+            self._stop.wait(self.reconnect_interval)
+
+    def _follow(self, rfile):
+        entries = []
+        while True:
+            kind, fileid, offset, size = STRUCT_FEED.unpack(
+                    _recv_exactly(rfile, STRUCT_FEED.size))
+            if kind == FEED_ENTRY:
+                entry = _recv_exactly(rfile, size)
+                crc, timestamp, key_size, _ = STRUCT_DATA.unpack_from(entry)
+                if binascii.crc32(memoryview(entry)[4:]) != crc:
+                    raise RuntimeError('CRC error on entry {}:{}'
+                                       .format(fileid, offset))
+                key = entry[14:14 + key_size]
+                tombstone = entry.startswith(TOMBSTONE_PREFIX, 14 + key_size)
+                entries.append((key, entry, tombstone, timestamp))
+                if self._live is not None:
+                    (self._live.discard if tombstone else self._live.add)(key)
+                if len(entries) >= 1000:
+                    self.db._apply_entries(entries)
+                    entries = []
+            elif kind == FEED_RESET:
+                self.db._apply_entries(entries)
+                entries = []
+                self._live = set()
+                self.synced.clear()
+            elif kind == FEED_SYNCED:
+                self.db._apply_entries(entries)
+                entries = []
+                if self._live is not None:
+                    for key in [key for key in self.db
+                                if key not in self._live]:
+                        del self.db[key]
+                    self._live = None
+                self.db.sync()
+                self._save_position((fileid, offset))
+                self.synced.set()
+
+    def _save_position(self, position):
+        tmp_filename = self._position_filename + '.tmp'
+        with open(tmp_filename, 'wb') as fobj:
+            fobj.write(STRUCT_POSITION.pack(*position))
+        os.rename(tmp_filename, self._position_filename)
+        self.position = position
+
+    def close(self):
+        'Stop following (waiting for the entries received) and close `db`'
+
+        self._stop.set()
+        if self._socket is not None:
+            try:
+                self._socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self._thread.join()
+        self.db.close()
@@ -1,15 +1,191 @@
 # coding: utf-8
 
 # This is a sample server which acts as a Redis server but uses Bitcask
-# instead. It only implements GET and SET operations.
+# instead. It implements GET, SET, DEL, EXISTS, MGET and MSET operations, plus
+# INFO, which replies with the Bitcask stats in Prometheus' text format.
+#
+# By default it runs on asyncio: connections are kept alive and pipelined
+# commands are parsed from a buffer as they arrive; consecutive writes of a
+# pipeline are appended to the Bitcask at once (using `put_many`). The old
+# one-command-per-connection server (GET and SET only) can be used with
+# `--legacy`.
 
+import asyncio
 import socketserver
 
+import bitcask
+
+
+class ProtocolError(ValueError):
+    pass
+
 
 def _pack_value(value):
     return b'$' + bytes(str(len(value)), 'ascii') + b'\r\n' + value + b'\r\n'
 
 
+def _pack_integer(value):
+    return b':' + bytes(str(value), 'ascii') + b'\r\n'
+
+
+def _pack_array(values):
+    result = [b'*' + bytes(str(len(values)), 'ascii') + b'\r\n']
+    for value in values:
+        result.append(b'$-1\r\n' if value is None else _pack_value(value))
+    return b''.join(result)
+
+
+def _pack_error(message):
+    return b'-ERR ' + bytes(message, 'utf-8') + b'\r\n'
+
+
+def _parse_command(buffer, offset=0):
+    '''Parse a RESP array of bulk strings starting on `offset` of `buffer`
+
+    Returns `(arguments, next_offset)` or `(None, offset)` if the command is
+    not complete yet.
+    '''
+
+    if offset >= len(buffer):
+        return None, offset
+    elif buffer[offset:offset + 1] != b'*':
+        raise ProtocolError('expected \'*\', got {!r}'
+                            .format(bytes(buffer[offset:offset + 1])))
+    end = buffer.find(b'\r\n', offset)
+    if end == -1:
+        return None, offset
+    count = int(buffer[offset + 1:end])
+    position = end + 2
+
+    arguments = []
+    for _ in range(count):
+        end = buffer.find(b'\r\n', position)
+        if end == -1:
+            return None, offset
+        elif buffer[position:position + 1] != b'$':
+            raise ProtocolError('expected \'$\', got {!r}'
+                                .format(bytes(buffer[position:position + 1])))
+        length = int(buffer[position + 1:end])
+        start = end + 2
+        if start + length + 2 > len(buffer):
+            return None, offset
+        arguments.append(bytes(buffer[start:start + length]))
+        position = start + length + 2
+    return arguments, position
+
+
+class BitcaskProtocol(asyncio.Protocol):
+    '''Serve Redis commands from a Bitcask over a persistent connection
+
+    All complete commands received are executed in order; SET and MSET are
+    accumulated and written in a single `put_many` call before the next read
+    command (or the end of the received data). If this write fails (even
+    for a read-only cask or an I/O error), all the accumulated commands reply
+    with an error and the next ones are still executed.
+    '''
+
+    def __init__(self, db):
+        self.db = db
+        self.buffer = bytearray()
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.buffer += data
+        replies, pending, pending_replies = [], [], []
+        offset = 0
+        while True:
+            try:
+                arguments, offset = _parse_command(self.buffer, offset)
+            except (ProtocolError, ValueError) as exception:
+                self._write_pending(replies, pending, pending_replies)
+                replies.append(_pack_error('Protocol error: {}'
+                                           .format(exception)))
+                self.transport.write(b''.join(replies))
+                self.transport.close()
+                return
+            if arguments is None:
+                break
+            elif not arguments:
+                continue
+
+            command = arguments[0].upper()
+            parameters = arguments[1:]
+            if command == b'SET' and len(parameters) == 2:
+                pending.append((parameters[0], parameters[1]))
+                pending_replies.append(len(replies))
+                replies.append(None)
+            elif command == b'MSET' and parameters and \
+                    len(parameters) % 2 == 0:
+                pending.extend(zip(parameters[::2], parameters[1::2]))
+                pending_replies.append(len(replies))
+                replies.append(None)
+            else:
+                self._write_pending(replies, pending, pending_replies)
+                replies.append(self._execute(command, parameters))
+        self._write_pending(replies, pending, pending_replies)
+
+        del self.buffer[:offset]
+        if replies:
+            self.transport.write(b''.join(replies))
+
+    def _write_pending(self, replies, pending, pending_replies):
+        if not pending:
+            return
+        try:
+            self.db.put_many(pending)
+        except (ValueError, RuntimeError, OSError) as exception:
+            # invalid entries, read-only cask or I/O error
+            reply = _pack_error(str(exception))
+        else:
+            reply = b'+OK\r\n'
+        for index in pending_replies:
+            replies[index] = reply
+        pending.clear()
+        pending_replies.clear()
+
+    def _execute(self, command, parameters):
+        db = self.db
+        if command == b'GET' and len(parameters) == 1:
+            try:
+                return _pack_value(db[parameters[0]])
+            except KeyError:
+                return b'$-1\r\n'
+        elif command == b'MGET' and parameters:
+            values = db.get_many(parameters)
+            return _pack_array([values.get(key) for key in parameters])
+        elif command == b'EXISTS' and parameters:
+            return _pack_integer(sum(1 for key in parameters if key in db))
+        elif command == b'DEL' and parameters:
+            deleted = 0
+            for key in parameters:
+                try:
+                    del db[key]
+                except KeyError:
+                    pass
+                else:
+                    deleted += 1
+            return _pack_integer(deleted)
+        elif command == b'INFO':
+            stats = bitcask.format_prometheus(db.stats())
+            return _pack_value(stats.encode('ascii'))
+        elif command in (b'GET', b'SET', b'MGET', b'MSET', b'EXISTS', b'DEL'):
+            return _pack_error('wrong number of arguments for \'{}\' command'
+                               .format(command.decode('ascii').lower()))
+        else:
+            return _pack_error('unknown command \'{}\''
+                               .format(command.decode('utf-8', 'replace')))
+
+
+async def serve(db, host, port):
+    loop = asyncio.get_running_loop()
+    server = await loop.create_server(lambda: BitcaskProtocol(db), host, port)
+    async with server:
+        await server.serve_forever()
+
+
 class MyTCPHandler(socketserver.StreamRequestHandler):
 
     def _read_command(self):
@@ -36,22 +212,44 @@ class MyTCPHandler(socketserver.StreamRequestHandler):
                 self.server._db[parameters[0]] = parameters[1]
                 self.wfile.write(b'+OK\r\n')
         elif command == b'GET':
-            key = parameters[0]
             try:
-                value = self.server._db[parameters[0]]
+                stream = self.server._db.open_value(parameters[0])
             except KeyError:
                 self.wfile.write(b'$-1\r\n')
-            else:
-                self.wfile.write(_pack_value(value))
+                return
+            with stream:
+                if not isinstance(stream, bitcask.ValueStream):
+                    self.wfile.write(_pack_value(stream.getvalue()))
+                    return
+                # the value is sent by the kernel, without reading it
+                self.wfile.write(b'$' + bytes(str(stream.size), 'ascii') +
+                                 b'\r\n')
+                stream.sendfile(self.request)
+                self.wfile.write(b'\r\n')
         else:
             # TODO: send the correct error
             self.wfile.write(b'-ERR\r\n')
 
 
 if __name__ == "__main__":
-    HOST, PORT = "localhost", 9999
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=9999)
+    parser.add_argument('--path', default='mycask')
+    parser.add_argument('--legacy', action='store_true',
+                        help='use the one-command-per-connection server')
+    parser.add_argument('--metrics', action='store_true',
+                        help='record latencies (reported by INFO)')
+    parser.add_argument('--codec', choices=sorted(bitcask.CODECS),
+                        help='compress values with this codec')
+    args = parser.parse_args()
 
-    import bitcask
-    server = socketserver.TCPServer((HOST, PORT), MyTCPHandler)
-    server._db = bitcask.Bitcask('mycask')
-    server.serve_forever()
+    db = bitcask.Bitcask(args.path, metrics=args.metrics, codec=args.codec)
+    if args.legacy:
+        server = socketserver.TCPServer((args.host, args.port), MyTCPHandler)
+        server._db = db
+        server.serve_forever()
+    else:
+        asyncio.run(serve(db, args.host, args.port))
@@ -19,7 +19,10 @@
 
 import os
 import shutil
+import sys
 import tempfile
+import threading
+import time
 
 import pytest
 
@@ -45,6 +48,31 @@ class TestBitcaskPath(TmpDir):
         obj = bitcask.Bitcask(path=self.tmpdir)
         assert os.path.exists(self.tmpdir)
 
+    def test_empty_active_file_is_used_again(self):
+        for counter in range(5):
+            obj = bitcask.Bitcask(self.tmpdir)
+            if counter == 2:
+                obj[b'key'] = b'value'
+            obj.close()
+        assert sorted(os.listdir(self.tmpdir)) == \
+                ['1.bitcask.data', '1.bitcask.hint',
+                 '2.bitcask.data', '2.bitcask.hint']
+
+        reader = bitcask.Bitcask(self.tmpdir, read_only=True)
+        obj = bitcask.Bitcask(self.tmpdir)
+        obj[b'other'] = b'other-value'
+        obj.close()
+        assert os.path.getsize(self._path('2.bitcask.data')) > 0
+        entries, complete = bitcask._read_hintfile(self._path('2.bitcask.hint'))
+        assert [entry[0] for entry in entries] == [b'other'] and complete
+
+        reader.refresh()
+        assert reader[b'other'] == b'other-value'
+        obj = bitcask.Bitcask(self.tmpdir)
+        assert dict(obj.iter_items()) == {b'key': b'value',
+                                          b'other': b'other-value'}
+        assert obj._active_fileid == 3
+
     def test_lockfile_exists_but_invalid(self):
         os.mkdir(self.tmpdir)
         lockfile = os.path.join(self.tmpdir, 'bitcask.write.lock')
@@ -56,7 +84,9 @@ class TestBitcaskPath(TmpDir):
 
         obj = bitcask.Bitcask(self.tmpdir)
 
-        assert not os.path.exists(lockfile)
+        # the invalid lock file was replaced by ours
+        with open(lockfile) as fobj:
+            assert fobj.read() == '{} 1.bitcask.data'.format(os.getpid())
 
     def test_lockfile_exists_and_valid(self):
         os.mkdir(self.tmpdir)
@@ -70,8 +100,20 @@ class TestBitcaskPath(TmpDir):
         with pytest.raises(RuntimeError):
             obj = bitcask.Bitcask(self.tmpdir)
 
-    # TODO: lock perms should be 600
-    # TODO: check if lock file was created
+    def test_lockfile_is_created_and_removed(self):
+        obj = bitcask.Bitcask(self.tmpdir, max_file_size=20)
+        lockfile = os.path.join(self.tmpdir, 'bitcask.write.lock')
+        with open(lockfile) as fobj:
+            assert fobj.read() == '{} 1.bitcask.data'.format(os.getpid())
+        assert os.stat(lockfile).st_mode & 0o777 == 0o600
+
+        obj[b'key'] = b'value-which-rotates-file'
+        obj[b'key'] = b'value-which-rotates-file'
+        with open(lockfile) as fobj:
+            assert fobj.read() == '{} 2.bitcask.data'.format(os.getpid())
+
+        obj.close()
+        assert not os.path.exists(lockfile)
 
 
 class TestBitcaskHint(TmpDir):
@@ -129,6 +171,93 @@ class TestBitcaskHint(TmpDir):
         assert hint4.size == 28
         assert hint4.fobj.name == data_filename
 
+    def test_truncated_hintfile_is_recreated(self, caplog):
+        hintdata, data = self._make_files()
+        with open(self.hint_filename, 'wb') as fobj:
+            fobj.write(hintdata[:10])
+
+        assert bitcask._read_hintfile(self.hint_filename) == ([], False)
+        obj = bitcask.Bitcask(self.tmpdir)
+        assert obj[b'mykey'] == b'myVALUE'
+        assert 'incomplete hint file, creating another' in caplog.text
+        entries, complete = bitcask._read_hintfile(self.hint_filename)
+        assert complete
+        assert entries == [(b'mykey2', 0, 42, 1466611251, True),
+                           (b'mykey2', 42, 28, 1466611251, False),
+                           (b'mykey', 70, 41, 1466611260, True),
+                           (b'mykey', 111, 26, 1466611260, False)]
+
+    def test_active_hintfile_checkpoints(self, monkeypatch):
+        monkeypatch.setattr(bitcask, 'HINT_CHECKPOINT_SIZE', 50)
+        obj = bitcask.Bitcask(self.tmpdir)
+        for index in range(5):
+            obj[b'key' + bytes(str(index), 'ascii')] = b'value'
+        obj.sync()
+        obj[b'key5'] = b'value'  # not checkpointed (22 + 4 bytes)
+        obj._active_hint.flush()
+
+        # copy the files as they would be if the process crashed now
+        crashed = self.tmpdir + '-crashed'
+        shutil.copytree(self.tmpdir, crashed)
+        os.remove(os.path.join(crashed, 'bitcask.write.lock'))
+        obj.close()
+        try:
+            hintfilename = os.path.join(crashed, '1.bitcask.hint')
+            entries, complete = bitcask._read_hintfile(hintfilename)
+            assert not complete
+            assert [entry[0] for entry in entries] == \
+                    [b'key0', b'key1', b'key2', b'key3', b'key4']
+
+            obj = bitcask.Bitcask(crashed)
+            assert len(obj) == 6
+            assert obj[b'key5'] == b'value'
+            entries, complete = bitcask._read_hintfile(hintfilename)
+            assert complete
+            assert len(entries) == 6
+            obj.close()
+        finally:
+            shutil.rmtree(crashed)
+
+        entries, complete = bitcask._read_hintfile(self._path('1.bitcask.hint'))
+        assert complete
+        assert len(entries) == 6
+
+    def test_read_entries_in_chunks(self, monkeypatch):
+        _, data = self._make_files(hintfile=False)
+        with open(self.data_filename, 'rb') as fobj:
+            expected = list(bitcask._read_entries(fobj))
+            monkeypatch.setattr(bitcask, 'READ_CHUNK_SIZE', 10)
+            assert list(bitcask._read_entries(fobj)) == expected
+            assert list(bitcask._read_entries(fobj, 42)) == expected[1:]
+        assert [entry[0] for entry in expected] == [0, 42, 70, 111]
+        assert expected[1][3:] == (b'mykey2', b'myvalueX')
+
+    def test_corrupted_entries_are_skipped(self):
+        _, data = self._make_files(hintfile=False)
+        data = bytearray(data)
+        data[60] ^= 0xff  # second entry's key
+        with open(self.data_filename, 'wb') as fobj:
+            fobj.write(data)
+
+        with open(self.data_filename, 'rb') as fobj:
+            with pytest.raises(RuntimeError):
+                list(bitcask._read_entries(fobj))
+            skipped = []
+            entries = list(bitcask._read_entries(fobj, skipped=skipped))
+        assert [entry[0] for entry in entries] == [0, 70, 111]
+        assert skipped == [(42, 70)]
+
+    def test_torn_tail_is_truncated(self, caplog):
+        _, data = self._make_files(hintfile=False)
+        with open(self.data_filename, 'ab') as fobj:
+            fobj.write(data[42:60])  # crashed in the middle of a write
+
+        obj = bitcask.Bitcask(self.tmpdir)
+        assert obj[b'mykey'] == b'myVALUE'
+        assert obj[b'mykey2'] == b'myvalueX'
+        assert os.path.getsize(self.data_filename) == len(data)
+        assert 'skipped 18 corrupted bytes (1 ranges)' in caplog.text
+
     def _make_files(self, hintfile=True, hintdata=None, data=None):
         # Erlang code to generate this data:
         #Bc = bitcask:open("mybitcask", [read_write]).
@@ -197,11 +326,8 @@ class TestBitcaskHint(TmpDir):
         assert created_hint_contents == expected_hint_data
 
     def test_hintfile_from_datafile_with_tombstones(self):
-        expected_hint_data = (b'Wj\xb63'          b'\x00\x06' b'\x00\x00\x00\x1c' b'\x00\x00\x00\x00\x00\x00\x00*'    b'mykey2'
-                              b'Wj\xb6<'          b'\x00\x05' b'\x00\x00\x00\x1a' b'\x00\x00\x00\x00\x00\x00\x00o'    b'mykey'
-                              b'\x00\x00\x00\x00' b'\x00\x00' b'\x9f\xaf#\x95'    b'\x7f\xff\xff\xff\xff\xff\xff\xff' b'')
-
-        self._make_files(hintfile=False)
+        # tombstones are kept on the hint file (the same one Erlang creates)
+        expected_hint_data, _ = self._make_files(hintfile=False)
         obj = bitcask.Bitcask(self.tmpdir)
 
         with open(self.hint_filename, 'rb') as fobj:
@@ -256,6 +382,1406 @@ class TestBitcaskHint(TmpDir):
         assert obj[b'anothernewkey'] == b'anothernewvalue'
         # TODO: check also datafile and hintfile
 
+class TestBitcaskDelete(TmpDir):
+
+    def test_delete(self):
+        obj = bitcask.Bitcask(self.tmpdir, cache_size=1024)
+        obj.put_many([(b'key1', b'value1'), (b'key2', b'value2')])
+        assert obj[b'key1'] == b'value1'  # cached
+        del obj[b'key1']
+        assert b'key1' not in obj
+        with pytest.raises(KeyError):
+            obj[b'key1']
+        with pytest.raises(KeyError):
+            del obj[b'key1']
+        obj.close()
+
+        with open(self._path('1.bitcask.data'), 'rb') as fobj:
+            entries = list(bitcask._read_entries(fobj))
+        assert entries[-1][3:] == (b'key1',
+                                   b'bitcask_tombstone2\x00\x00\x00\x01')
+        obj = bitcask.Bitcask(self.tmpdir)
+        assert list(obj) == [b'key2']
+        obj[b'key1'] = b'value1-new'
+        assert obj[b'key1'] == b'value1-new'
+        obj.close()
+
+        # without hint files, tombstones are read from the data files
+        for filename in os.listdir(self.tmpdir):
+            if filename.endswith('.hint'):
+                os.remove(self._path(filename))
+        obj = bitcask.Bitcask(self.tmpdir)
+        assert sorted(obj) == [b'key1', b'key2']
+        assert obj[b'key1'] == b'value1-new'
+
+    def test_file_stats(self):
+        obj = bitcask.Bitcask(self.tmpdir)
+        obj.put_many([(b'key1', b'value1'), (b'key2', b'value2')])
+        obj[b'key1'] = b'value1-new'
+        del obj[b'key2']
+
+        stats = obj.file_stats()
+        assert len(stats) == 1
+        assert stats[0].fileid == 1
+        assert stats[0].live_keys == 1
+        assert stats[0].live_bytes == 14 + 4 + 10
+        assert stats[0].dead_keys == 3  # 2 old entries and the tombstone
+        assert stats[0].dead_bytes == 2 * (14 + 4 + 6) + (14 + 4 + 22)
+        assert stats[0].total_bytes == stats[0].live_bytes + \
+                stats[0].dead_bytes
+        obj.close()
+
+        obj = bitcask.Bitcask(self.tmpdir)
+        assert obj.file_stats()[0] == stats[0]
+        obj.merge()
+        assert [(stat.live_keys, stat.dead_keys, stat.total_bytes)
+                for stat in obj.file_stats()] == [(1, 0, 28), (0, 0, 0)]
+        assert len(obj) == 1
+
+    def test_read_only_sees_deletes(self):
+        writer = bitcask.Bitcask(self.tmpdir)
+        writer.put_many([(b'key1', b'value1'), (b'key2', b'value2')])
+        reader = bitcask.Bitcask(self.tmpdir, read_only=True)
+        del writer[b'key1']
+        reader.refresh()
+        assert list(reader) == [b'key2']
+
+
+class TestBitcaskStats(TmpDir):
+
+    def test_stats(self):
+        obj = bitcask.Bitcask(self.tmpdir)
+        obj.put_many([(b'key1', b'value1'), (b'key2', b'value2')])
+        obj[b'key1']
+        with pytest.raises(KeyError):
+            obj[b'key3']
+        del obj[b'key2']
+
+        stats = obj.stats()
+        assert 'latency' not in stats
+        assert stats['gets'] == 2
+        assert stats['get_misses'] == 1
+        assert stats['puts'] == 2
+        assert stats['deletes'] == 1
+        assert stats['bytes_written'] == 2 * (14 + 4 + 6) + 14 + 4 + 22
+        assert stats['flushes'] == 2
+        assert stats['keys'] == 1
+        assert stats['live_bytes'] == 14 + 4 + 6
+        obj.close()
+
+        os.remove(self._path('1.bitcask.hint'))
+        obj = bitcask.Bitcask(self.tmpdir)
+        assert obj.stats()['hint_rebuilds'] == 1
+
+    def test_latency_metrics(self):
+        obj = bitcask.Bitcask(self.tmpdir, metrics=True)
+        obj[b'key1'] = b'value1'
+        for _ in range(10):
+            obj[b'key1']
+
+        latency = obj.stats()['latency']
+        assert latency['get']['count'] == 10
+        assert latency['put']['count'] == 1
+        assert latency['delete']['count'] == 0
+        assert 0 < latency['get']['p50_us'] <= latency['get']['p999_us']
+
+        text = bitcask.format_prometheus(obj.stats())
+        assert 'bitcask_gets 10\n' in text
+        assert 'bitcask_get_latency_microseconds_count 10\n' in text
+        assert 'bitcask_get_latency_microseconds{quantile="0.99"}' in text
+
+    def test_latency_histogram(self):
+        histogram = bitcask.LatencyHistogram()
+        for nanoseconds in range(1, 1001):
+            histogram.record(nanoseconds)
+        assert histogram.percentile(0.5) == 512
+        assert histogram.percentile(0.999) == 1024
+        assert histogram.summary()['sum_us'] == 500.5
+
+
+class TestBitcaskFold(TmpDir):
+
+    def test_iter_items_in_disk_order(self, monkeypatch):
+        monkeypatch.setattr(bitcask, 'READ_CHUNK_SIZE', 60)
+        obj = bitcask.Bitcask(self.tmpdir, max_file_size=100)
+        for counter in range(10):
+            obj[bytes('key{}'.format(counter), 'ascii')] = b'x' * counter
+        obj[b'key2'] = b'new value'
+        del obj[b'key5']
+
+        items = list(obj.iter_items())
+        assert dict(items) == dict(obj.items())
+        assert len(items) == 9
+        positions = [(bitcask._fileid(obj._keydir[key].fobj.name),
+                      obj._keydir[key].position) for key, _ in items]
+        assert positions == sorted(positions)
+        assert items[-1] == (b'key2', b'new value')
+
+        def total_size(key, value, accumulator):
+            return accumulator + len(value)
+        assert obj.fold(total_size, 0) == sum(range(10)) - 2 - 5 + 9
+
+    def test_iter_items_while_merging(self):
+        obj = bitcask.Bitcask(self.tmpdir)
+        obj.put_many([(b'key1', b'value1'), (b'key2', b'value2')])
+        items = obj.iter_items()
+        assert next(items) == (b'key1', b'value1')
+        obj[b'key2'] = b'value2-new'
+        obj.merge()
+        assert list(items) == [(b'key2', b'value2')]  # snapshot
+
+
+class TestBitcaskGetMany(TmpDir):
+
+    def test_get_many(self, monkeypatch):
+        preads = []
+        pread = os.pread
+
+        def counting_pread(fd, size, offset):
+            preads.append((fd, size, offset))
+            return pread(fd, size, offset)
+
+        monkeypatch.setattr(bitcask.os, 'pread', counting_pread)
+        obj = bitcask.Bitcask(self.tmpdir, cache_size=100)
+        for counter in range(10):
+            obj[bytes('key{}'.format(counter), 'ascii')] = b'x' * counter
+        assert obj[b'key0'] == b''  # cached
+        del preads[:]
+
+        values = obj.get_many([b'key9', b'key0', b'missing', b'key1',
+                               b'key5', b'key9'])
+        assert values == {b'key9': b'x' * 9, b'key0': b'', b'key1': b'x',
+                          b'key5': b'x' * 5}
+        assert len(preads) == 1  # close enough to be read at once
+        assert obj.stats()['get_misses'] == 1
+
+        monkeypatch.setattr(bitcask, 'COALESCE_GAP', 0)
+        values = obj.get_many([b'key2', b'key3', b'key6'])
+        assert values == {b'key2': b'xx', b'key3': b'xxx',
+                          b'key6': b'x' * 6}
+        assert len(preads) == 3  # key2 and key3 are contiguous
+        assert obj.get_many([]) == {}
+
+
+class TestBitcaskCodec(TmpDir):
+
+    def _datafile(self):
+        with open(os.path.join(self.tmpdir, '1.bitcask.data'), 'rb') as fobj:
+            return fobj.read()
+
+    def test_compressed_values(self):
+        value = b'{"name": "pybitcask", "value": 42}' * 100
+        obj = bitcask.Bitcask(self.tmpdir, codec='zlib',
+                              compress_threshold=100)
+        obj.put_many([(b'big', value), (b'small', b'x' * 99),
+                      (b'random', os.urandom(1000))])
+        obj.close()
+
+        data = self._datafile()
+        assert value not in data
+        assert bitcask.CODEC_PREFIX + b'\x01' in data
+        assert b'x' * 99 in data  # under the threshold
+        assert data.count(bitcask.CODEC_PREFIX) == 1  # random didn't shrink
+        assert len(data) < len(value)
+
+        obj = bitcask.Bitcask(self.tmpdir, mmap_reads=True)  # no codec
+        assert obj[b'big'] == value
+        assert obj.get_many([b'big']) == {b'big': value}
+        assert dict(obj.iter_items())[b'big'] == value
+        obj.merge()
+        assert obj[b'big'] == value
+        obj.close()
+
+    def test_raw_values_stay_compatible(self):
+        obj = bitcask.Bitcask(self.tmpdir)
+        collision = bitcask.CODEC_PREFIX + b'\x01not compressed'
+        obj.put_many([(b'key', b'value'), (b'collision', collision)])
+        assert obj[b'collision'] == collision
+        obj.close()
+
+        data = self._datafile()
+        assert b'keyvalue' in data
+        assert bitcask.CODEC_PREFIX + b'\x00' + collision in data
+
+    def test_invalid_codec(self):
+        with pytest.raises(ValueError):
+            bitcask.Bitcask(self.tmpdir, codec='snappy')
+        with pytest.raises(ValueError):
+            bitcask.Bitcask(self.tmpdir,
+                            codec=bitcask.Codec(0, bytes, bytes))
+
+
+class TestBitcaskTTL(TmpDir):
+
+    def setup_method(self, method):
+        super().setup_method(method)
+        self.now = 1466611260.5
+
+    def _clock(self, monkeypatch):
+        monkeypatch.setattr(bitcask.time, 'time', lambda: self.now)
+
+    def test_ttl(self, monkeypatch):
+        self._clock(monkeypatch)
+        obj = bitcask.Bitcask(self.tmpdir, expiry_interval=None,
+                              cache_size=1000)
+        obj[b'key'] = b'old'
+        obj.set(b'key', b'value', ttl=10)
+        obj.set(b'other', b'value', ttl=20)
+        obj[b'forever'] = b'value'
+        assert obj[b'key'] == b'value'
+        assert obj._keydir[b'key'].timestamp == \
+                1466611271 | bitcask.TIMESTAMP_EXPIRES
+        with pytest.raises(ValueError):
+            obj.set(b'key', b'value', ttl=0)
+
+        self.now += 10  # expiry time is rounded up, so not expired yet
+        assert obj[b'key'] == b'value'
+        self.now += 0.5
+        assert b'key' not in obj
+        with pytest.raises(KeyError):
+            obj[b'key']
+        assert obj.get_many([b'key', b'other']) == {b'other': b'value'}
+        assert obj.expire() == 0  # `key` was already dropped
+
+        self.now += 10
+        assert obj.expire() == 1
+        assert list(obj) == [b'forever']
+        assert obj.file_stats()[0].live_keys == 1
+        obj.close()
+
+        # expired entries hide the older ones (like tombstones)
+        obj = bitcask.Bitcask(self.tmpdir)
+        assert list(obj) == [b'forever']
+        obj.close()
+        os.remove(self._path('1.bitcask.hint'))
+        obj = bitcask.Bitcask(self.tmpdir)
+        assert list(obj) == [b'forever']
+        entries, _ = bitcask._read_hintfile(self._path('1.bitcask.hint'))
+        assert [entry[4] for entry in entries] == [False, True, True, False]
+        obj.close()
+
+    def test_expiry_heap_is_bounded_by_keys(self, monkeypatch):
+        self._clock(monkeypatch)
+        obj = bitcask.Bitcask(self.tmpdir, expiry_interval=None)
+        keys = [bytes('session{}'.format(counter), 'ascii')
+                for counter in range(100)]
+        for counter in range(1000):
+            self.now += 0.5  # each second gets a new expiry time
+            obj.put_many([(key, b'value') for key in keys], ttl=3600)
+            assert len(obj._expiry) <= 2 * 100 + 16
+        obj[keys[0]] = b'no ttl'
+        del obj[keys[1]]
+        assert obj._expiring == 98
+        obj.close()
+
+        # entries overwritten on the hint files aren't scheduled
+        obj = bitcask.Bitcask(self.tmpdir, expiry_interval=None)
+        assert obj._expiring == 98
+        assert len(obj._expiry) == 98
+        self.now += 3600.5
+        assert obj.expire() == 98
+        assert list(obj) == [keys[0]]
+        obj.close()
+
+    def test_expired_in_background(self, monkeypatch):
+        self._clock(monkeypatch)
+        obj = bitcask.Bitcask(self.tmpdir, expiry_interval=0.01)
+        obj.set(b'key', b'value', ttl=1)
+        self.now += 1.5
+        time.sleep(0.1)
+        assert len(obj) == 0
+        obj.close()
+
+
+class TestBitcaskStream(TmpDir):
+
+    def test_put_stream_and_open_value(self, monkeypatch):
+        import io
+
+        monkeypatch.setattr(bitcask, 'STREAM_CHUNK_SIZE', 7)
+        value = bytes(range(256)) * 10
+        obj = bitcask.Bitcask(self.tmpdir)
+        obj[b'before'] = b'value'
+        obj.put_stream(b'key', io.BytesIO(value))
+        obj.put_stream(b'prefixed', io.BytesIO(bitcask.CODEC_PREFIX + value),
+                       size=len(bitcask.CODEC_PREFIX) + 10)
+        assert obj[b'key'] == value
+        assert obj[b'prefixed'] == bitcask.CODEC_PREFIX + value[:10]
+
+        with obj.open_value(b'key') as stream:
+            assert stream.size == len(value)
+            assert stream.read(10) == value[:10]
+            stream.seek(-5, io.SEEK_END)
+            assert stream.read() == value[-5:]
+            stream.seek(300)
+            assert io.BufferedReader(stream).read() == value[300:]
+        with obj.open_value(b'prefixed') as stream:
+            assert stream.read() == bitcask.CODEC_PREFIX + value[:10]
+        with pytest.raises(KeyError):
+            obj.open_value(b'missing')
+        obj.close()
+
+        # CRCs are checked when the hint file is created
+        os.remove(self._path('1.bitcask.hint'))
+        obj = bitcask.Bitcask(self.tmpdir)
+        assert obj[b'key'] == value
+        obj.close()
+
+    def test_put_stream_errors(self):
+        import io
+
+        obj = bitcask.Bitcask(self.tmpdir)
+        obj[b'before'] = b'value'
+        size = os.path.getsize(self._path('1.bitcask.data'))
+        with pytest.raises(ValueError):
+            obj.put_stream(b'key', io.BytesIO(b'short'), size=10)
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, b'value')
+        os.close(write_fd)
+        with open(read_fd, 'rb', buffering=0) as pipe:
+            with pytest.raises(ValueError):  # not seekable: size is needed
+                obj.put_stream(b'key', pipe)
+        assert os.path.getsize(self._path('1.bitcask.data')) == size
+        obj[b'after'] = b'value'
+        assert b'key' not in obj
+        obj.close()
+        obj = bitcask.Bitcask(self.tmpdir)
+        assert sorted(obj) == [b'after', b'before']
+
+    def test_reads_while_streaming(self):
+        obj = bitcask.Bitcask(self.tmpdir, compact_keydir=True,
+                              cache_size=1000)
+        obj[b'before'] = b'value'
+        copying, release = threading.Event(), threading.Event()
+
+        class SlowSource:
+            calls = 0
+
+            def read(self, size):
+                self.calls += 1
+                if self.calls > 1:  # the first read is the value's head
+                    copying.set()
+                    release.wait(10)
+                return b'x' * size
+
+        def run(function, *args):
+            thread = threading.Thread(target=function, args=args)
+            thread.start()
+            return thread
+
+        streaming = run(obj.put_stream, b'key', SlowSource(), 20)
+        results = []
+        try:
+            assert copying.wait(10)
+            reading = run(lambda: results.append(
+                    (obj[b'before'], b'before' in obj,
+                     obj.get_many([b'before']), obj.stats()['keys'])))
+            reading.join(5)
+            assert results == [(b'value', True, {b'before': b'value'}, 1)]
+            writing = run(obj.__setitem__, b'after', b'value')
+            writing.join(0.1)
+            assert writing.is_alive()  # other writes wait for the copy
+        finally:
+            release.set()
+        streaming.join()
+        writing.join()
+        assert obj[b'key'] == b'x' * 20
+        assert obj[b'after'] == b'value'
+        obj.close()
+        obj = bitcask.Bitcask(self.tmpdir)
+        assert dict(obj.iter_items()) == {b'before': b'value',
+                                          b'key': b'x' * 20,
+                                          b'after': b'value'}
+        obj.close()
+
+    def test_sendfile(self):
+        import socket
+
+        obj = bitcask.Bitcask(self.tmpdir)
+        obj[b'key'] = b'value' * 1000
+        left, right = socket.socketpair()
+        with left, right, obj.open_value(b'key') as stream:
+            assert stream.sendfile(left) == 5000
+            received = b''
+            while len(received) < 5000:
+                received += right.recv(5000)
+        assert received == b'value' * 1000
+
+
+class TestBitcaskSnapshot(TmpDir):
+
+    def _fill(self, **options):
+        obj = bitcask.Bitcask(self.tmpdir, max_file_size=100, **options)
+        for counter in range(20):
+            obj[bytes('key{}'.format(counter % 12), 'ascii')] = \
+                    bytes('value{}'.format(counter), 'ascii')
+        del obj[b'key3']
+        return obj
+
+    def _contents(self, obj):
+        return dict(obj.iter_items()), [stats for stats in obj.file_stats()
+                                        if stats.total_bytes > 0]
+
+    def test_snapshot(self, monkeypatch):
+        obj = self._fill()
+        obj.snapshot()
+        snapshot_fileid = obj._active_fileid
+        obj.put_many([(b'key0', b'new'), (b'key20', b'value')])
+        del obj[b'key1']
+        obj.set(b'key4', b'value', ttl=3600)
+        for counter in range(5):  # rotates the active file
+            obj[bytes('other{}'.format(counter), 'ascii')] = b'x' * 20
+        expected = self._contents(obj)
+        obj.close()
+
+        loaded = []
+        load_entries = bitcask._load_entries
+        monkeypatch.setattr(bitcask, '_load_entries', lambda filename:
+                            loaded.append(bitcask._fileid(filename)) or
+                            load_entries(filename))
+        obj = bitcask.Bitcask(self.tmpdir)
+        assert self._contents(obj) == expected
+        assert loaded[0] == snapshot_fileid  # only after the snapshot
+        assert loaded == list(range(snapshot_fileid,
+                                    snapshot_fileid + len(loaded)))
+        assert obj._expiry[0][1] == b'key4'
+        obj.close()
+
+        # a snapshot of files which were merged is not used
+        obj = bitcask.Bitcask(self.tmpdir)
+        obj.merge()
+        expected = self._contents(obj)
+        obj.close()
+        del loaded[:]
+        obj = bitcask.Bitcask(self.tmpdir)
+        assert self._contents(obj) == expected
+        # all files (the empty active file of the merge is used again)
+        assert loaded == [stats.fileid for stats in obj.file_stats()]
+        obj.close()
+
+    def test_writes_while_snapshot_is_written(self, monkeypatch):
+        monkeypatch.setattr(bitcask, 'SNAPSHOT_BLOCK', 3)
+        obj = self._fill(compact_keydir=True)
+        frozen_items = obj._frozen_items
+
+        def write_meanwhile():
+            for index, item in enumerate(frozen_items()):
+                if index == 1:  # entries of the next blocks are changed
+                    obj.put_many([(b'key0', b'new'), (b'key11', b'new'),
+                                  (b'key20', b'value')])
+                    for counter in range(4, 11):  # would compact the arrays
+                        del obj[bytes('key{}'.format(counter), 'ascii')]
+                    # and resizes its hash table
+                    obj.put_many((bytes('new{}'.format(counter), 'ascii'),
+                                  b'value') for counter in range(30))
+                yield item
+
+        monkeypatch.setattr(obj, '_frozen_items', write_meanwhile)
+        obj.snapshot()
+        assert obj._keydir._frozen is None
+        expected = self._contents(obj)
+        obj.close()
+
+        # the snapshot has the keydir before the writes, which are loaded
+        # from the data files (so stats aren't counted twice)
+        obj = bitcask.Bitcask(self.tmpdir, compact_keydir=True)
+        assert self._contents(obj) == expected
+        assert len(obj) == 5 + 30
+        assert b'key10' not in obj
+        assert obj[b'key11'] == b'new'
+        obj.close()
+
+    def test_snapshot_on_close(self, monkeypatch):
+        obj = self._fill(snapshot_interval=3600, compact_keydir=True)
+        expected = self._contents(obj)
+        obj.close()
+        assert os.path.exists(self._path('bitcask.keydir'))
+
+        monkeypatch.setattr(bitcask, '_load_entries', None)  # not called
+        obj = bitcask.Bitcask(self.tmpdir, compact_keydir=True)
+        assert self._contents(obj) == expected
+        obj.close()
+
+    def test_snapshot_fsyncs_sealed_files(self, monkeypatch):
+        synced = []
+        fsync = os.fsync
+        monkeypatch.setattr(bitcask.os, 'fsync', lambda fd: synced.append(
+                os.fstat(fd).st_ino) or fsync(fd))
+
+        def inode(fileid):
+            return os.stat(self._path('{}.bitcask.data'.format(fileid))).st_ino
+
+        obj = self._fill()  # `sync='none'`: files are sealed without fsync
+        sealed = sorted(fileid for fileid in obj._datafiles
+                        if fileid != obj._active_fileid)
+        assert len(sealed) > 1 and synced == []
+        obj.snapshot()
+        assert set(map(inode, sealed + [obj._active_fileid])) <= set(synced)
+        del synced[:]
+        obj.snapshot()  # only the active file is fsync'ed again
+        assert set(map(inode, sealed)).isdisjoint(synced)
+        obj.close()
+
+    def test_snapshot_of_truncated_files_is_ignored(self, monkeypatch):
+        obj = self._fill(snapshot_interval=3600)
+        fileids = sorted(obj._datafiles)
+        obj.close()
+        # the end of a file not fsync'ed was lost (its hint file too)
+        with open(self._path('1.bitcask.data'), 'r+b') as fobj:
+            fobj.truncate(os.fstat(fobj.fileno()).st_size - 1)
+        os.remove(self._path('1.bitcask.hint'))
+
+        loaded = []
+        load_entries = bitcask._load_entries
+        monkeypatch.setattr(bitcask, '_load_entries', lambda filename:
+                            loaded.append(bitcask._fileid(filename)) or
+                            load_entries(filename))
+        obj = bitcask.Bitcask(self.tmpdir)
+        assert loaded == fileids
+        assert len(dict(obj.iter_items())) == len(obj)
+        obj.close()
+
+    def test_corrupted_snapshot_is_ignored(self):
+        obj = self._fill(snapshot_interval=3600)
+        expected = self._contents(obj)
+        obj.close()
+        with open(self._path('bitcask.keydir'), 'r+b') as fobj:
+            fobj.seek(40)
+            data = fobj.read(1)
+            fobj.seek(40)
+            fobj.write(bytes((data[0] ^ 1, )))
+
+        obj = bitcask.Bitcask(self.tmpdir)
+        assert self._contents(obj) == expected
+        obj.close()
+
+
+class TestShardedBitcask(TmpDir):
+
+    def _check(self, processes):
+        obj = bitcask.ShardedBitcask(self.tmpdir, shards=3,
+                                     processes=processes)
+        items = [(bytes('key{}'.format(counter), 'ascii'),
+                  bytes('value{}'.format(counter), 'ascii'))
+                 for counter in range(30)]
+        obj.put_many(items)
+        obj[b'key0'] = b'new'
+        del obj[b'key1']
+        with pytest.raises(KeyError):
+            obj[b'key1']
+        with pytest.raises(KeyError):
+            del obj[b'missing']
+        assert obj[b'key0'] == b'new'
+        assert obj[b'key2'] == b'value2'
+        assert len(obj) == 29
+        assert sorted(obj) == sorted(key for key, _ in items if key != b'key1')
+        assert obj.get_many([b'key1', b'key3', b'key4']) == \
+                {b'key3': b'value3', b'key4': b'value4'}
+        obj.close()
+
+        # keys are spread over independent casks
+        shards = [bitcask.Bitcask(os.path.join(self.tmpdir,
+                                               'shard-{}'.format(index)))
+                  for index in range(3)]
+        assert all(len(shard) > 0 for shard in shards)
+        assert sum(len(shard) for shard in shards) == 29
+        assert shards[bitcask._shard_index(b'key0', 3)][b'key0'] == b'new'
+        for shard in shards:
+            shard.close()
+
+        with pytest.raises(ValueError):
+            bitcask.ShardedBitcask(self.tmpdir, shards=4)
+
+    def test_sharded(self):
+        self._check(processes=False)
+
+    def test_sharded_processes(self):
+        self._check(processes=True)
+
+    def test_read_only_does_not_create_directory(self):
+        with pytest.raises(FileNotFoundError):
+            bitcask.ShardedBitcask(self.tmpdir, read_only=True)
+        assert not os.path.exists(self.tmpdir)
+
+
+class TestBitcaskChanges(TmpDir):
+
+    def test_changes_resume_and_rotation(self):
+        obj = bitcask.Bitcask(self.tmpdir, max_file_size=100, codec='zlib',
+                              compress_threshold=10)
+        obj[b'key1'] = b'value1'
+        obj[b'key2'] = b'x' * 1000
+        del obj[b'key1']
+
+        changes = list(obj.changes())
+        assert [(change.key, change.tombstone) for change in changes] == \
+                [(b'key1', False), (b'key2', False), (b'key1', True)]
+        assert [change.value for change in changes[:2]] == \
+                [b'value1', b'x' * 1000]
+        assert len({change.fileid for change in changes}) > 1
+
+        last = changes[-1]
+        assert list(obj.changes(last.fileid, last.offset + last.size)) == []
+        obj[b'key3'] = b'value3'
+        assert [change.key for change in
+                obj.changes(last.fileid, last.offset + last.size)] == [b'key3']
+        with pytest.raises(bitcask.PositionLost):
+            list(obj.changes(last.fileid, 10 ** 6))
+        obj.close()
+
+    def test_changes_after_merge(self):
+        obj = bitcask.Bitcask(self.tmpdir)
+        obj[b'key1'] = b'value1'
+        obj[b'key1'] = b'value2'
+        end = list(obj.changes())[-1]
+        end = (end.fileid, end.offset + end.size)
+        middle = (end[0], 1)
+
+        obj.merge()
+        obj[b'key2'] = b'value3'
+        # at the end of the merged active file: continue on the new one
+        assert [change.key for change in obj.changes(*end)] == [b'key2']
+        with pytest.raises(bitcask.PositionLost):
+            list(obj.changes(*middle))
+        # from the start: the merged entries and then the new ones
+        assert [(change.key, change.value) for change in obj.changes()] == \
+                [(b'key1', b'value2'), (b'key2', b'value3')]
+        obj.close()
+
+
+class TestFollower(TmpDir):
+
+    def setup_method(self, method):
+        super().setup_method(method)
+        os.makedirs(self.tmpdir)
+        self.db = bitcask.Bitcask(self._path('leader'))
+        self.address = self._path('feed.sock')
+        self.server = bitcask.ChangeFeedServer(self.address, self.db,
+                                               interval=0.01)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       kwargs={'poll_interval': 0.01})
+        self.thread.start()
+
+    def teardown_method(self, method):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        self.db.close()
+        super().teardown_method(method)
+
+    def _wait(self, follower, position):
+        deadline = time.time() + 10
+        while follower.position != position:
+            assert time.time() < deadline
+            follower.synced.wait(0.01)
+
+    def _position(self):
+        feed = bitcask.ChangeFeed(self.db)
+        list(feed.read())
+        return feed.position
+
+    def test_replication(self):
+        self.db.put_many([(b'key1', b'value1'), (b'key2', b'value2')])
+        self.db.set(b'key3', b'value3', ttl=3600)
+        follower = bitcask.Follower(self._path('follower'), self.address,
+                                    reconnect_interval=0.01)
+        self._wait(follower, self._position())
+        assert dict(follower.db.iter_items()) == \
+                {b'key1': b'value1', b'key2': b'value2', b'key3': b'value3'}
+
+        del self.db[b'key1']
+        self.db[b'key2'] = b'new'
+        self._wait(follower, self._position())
+        assert sorted(follower.db) == [b'key2', b'key3']
+        assert follower.db[b'key2'] == b'new'
+        follower.close()
+
+        # reopened, it asks only for the new entries
+        self.db[b'key4'] = b'value4'
+        follower = bitcask.Follower(self._path('follower'), self.address,
+                                    reconnect_interval=0.01)
+        self._wait(follower, self._position())
+        assert sorted(follower.db) == [b'key2', b'key3', b'key4']
+        follower.close()
+
+    def test_resync_after_position_lost(self):
+        self.db.put_many([(b'key1', b'value1'), (b'key2', b'value2')])
+        follower = bitcask.Follower(self._path('follower'), self.address,
+                                    reconnect_interval=0.01)
+        self._wait(follower, self._position())
+        follower.close()
+
+        del self.db[b'key1']
+        self.db[b'key3'] = b'value3'
+        self.db.merge()  # drops the tombstone of `key1`
+        follower = bitcask.Follower(self._path('follower'), self.address,
+                                    reconnect_interval=0.01)
+        self._wait(follower, self._position())
+        assert dict(follower.db.iter_items()) == \
+                {b'key2': b'value2', b'key3': b'value3'}
+        follower.close()
+
+
+class TestBitcaskThreads(TmpDir):
+
+    def test_concurrent_reads_and_writes(self):
+        import threading
+
+        obj = bitcask.Bitcask(self.tmpdir, max_file_size=1000)
+        keys = [bytes('key{}'.format(counter), 'ascii')
+                for counter in range(20)]
+        obj.put_many((key, key + b'-0') for key in keys)
+        stop, errors = threading.Event(), []
+
+        def read():
+            while not stop.is_set():
+                for key in keys:
+                    value = obj[key]
+                    if not value.startswith(key + b'-'):
+                        errors.append(value)
+
+        readers = [threading.Thread(target=read) for _ in range(4)]
+        for thread in readers:
+            thread.start()
+        try:
+            for version in range(1, 50):
+                obj.put_many((key, key + bytes('-{}'.format(version), 'ascii'))
+                             for key in keys)
+                if version % 10 == 0:
+                    obj.merge()
+        finally:
+            stop.set()
+            for thread in readers:
+                thread.join()
+        assert errors == []
+        assert obj[b'key3'] == b'key3-49'
+
+    def test_compact_keydir_lookups_while_resized(self):
+        obj = bitcask.Bitcask(self.tmpdir, compact_keydir=True,
+                              max_file_size=10000)
+        # deleting the junk keys makes the keydir compact its arrays, moving
+        # the entries of the keys checked
+        junk = [bytes('junk{}'.format(counter), 'ascii')
+                for counter in range(2000)]
+        keys = [bytes('key{}'.format(counter), 'ascii')
+                for counter in range(50)]
+        obj.put_many((key, key) for key in junk + keys)
+        stop, errors = threading.Event(), []
+
+        def check():
+            while not stop.is_set():
+                for key in keys:
+                    try:
+                        if key not in obj:
+                            errors.append(key)
+                    except Exception as exception:
+                        errors.append(exception)
+
+        def write(prefix, first_junk):
+            # new keys make the keydir grow (and rebuild its hash table)
+            for counter in range(3000):
+                key = bytes('{}{}'.format(prefix, counter), 'ascii')
+                obj[key] = key
+                if counter % 4:
+                    del obj[key]
+                if counter < 1000:
+                    del obj[junk[first_junk + counter]]
+
+        checkers = [threading.Thread(target=check) for _ in range(2)]
+        writers = [threading.Thread(target=write, args=(prefix, first_junk))
+                   for prefix, first_junk in (('a', 0), ('b', 1000))]
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)  # switch threads in the middle of lookups
+        for thread in checkers + writers:
+            thread.start()
+        try:
+            for _ in range(3):
+                obj.merge()
+            for thread in writers:
+                thread.join()
+        finally:
+            stop.set()
+            for thread in checkers:
+                thread.join()
+            sys.setswitchinterval(interval)
+        assert errors == []
+        assert set(obj) == set(keys) | {
+                bytes('{}{}'.format(prefix, counter), 'ascii')
+                for prefix in ('a', 'b') for counter in range(0, 3000, 4)}
+        obj.close()
+
+    def test_iteration_while_writing(self):
+        obj = bitcask.Bitcask(self.tmpdir)
+        keys = [bytes('key{}'.format(counter), 'ascii')
+                for counter in range(1000)]
+        obj.put_many((key, key) for key in keys)
+        stop, errors = threading.Event(), []
+
+        def write():
+            counter = 0
+            while not stop.is_set():
+                key = bytes('new{}'.format(counter), 'ascii')
+                obj[key] = key
+                del obj[key]
+                counter += 1
+
+        writer = threading.Thread(target=write)
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        writer.start()
+        try:
+            for _ in range(50):
+                try:
+                    scanned = [key for key in obj if key.startswith(b'key')]
+                    if scanned != keys:
+                        errors.append(len(scanned))
+                except RuntimeError as exception:
+                    errors.append(exception)
+        finally:
+            stop.set()
+            writer.join()
+            sys.setswitchinterval(interval)
+        assert errors == []
+        obj.close()
+
+    def test_value_read_before_write_is_not_cached(self):
+        obj = bitcask.Bitcask(self.tmpdir, cache_size=1000)
+        obj[b'key'] = b'old'
+        read_value = obj._read_value
+
+        def read_and_write(key, hint):
+            value = read_value(key, hint)
+            obj[b'key'] = b'new'  # finished before the old value is cached
+            return value
+
+        obj._read_value = read_and_write
+        assert obj[b'key'] == b'old'
+        obj._read_value = read_value
+        assert obj[b'key'] == b'new'
+        assert obj.get_many([b'key']) == {b'key': b'new'}
+
+
+class TestBitcaskBatch(TmpDir):
+
+    def test_put_many(self):
+        obj = bitcask.Bitcask(self.tmpdir)
+        obj.put_many([(b'key1', b'value1'), (b'key2', b'value2'),
+                      (b'key1', b'value1-new')])
+
+        assert len(obj) == 2
+        assert obj[b'key1'] == b'value1-new'
+        assert obj[b'key2'] == b'value2'
+        obj.close()
+
+        obj = bitcask.Bitcask(self.tmpdir)
+        assert obj[b'key1'] == b'value1-new'
+        assert obj[b'key2'] == b'value2'
+
+    def test_put_many_invalid_entry(self):
+        obj = bitcask.Bitcask(self.tmpdir)
+        with pytest.raises(ValueError):
+            obj.put_many([(b'key1', b'value1'),
+                          (b'key2', b'bitcask_tombstone')])
+
+        assert len(obj) == 0
+        assert os.path.getsize(self._path('1.bitcask.data')) == 0
+
+    def test_put_many_rotates_active_file(self):
+        obj = bitcask.Bitcask(self.tmpdir, max_file_size=100)
+        obj.put_many(('key{}'.format(counter).encode('ascii'), b'x' * 30)
+                     for counter in range(5))
+
+        assert obj._active_fileid == 3
+        for counter in range(5):
+            assert obj['key{}'.format(counter).encode('ascii')] == b'x' * 30
+
+    def test_write_batch(self):
+        obj = bitcask.Bitcask(self.tmpdir)
+        with obj.write_batch() as batch:
+            batch[b'key1'] = b'value1'
+            batch[b'key2'] = b'value2'
+            assert b'key1' not in obj
+
+        assert obj[b'key1'] == b'value1'
+        assert obj[b'key2'] == b'value2'
+
+        with pytest.raises(ZeroDivisionError):
+            with obj.write_batch() as batch:
+                batch[b'key3'] = b'value3'
+                1 / 0
+        assert b'key3' not in obj
+
+
+class TestBitcaskSync(TmpDir):
+
+    def _count_fsyncs(self, monkeypatch):
+        calls = []
+        fsync = os.fsync
+
+        def counting_fsync(fd):
+            calls.append(fd)
+            fsync(fd)
+
+        monkeypatch.setattr(bitcask.os, 'fsync', counting_fsync)
+        return calls
+
+    def test_parse_sync(self):
+        assert bitcask._parse_sync('none') == ('none', None)
+        assert bitcask._parse_sync(False) == ('none', None)
+        assert bitcask._parse_sync('always') == ('always', None)
+        assert bitcask._parse_sync(True) == ('always', None)
+        assert bitcask._parse_sync('interval=250') == ('interval', 0.25)
+        for sync in ('sometimes', 'interval=', 'interval=-1', None):
+            with pytest.raises(ValueError):
+                bitcask._parse_sync(sync)
+
+    def test_sync_none(self, monkeypatch):
+        calls = self._count_fsyncs(monkeypatch)
+        obj = bitcask.Bitcask(self.tmpdir)
+        obj[b'key'] = b'value'
+        assert calls == []
+        obj.sync()
+        assert len(calls) == 2  # data and hint files
+
+    def test_sync_always(self, monkeypatch):
+        calls = self._count_fsyncs(monkeypatch)
+        obj = bitcask.Bitcask(self.tmpdir, sync='always')
+        obj[b'key'] = b'value'
+        obj[b'key2'] = b'value'
+        assert calls == [obj._active_data.fileno()] * 2
+
+    def test_sync_interval(self, monkeypatch):
+        calls = self._count_fsyncs(monkeypatch)
+        obj = bitcask.Bitcask(self.tmpdir, sync='interval=10')
+        obj[b'key'] = b'value'
+        for _ in range(100):
+            if calls:
+                break
+            time.sleep(0.01)
+        obj.close()
+        assert calls
+
+
+class TestBitcaskCache(TmpDir):
+
+    def test_lru_cache(self):
+        cache = bitcask.LRUCache(max_bytes=20)
+        cache.put(b'k1', b'12345678')  # 10 bytes
+        cache.put(b'k2', b'12345678')
+        assert cache.get(b'k1') == b'12345678'  # k2 is now the oldest
+        cache.put(b'k3', b'1234')
+
+        assert cache.get(b'k2') is None
+        assert cache.get(b'k3') == b'1234'
+        assert cache.size == 16
+        cache.put(b'k4', b'x' * 30)  # too big to be cached
+        assert cache.get(b'k4') is None
+        assert len(cache) == 2
+        assert (cache.hits, cache.misses) == (2, 2)
+
+    def test_cached_reads(self):
+        obj = bitcask.Bitcask(self.tmpdir, cache_size=1024)
+        obj[b'key'] = b'value'
+        assert obj[b'key'] == b'value'
+        assert obj[b'key'] == b'value'
+        assert obj.cache_info() == bitcask.CacheInfo(hits=1, misses=1,
+                                                     maxsize=1024, currsize=8)
+
+        obj[b'key'] = b'new-value'
+        assert obj.cache_info().currsize == 0
+        assert obj[b'key'] == b'new-value'
+        with pytest.raises(KeyError):
+            obj[b'non-existent']
+        assert obj.cache_info().misses == 3
+
+    def test_cache_disabled(self):
+        obj = bitcask.Bitcask(self.tmpdir)
+        obj[b'key'] = b'value'
+        assert obj[b'key'] == b'value'
+        assert obj.cache_info() is None
+
+
+class TestCompactKeydir(TmpDir):
+
+    def test_mapping_interface(self):
+        fobj1, fobj2 = object(), object()
+        keydir = bitcask.CompactKeydir()
+        for counter in range(1000):
+            key = 'key-{}'.format(counter).encode('ascii')
+            keydir[key] = bitcask.Hint(fobj=fobj1, position=counter * 10,
+                                       size=counter, timestamp=counter + 1)
+        keydir[b'key-5'] = bitcask.Hint(fobj=fobj2, position=2 ** 40,
+                                        size=123, timestamp=456)
+
+        assert len(keydir) == 1000
+        assert b'key-999' in keydir
+        assert b'key-1000' not in keydir
+        assert keydir[b'key-10'] == bitcask.Hint(fobj=fobj1, position=100,
+                                                 size=10, timestamp=11)
+        assert keydir[b'key-5'] == bitcask.Hint(fobj=fobj2, position=2 ** 40,
+                                                size=123, timestamp=456)
+        assert keydir.get(b'non-existent') is None
+        assert set(keydir) == {'key-{}'.format(counter).encode('ascii')
+                               for counter in range(1000)}
+
+        for counter in range(0, 1000, 2):
+            del keydir[('key-{}'.format(counter)).encode('ascii')]
+        with pytest.raises(KeyError):
+            del keydir[b'key-0']
+        assert len(keydir) == 500
+        assert b'key-2' not in keydir
+        assert keydir[b'key-5'].fobj is fobj2
+        assert keydir[b'key-999'].position == 9990
+        assert len(list(keydir)) == 500
+
+    def test_rebuild_compacts_in_place(self):
+        fobj = object()
+        keydir = bitcask.CompactKeydir()
+        for counter in range(1000):
+            keydir[b'k' * (counter % 7 + 1) + str(counter).encode('ascii')] = \
+                    bitcask.Hint(fobj=fobj, position=counter, size=counter,
+                                 timestamp=counter)
+        for counter in range(700):
+            del keydir[b'k' * (counter % 7 + 1) +
+                       str(counter).encode('ascii')]
+            if counter == 500:  # more than half were deleted: compacted
+                assert len(keydir._files) == 499
+                assert len(keydir._keys) == sum(len(key) for key in keydir)
+
+        assert len(keydir) == 300
+        for counter in range(700, 1000):
+            key = b'k' * (counter % 7 + 1) + str(counter).encode('ascii')
+            assert keydir[key] == bitcask.Hint(fobj=fobj, position=counter,
+                                               size=counter, timestamp=counter)
+
+    def test_frozen_blocks(self):
+        fobj = object()
+        keydir = bitcask.CompactKeydir()
+        hints = {}
+        for counter in range(100):
+            key = bytes('key{}'.format(counter), 'ascii')
+            keydir[key] = hints[key] = bitcask.Hint(
+                    fobj=fobj, position=counter, size=counter,
+                    timestamp=counter)
+        del keydir[b'key0']
+        del hints[b'key0']
+        keydir.freeze()
+        items = keydir.block_items(keydir.frozen_block(0, 30))
+        for counter in range(1, 90):  # deleted, not compacted
+            del keydir[bytes('key{}'.format(counter), 'ascii')]
+        keydir[b'key95'] = keydir[b'key95']._replace(position=0)
+        keydir[b'key100'] = hints[b'key99']
+        assert len(keydir._files) == 101
+        for start in range(30, 200, 30):
+            items += keydir.block_items(keydir.frozen_block(start,
+                                                            start + 30))
+        assert dict(items) == hints  # as they were on `freeze`
+
+        keydir.unfreeze()
+        assert len(keydir._files) == len(keydir) == 11  # compacted
+        assert keydir[b'key95'].position == 0
+        assert keydir[b'key100'] == hints[b'key99']
+
+    def test_bitcask_with_compact_keydir(self):
+        obj = bitcask.Bitcask(self.tmpdir, compact_keydir=True)
+        assert isinstance(obj._keydir, bitcask.CompactKeydir)
+        for counter in range(3):
+            obj[b'key'] = 'value-{}'.format(counter).encode('ascii')
+        obj[b'other'] = b'other-value'
+        obj.merge()
+
+        assert len(obj) == 2
+        assert obj[b'key'] == b'value-2'
+        assert obj[b'other'] == b'other-value'
+        obj.close()
+
+        obj = bitcask.Bitcask(self.tmpdir, compact_keydir=True)
+        assert obj[b'key'] == b'value-2'
+        assert sorted(obj) == [b'key', b'other']
+
+
+class TestBitcaskRotation(TmpDir):
+
+    def test_active_file_is_rotated(self):
+        # each entry has 14 + 5 + 15 = 34 bytes, so 3 entries fit on a file
+        obj = bitcask.Bitcask(self.tmpdir, max_file_size=110)
+        for counter in range(7):
+            key = 'k{:04d}'.format(counter).encode('ascii')
+            obj[key] = 'value-{:09d}'.format(counter).encode('ascii')
+
+        assert obj._active_fileid == 3
+        assert os.path.getsize(self._path('1.bitcask.data')) == 102
+        assert os.path.getsize(self._path('2.bitcask.data')) == 102
+        assert os.path.getsize(self._path('3.bitcask.data')) == 34
+        # sealed hint files have their CRC, so they're read on next open
+        obj.close()
+        with open(self._path('1.bitcask.hint'), 'rb') as fobj:
+            hintdata = fobj.read()
+        assert len(hintdata) == 3 * (18 + 5) + 18
+
+        obj = bitcask.Bitcask(self.tmpdir, max_file_size=110)
+        assert len(obj) == 7
+        for counter in range(7):
+            key = 'k{:04d}'.format(counter).encode('ascii')
+            assert obj[key] == 'value-{:09d}'.format(counter).encode('ascii')
+
+    def test_big_entry_gets_its_own_file(self):
+        obj = bitcask.Bitcask(self.tmpdir, max_file_size=50)
+        obj[b'small'] = b'value'
+        obj[b'big'] = b'x' * 100
+        obj[b'small2'] = b'value'
+
+        assert obj._active_fileid == 3
+        assert obj[b'big'] == b'x' * 100
+        assert os.path.getsize(self._path('2.bitcask.data')) == 14 + 3 + 100
+
+    def test_merge_output_is_rotated(self):
+        obj = bitcask.Bitcask(self.tmpdir, max_file_size=110)
+        for _ in range(3):
+            for counter in range(7):
+                key = 'k{:04d}'.format(counter).encode('ascii')
+                obj[key] = 'value-{:09d}'.format(counter).encode('ascii')
+        obj.merge()
+
+        datafiles = sorted(obj._datafiles)
+        assert len(datafiles) == 4  # 3 merged files + active file
+        assert datafiles[-1] == obj._active_fileid
+        for fileid in datafiles[:-1]:
+            filename = self._path('{}.bitcask.data'.format(fileid))
+            assert os.path.getsize(filename) <= 110
+        for counter in range(7):
+            key = 'k{:04d}'.format(counter).encode('ascii')
+            assert obj[key] == 'value-{:09d}'.format(counter).encode('ascii')
+
+
+class TestBitcaskMmap(TmpDir):
+
+    def test_mmap_reads(self):
+        obj = bitcask.Bitcask(self.tmpdir, max_file_size=100, mmap_reads=True)
+        obj[b'sealed'] = b'sealed-value' * 5
+        obj[b'active'] = b'active-value'
+
+        value = obj[b'sealed']
+        assert isinstance(value, memoryview)
+        assert value == b'sealed-value' * 5
+        assert obj[b'active'] == b'active-value'
+        assert isinstance(obj[b'active'], bytes)
+
+        obj.merge()
+        assert obj[b'sealed'] == b'sealed-value' * 5
+        assert obj[b'active'] == b'active-value'
+        # memory maps of merged (deleted) files are still valid
+        assert value == b'sealed-value' * 5
+
+    def test_mmap_reads_disabled(self):
+        obj = bitcask.Bitcask(self.tmpdir, max_file_size=100)
+        obj[b'sealed'] = b'sealed-value' * 5
+        obj[b'active'] = b'active-value'
+
+        assert obj[b'sealed'] == b'sealed-value' * 5
+        assert isinstance(obj[b'sealed'], bytes)
+        assert obj._mmaps == {}
+
+
+class TestBitcaskParallelLoad(TmpDir):
+
+    def test_parallel_load(self):
+        obj = bitcask.Bitcask(self.tmpdir, max_file_size=100)
+        for _ in range(2):
+            for counter in range(10):
+                key = 'key-{}'.format(counter).encode('ascii')
+                obj[key] = 'value-{}-{}'.format(counter, _).encode('ascii')
+        obj.close()
+        os.remove(self._path('2.bitcask.hint'))  # will be created by worker
+        serial = bitcask.Bitcask(self.tmpdir)
+        serial_keydir = {key: (os.path.basename(hint.fobj.name),
+                               hint.position, hint.size)
+                         for key, hint in serial._keydir.items()}
+        serial_dead_ratio = serial._dead_ratio()
+        serial.close()
+
+        obj = bitcask.Bitcask(self.tmpdir, load_workers=4)
+        keydir = {key: (os.path.basename(hint.fobj.name), hint.position,
+                        hint.size)
+                  for key, hint in obj._keydir.items()}
+
+        assert os.path.exists(self._path('2.bitcask.hint'))
+        assert keydir == serial_keydir
+        assert obj[b'key-3'] == b'value-3-1'
+        assert obj._dead_ratio() == serial_dead_ratio
+
+
+class TestBitcaskReadOnly(TmpDir):
+
+    def test_read_only_with_writer(self):
+        writer = bitcask.Bitcask(self.tmpdir, max_file_size=100)
+        writer[b'key1'] = b'value1'
+        filenames = sorted(os.listdir(self.tmpdir))
+
+        reader = bitcask.Bitcask(self.tmpdir, read_only=True)
+        assert sorted(os.listdir(self.tmpdir)) == filenames
+        assert reader[b'key1'] == b'value1'
+        assert reader._tail[:2] == [1, reader._datafiles[1]]
+
+        writer[b'key2'] = b'value2'
+        writer[b'key1'] = b'value1-new'
+        assert b'key2' not in reader
+        reader.refresh()
+        assert reader[b'key1'] == b'value1-new'
+        assert reader[b'key2'] == b'value2'
+
+        # writer rotates the active file
+        writer[b'key3'] = b'x' * 50
+        writer[b'key4'] = b'x' * 50
+        reader.refresh()
+        assert writer._active_fileid == 3
+        assert reader._tail[0] == 3
+        assert len(reader) == 4
+        assert reader[b'key4'] == b'x' * 50
+
+        writer.merge()
+        writer[b'key1'] = b'value1-after-merge'
+        reader.refresh()
+        assert reader[b'key1'] == b'value1-after-merge'
+        assert reader[b'key4'] == b'x' * 50
+
+        with pytest.raises(RuntimeError):
+            reader[b'key5'] = b'value5'
+        with pytest.raises(RuntimeError):
+            reader.merge()
+        reader.close()
+        assert os.path.exists(self._path('bitcask.write.lock'))
+
+    def test_tombstones_merged_before_refresh(self):
+        writer = bitcask.Bitcask(self.tmpdir)
+        writer.put_many([(b'a', b'1'), (b'b', b'2')])
+        reader = bitcask.Bitcask(self.tmpdir, read_only=True)
+        old_fobjs = list(reader._datafiles.values())
+        writer.merge()
+        del writer[b'a']
+        writer.merge()  # the tombstone of `a` is never seen by the reader
+
+        reader.refresh()
+        assert b'a' not in reader
+        assert dict(reader.iter_items()) == {b'b': b'2'}
+        # files removed by the writer are closed
+        assert sorted(reader._datafiles) == sorted(writer._datafiles)
+        assert all(fobj.closed for fobj in old_fobjs)
+        assert reader._files == set(reader._datafiles.values())
+
+    def test_refresh_with_merges(self):
+        import random
+
+        random.seed(42)
+        writer = bitcask.Bitcask(self.tmpdir, max_file_size=300)
+        reader = bitcask.Bitcask(self.tmpdir, read_only=True)
+        keys = [bytes('key{}'.format(counter), 'ascii')
+                for counter in range(20)]
+        for step in range(30):
+            for _ in range(random.randint(1, 20)):
+                key = random.choice(keys)
+                if key in writer and random.random() < 0.3:
+                    del writer[key]
+                else:
+                    writer[key] = os.urandom(random.randint(1, 30))
+                if random.random() < 0.05:
+                    writer.merge()
+            reader.refresh()
+            assert dict(reader.iter_items()) == dict(writer.iter_items())
+            assert reader._files == set(reader._datafiles.values())
+            assert set(reader._deleted.values()) <= set(reader._datafiles)
+
+    def test_refresh_with_cache(self):
+        writer = bitcask.Bitcask(self.tmpdir)
+        writer.put_many([(b'a', b'old'), (b'b', b'old')])
+        reader = bitcask.Bitcask(self.tmpdir, read_only=True, cache_size=1024)
+        assert reader[b'a'] == reader[b'b'] == b'old'  # now cached
+
+        writer[b'a'] = b'new'
+        del writer[b'b']
+        reader.refresh()
+        assert reader[b'a'] == b'new'
+        assert b'b' not in reader
+        with pytest.raises(KeyError):
+            reader[b'b']
+
+    def test_incomplete_entry_on_active_file(self):
+        writer = bitcask.Bitcask(self.tmpdir)
+        writer[b'key1'] = b'value1'
+        with open(self._path('1.bitcask.data'), 'ab') as fobj:
+            fobj.write(b'\x00' * 10)  # writer is in the middle of a write
+
+        reader = bitcask.Bitcask(self.tmpdir, read_only=True)
+        assert len(reader) == 1
+        assert reader._tail[2] == 14 + 4 + 6
+
+    def test_read_only_does_not_create_directory(self):
+        with pytest.raises(FileNotFoundError):
+            bitcask.Bitcask(self.tmpdir, read_only=True)
+        assert not os.path.exists(self.tmpdir)
+
+
+class TestBitcaskMerge(TmpDir):
+
+    def _datafiles(self):
+        return sorted(filename for filename in os.listdir(self.tmpdir)
+                      if filename.endswith('.bitcask.data'))
+
+    def test_merge_keeps_only_live_entries(self):
+        obj = bitcask.Bitcask(self.tmpdir)
+        for counter in range(10):
+            obj[b'key'] = 'value-{}'.format(counter).encode('ascii')
+        obj[b'other'] = b'other-value'
+        assert obj._dead_ratio() >= 0.8
+
+        obj.merge()
+
+        assert obj[b'key'] == b'value-9'
+        assert obj[b'other'] == b'other-value'
+        assert obj._dead_ratio() == 0
+        # file 1 was sealed and merged into 2, 3 is the new active file
+        assert self._datafiles() == ['2.bitcask.data', '3.bitcask.data']
+        assert os.path.getsize(self._path('2.bitcask.data')) == \
+                (14 + 3 + 7) + (14 + 5 + 11)
+        assert os.path.exists(self._path('2.bitcask.hint'))
+        obj[b'new'] = b'new-value'
+        obj.close()
+
+        obj = bitcask.Bitcask(self.tmpdir)
+        assert len(obj) == 3
+        assert obj[b'key'] == b'value-9'
+        assert obj[b'other'] == b'other-value'
+        assert obj[b'new'] == b'new-value'
+        assert obj._dead_ratio() == 0
+
+    def test_merge_leftovers_are_removed(self):
+        os.mkdir(self.tmpdir)
+        leftover = self._path('2.bitcask.data.merge')
+        with open(leftover, 'wb') as fobj:
+            fobj.write(b'incomplete')
+
+        obj = bitcask.Bitcask(self.tmpdir)
+
+        assert not os.path.exists(leftover)
+        assert len(obj) == 0
+
+    def test_background_merge(self):
+        obj = bitcask.Bitcask(self.tmpdir, merge_threshold=0.5,
+                              merge_interval=0.01)
+        for counter in range(10):
+            obj[b'key'] = 'value-{}'.format(counter).encode('ascii')
+
+        for _ in range(100):
+            if '1.bitcask.data' not in self._datafiles():
+                break
+            time.sleep(0.01)
+        obj.close()
+        assert '1.bitcask.data' not in self._datafiles()
+
+        obj = bitcask.Bitcask(self.tmpdir)
+        assert obj[b'key'] == b'value-9'
+
+
 # TODO: test hintfile update (with CRC) on Bitcask.close()
 # TODO: test __del__
 # TODO: __init__ should update as dict({'a': 123, 'b': 456})
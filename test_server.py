@@ -0,0 +1,145 @@
+# coding: utf-8
+
+# Copyright 2015-2016 Álvaro Justen
+#
+# This file is part of pybitcask.
+# You can get more information at: https://github.com/turicas/pybitcask
+#
+# pybitcask is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or # (at your option) any later
+# version.
+#
+# pybitcask is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pybitcask. If not, see <http://www.gnu.org/licenses/>.
+
+import pytest
+
+import bitcask
+import server
+
+from test_bitcask import TmpDir
+
+
+class FakeTransport:
+    def __init__(self):
+        self.data = b''
+        self.closed = False
+
+    def write(self, data):
+        self.data += data
+
+    def close(self):
+        self.closed = True
+
+
+class TestParseCommand:
+
+    def test_complete_and_incomplete_commands(self):
+        buffer = (b'*3\r\n$3\r\nSET\r\n$3\r\nkey\r\n$5\r\nvalue\r\n'
+                  b'*2\r\n$3\r\nGET\r\n$3\r\nk')
+
+        arguments, offset = server._parse_command(buffer)
+        assert arguments == [b'SET', b'key', b'value']
+        assert offset == 33
+        assert server._parse_command(buffer, offset) == (None, offset)
+
+    def test_protocol_error(self):
+        with pytest.raises(server.ProtocolError):
+            server._parse_command(b'GET key\r\n')
+
+
+class TestBitcaskProtocol(TmpDir):
+
+    def setup_method(self, method):
+        super().setup_method(method)
+        self.db = bitcask.Bitcask(self.tmpdir)
+        self.protocol = server.BitcaskProtocol(self.db)
+        self.transport = FakeTransport()
+        self.protocol.connection_made(self.transport)
+
+    def _send(self, *commands):
+        for command in commands:
+            self.protocol.data_received(command)
+        data, self.transport.data = self.transport.data, b''
+        return data
+
+    def test_pipelined_commands(self):
+        calls = []
+        put_many = self.db.put_many
+        self.db.put_many = lambda items: calls.append(list(items)) or \
+                put_many(items)
+
+        reply = self._send(b'*3\r\n$3\r\nSET\r\n$2\r\nk1\r\n$2\r\nv1\r\n'
+                           b'*5\r\n$4\r\nMSET\r\n$2\r\nk2\r\n$2\r\nv2\r\n'
+                           b'$2\r\nk3\r\n$2\r\nv3\r\n'
+                           b'*4\r\n$4\r\nMGET\r\n$2\r\nk1\r\n$2\r\nk3\r\n'
+                           b'$2\r\nk4\r\n'
+                           b'*3\r\n$6\r\nEXISTS\r\n$2\r\nk2\r\n$2\r\nk4\r\n'
+                           b'*2\r\n$3\r\nget\r\n$2\r\nk2\r\n')
+
+        assert reply == (b'+OK\r\n+OK\r\n'
+                         b'*3\r\n$2\r\nv1\r\n$2\r\nv3\r\n$-1\r\n'
+                         b':1\r\n'
+                         b'$2\r\nv2\r\n')
+        assert calls == [[(b'k1', b'v1'), (b'k2', b'v2'), (b'k3', b'v3')]]
+
+    def test_del(self):
+        self.db.put_many([(b'k1', b'v1'), (b'k2', b'v2')])
+        reply = self._send(b'*4\r\n$3\r\nDEL\r\n$2\r\nk1\r\n$2\r\nk2\r\n'
+                           b'$2\r\nk3\r\n'
+                           b'*2\r\n$3\r\nGET\r\n$2\r\nk1\r\n')
+
+        assert reply == b':2\r\n$-1\r\n'
+        assert len(self.db) == 0
+
+    def test_info(self):
+        self._send(b'*3\r\n$3\r\nSET\r\n$1\r\nk\r\n$1\r\nv\r\n')
+        reply = self._send(b'*1\r\n$4\r\nINFO\r\n')
+
+        header, body = reply.split(b'\r\n', 1)
+        assert int(header[1:]) == len(body) - 2
+        assert b'bitcask_keys 1\n' in body
+        assert b'bitcask_puts 1\n' in body
+
+    def test_command_split_between_packets(self):
+        reply = self._send(b'*3\r\n$3\r\nSET\r\n$3\r\nke',
+                           b'y\r\n$5\r\nvalue\r\n*2\r\n$3\r\nGET\r\n',
+                           b'$3\r\nkey\r\n')
+
+        assert reply == b'+OK\r\n$5\r\nvalue\r\n'
+        assert self.protocol.buffer == b''
+
+    def test_errors(self):
+        assert self._send(b'*2\r\n$3\r\nSET\r\n$3\r\nkey\r\n') == \
+                b'-ERR wrong number of arguments for \'set\' command\r\n'
+        assert self._send(b'*1\r\n$4\r\nPING\r\n') == \
+                b'-ERR unknown command \'PING\'\r\n'
+        assert not self.transport.closed
+        assert self._send(b'PING\r\n').startswith(b'-ERR Protocol error')
+        assert self.transport.closed
+
+    def test_write_errors(self):
+        self.db.put_many([(b'key', b'value')])
+        self.db.close()
+        self.db = bitcask.Bitcask(self.tmpdir, read_only=True)
+        self.protocol = server.BitcaskProtocol(self.db)
+        self.protocol.connection_made(self.transport)
+        reply = self._send(b'*3\r\n$3\r\nSET\r\n$1\r\nk\r\n$1\r\nv\r\n'
+                           b'*3\r\n$4\r\nMSET\r\n$1\r\nk\r\n$1\r\nv\r\n'
+                           b'*2\r\n$3\r\nGET\r\n$3\r\nkey\r\n')
+
+        error = b'-ERR Bitcask is opened in read-only mode\r\n'
+        assert reply == error + error + b'$5\r\nvalue\r\n'
+
+        def put_many(items):
+            raise OSError('No space left on device')
+
+        self.db.put_many = put_many
+        reply = self._send(b'*3\r\n$3\r\nSET\r\n$1\r\nk\r\n$1\r\nv\r\n')
+        assert reply == b'-ERR No space left on device\r\n'
+        assert not self.transport.closed